@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""
+Converts an obstacle parameter file (YAML, as loaded by `sim_lidar`) into a
+binary obstacle map that `sim_lidar` can memory-map with `obstacles_file`.
+
+    ros2 run svea_core convert_obstacles.py floor2_obstacles.yaml floor2_obstacles.npy
+"""
+
+import argparse
+import ast
+
+import yaml
+
+from svea_core.simulators.obstacle_file import save_obstacles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('params', help='YAML file with the obstacles parameter')
+    parser.add_argument('output', help='obstacle map to write (.npy)')
+    args = parser.parse_args()
+
+    with open(args.params) as f:
+        params = yaml.safe_load(f)
+    if '/**' in params:
+        params = params['/**']['ros__parameters']
+
+    obstacles = params['obstacles']
+    if isinstance(obstacles, str):
+        obstacles = ast.literal_eval(obstacles)
+    save_obstacles(args.output, obstacles)
+
+
+if __name__ == '__main__':
+    main()
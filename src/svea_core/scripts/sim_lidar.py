@@ -7,8 +7,8 @@ match the publications made by a Lidar driver.
 Author: Frank Jiang, Javier Cerna
 """
 
-from copy import deepcopy
-from math import cos, sin, sqrt, radians
+from array import array
+from math import radians
 from multiprocessing import Pool
 
 import numpy as np
@@ -17,14 +17,24 @@ import rclpy
 import rclpy.clock
 from rclpy.qos import QoSProfile, QoSDurabilityPolicy, QoSReliabilityPolicy, QoSHistoryPolicy
 from sensor_msgs.msg import LaserScan, PointCloud
-from nav_msgs.msg import Odometry
+from nav_msgs.msg import Odometry, OccupancyGrid
 from visualization_msgs.msg import Marker
 from tf_transformations import euler_from_quaternion
 from tf2_ros import TransformBroadcaster
-from geometry_msgs.msg import TransformStamped
+from geometry_msgs.msg import TransformStamped, PoseArray
 
 from svea_core import rosonic as rx
 from svea_core.utils.viz_util import publish_lidar_points, publish_lidar_rays, publish_edges
+from svea_core.simulators.raycast import edges_from_obstacles, BeamTable, cast_rays
+from svea_core.simulators.spatial import EdgeGrid
+from svea_core.simulators.visibility import VisibilityCuller
+from svea_core.simulators.shared import SharedEdges, cast_beams
+from svea_core.simulators.gridmap import OccupancyRayMarcher
+from svea_core.simulators.scheduler import ScanScheduler, should_publish
+from svea_core.simulators.cache import ScanCache
+from svea_core.simulators.obstacle_file import load_obstacles
+from svea_core.simulators.moving import MovingObstacle
+from svea_core.simulators.noise import NoiseStream
 import ast
 
 
@@ -44,17 +54,64 @@ qos_subber = QoSProfile(
 )
 
 
+qos_map = QoSProfile(
+    reliability=QoSReliabilityPolicy.RELIABLE,
+    durability=QoSDurabilityPolicy.TRANSIENT_LOCAL, # map is published latched
+    history=QoSHistoryPolicy.KEEP_LAST,
+    depth=1,
+)
+
+
 class sim_lidar(rx.Node):
     """Simulated 1-band lidar. It works by taking a list of obstacles,
     and simulates the detected points. Parameters are based on the
-    Hokuyo UST-10LX (reduce computation).
+    Hokuyo UST-10LX.
+
+    Scans are computed by intersecting all beams against the obstacle edges
+    in one vectorized computation. The edges are binned into a uniform grid
+    when the obstacles are loaded, so each beam only tests the edges in the
+    cells it crosses. A worker pool is kept as a fallback and can be enabled
+    with the `use_pool` parameter. The workers read the edges from shared
+    memory and only receive the lidar pose and the beams to compute.
+
+    Only edges that can be visible are considered during a scan. Edges out
+    of range, outside the field of view, back-facing or occluded are culled
+    whenever the lidar has moved more than `visibility_margin` (or turned
+    more than `VISIBILITY_YAW_MARGIN`) since the last culling.
+
+    Exactly one scan is computed per `SCAN_TIME`, from the newest pose
+    received and stamped with the time of that pose. Periods without new
+    odometry are skipped. How many poses were coalesced and how many periods
+    were skipped or dropped is logged every `REPORT_TIME`.
+
+    With `backend` set to `gridmap`, the polygon obstacles are not used.
+    Instead, the occupancy grid on `map_topic` (e.g. from the map server) is
+    ray marched directly, so scans can be simulated against SLAM maps.
+
+    Obstacles are read from the `obstacles` parameter, or, for large maps,
+    memory-mapped from the binary obstacle map in `obstacles_file` (see
+    `convert_obstacles.py` and the obstacles builder GUI).
+
+    The visualization topics are only built every `viz_decimation` scans
+    (`edges_decimation` for the visible edges) and only while they have
+    subscribers, so they cost nothing in headless runs.
+
+    Scans are cached by pose, quantized to `scan_cache_resolution` and
+    `scan_cache_yaw_resolution`, so a parked vehicle does not compute the
+    same scan over and over. The cache is invalidated when the map changes.
+
+    Moving obstacles are given in `moving_obstacles` as a list of
+    `{'polygon': [[x, y], ...], 'trajectory': [[t, x, y, yaw], ...],
+    'loop': True}`, with the polygon in the frame of the obstacle. Obstacles
+    without a trajectory are moved by the poses on `moving_obstacles_topic`,
+    the i-th pose moving the i-th of them. Only the obstacles that moved are
+    updated in the edge grid, and the scan is recomputed even if the vehicle
+    stands still. Moving obstacles require the `edges` backend.
 
     The position of the vehicle is expected to be set externally
     instead of being updated through a ROS communication channel, this
     is to ensure it can be directly used within the SimSVEA class.
 
-    #TODO: add updating list of visible edges
-
 
     TODO: Update for rosonic.
     """
@@ -63,8 +120,7 @@ class sim_lidar(rx.Node):
 
     ANGLE_MIN = radians(-135.0) # start angle of scan [rad]
     ANGLE_MAX = radians(135.0) # end angle of the scan [rad]
-    # INCREMENT = radians(0.25) # angular distance between measurements [rad]
-    INCREMENT = radians(2) # angular distance between measurements [rad]
+    INCREMENT = radians(0.25) # angular distance between measurements [rad]
     TIME_INCREMENT = 0.00002 # time between each beam measurement [s]
     SCAN_TIME = 0.025 # time between scans/between publication [seconds]localize
     RANGE_MIN = 0.02 # min range of lidar [m]
@@ -73,9 +129,31 @@ class sim_lidar(rx.Node):
 
     LIDAR_OFFSET = 0.30 # dist between SVEA rear axle and lidar mount point [m]
 
+    POOL_SIZE = 4 # number of workers for the fallback pool
+
+    VISIBILITY_YAW_MARGIN = radians(5) # turn allowed before culling again [rad]
+
+    REPORT_TIME = 10.0 # time between scheduling reports [s]
+
 
     ## Parameters ##
     odometry_top = rx.Parameter('odometry/local')
+    backend = rx.Parameter('edges') # 'edges' (obstacles) or 'gridmap'
+    map_topic = rx.Parameter('/map') # occupancy grid for gridmap backend
+    obstacles_file = rx.Parameter('') # binary obstacle map, instead of `obstacles`
+    unknown_occupied = rx.Parameter(False) # treat unknown cells as occupied
+    use_pool = rx.Parameter(False) # fallback to per-beam worker pool
+    grid_cell_size = rx.Parameter(1.0) # cell size of obstacle edge grid [m]
+    visibility_margin = rx.Parameter(0.25) # move allowed before culling again [m]
+    viz_decimation = rx.Parameter(4) # publish lidar viz every N scans, 0 to disable
+    edges_decimation = rx.Parameter(40) # publish visible edges every N scans, 0 to disable
+    scan_cache_size = rx.Parameter(16) # number of cached scans, 0 to disable
+    scan_cache_resolution = rx.Parameter(0.01) # position quantization of cached scans [m]
+    scan_cache_yaw_resolution = rx.Parameter(radians(0.25)) # heading quantization [rad]
+    moving_obstacles = rx.Parameter('[]') # moving obstacles, see class description
+    moving_obstacles_topic = rx.Parameter('moving_obstacles') # poses of untimed obstacles
+    range_noise_std = rx.Parameter(0.0) # std of the range noise [m], 0 to disable
+    noise_seed = rx.Parameter(-1) # seed of the range noise, -1 for a random seed
     _viz_points_topic = 'viz_lidar_points'
     _viz_rays_topic = 'viz_lidar_rays'
     _viz_edges_topic = 'viz_edges'
@@ -105,10 +183,8 @@ class sim_lidar(rx.Node):
         rot_offset = np.dot(rot, offset).tolist()[0]
         lidar_xy = vehicle_xy + np.array(rot_offset)
 
-        self._lidar_position = np.append(lidar_xy, yaw)
-
-        self._scan_msg.header.stamp = odmetry_msg.header.stamp
-        self.sim_loop()
+        # the scan is computed by the timer, from the newest pose only
+        self._scheduler.update(np.append(lidar_xy, yaw), odmetry_msg.header.stamp)
 
 
     ## Main Methods ##
@@ -118,14 +194,42 @@ class sim_lidar(rx.Node):
         self.get_logger().info("Startup complete.")
 
         self._lidar_position = None # [x, y, yaw] -> [m, m, rad]
-        self._last_visibility_pos = None # [x, y, yaw] -> [m, m, rad]
         self._obstacles = None
-        self._visible_edges = []
+        self._edges = np.empty((0, 4))
+        self._edge_grid = None
+        self._culler = None
+        self._visible_edges = np.empty((0, 4))
+        self._ray_marcher = None
+        self._moving = []
 
-        self.ranges = []
         self.viz_points = []
-
-        self._pool = Pool(4) # worker pool for tasks that need a bit of help
+        self._scan_count = 0
+
+        self._scheduler = ScanScheduler(self.SCAN_TIME)
+        self._scan_cache = ScanCache(self.scan_cache_size,
+                                     self.scan_cache_resolution,
+                                     self.scan_cache_yaw_resolution)
+
+        self._angles = np.arange(self.ANGLE_MIN, self.ANGLE_MAX, self.INCREMENT)
+        self._range_noise = None
+        if self.range_noise_std > 0:
+            self._range_noise = NoiseStream(self.range_noise_std, shape=len(self._angles),
+                                            seed=self.noise_seed if self.noise_seed >= 0 else None,
+                                            key=(self.get_namespace().strip('/'), 'lidar'),
+                                            block_size=64)
+        self._beams = BeamTable(self._angles)
+        self._directions = self._beams.directions(0.0)
+
+        # the scan message holds this buffer, scans are written into it in place
+        self._ranges_buffer = array('f', bytes(4 * len(self._angles)))
+        self._ranges = np.frombuffer(self._ranges_buffer, dtype=np.float32)
+        self.ranges = self._ranges
+
+        self._pool = None
+        self._shared_edges = None
+        if self.use_pool:
+            self._pool = Pool(self.POOL_SIZE) # worker pool for tasks that need a bit of help
+            self._shared_edges = SharedEdges()
 
         self._scan_msg = LaserScan()
         self._scan_msg.header.stamp = rclpy.clock.Clock().now().to_msg()
@@ -137,13 +241,39 @@ class sim_lidar(rx.Node):
         self._scan_msg.scan_time = self.SCAN_TIME
         self._scan_msg.range_min = self.RANGE_MIN
         self._scan_msg.range_max = self.RANGE_MAX
+        self._scan_msg.ranges = self._ranges_buffer
 
-        self._obstacles = self.load_param('obstacles', '')
-        self._obstacles = ast.literal_eval(self._obstacles) 
+        if self.backend == 'gridmap':
+            self.create_subscription(OccupancyGrid, self.map_topic, self._map_cb, qos_map)
+        else:
+            if self.obstacles_file:
+                # memory-mapped, shared with other processes using the same map
+                self._edges, polygon_ids = load_obstacles(self.obstacles_file)
+            else:
+                self._obstacles = self.load_param('obstacles', '')
+                self._obstacles = ast.literal_eval(self._obstacles)
+                self._edges, polygon_ids = edges_from_obstacles(self._obstacles, return_ids=True)
+            self._edge_grid = EdgeGrid(self._edges, self.grid_cell_size)
+            self._culler = VisibilityCuller(self._edges, polygon_ids,
+                                            range_max=self.RANGE_MAX,
+                                            angle_min=self.ANGLE_MIN,
+                                            angle_max=self.ANGLE_MAX,
+                                            margin=self.visibility_margin,
+                                            yaw_margin=self.VISIBILITY_YAW_MARGIN)
+            if self._shared_edges is not None:
+                self._shared_edges.publish(self._edges)
+            self._load_moving_obstacles()
 
         self.tf_broadcaster = TransformBroadcaster(self)
 
         self.create_timer(self.SCAN_TIME, self.sim_loop)
+        self.create_timer(self.REPORT_TIME, self.report_scheduling)
+
+    def on_shutdown(self):
+        if self._pool is not None:
+            self._pool.terminate()
+        if self._shared_edges is not None:
+            self._shared_edges.close()
 
     def load_param(self, name, value=None):
         try:
@@ -154,15 +284,99 @@ class sim_lidar(rx.Node):
             assert self.has_parameter(name), f'Missing parameter "{name}"'
         return self.get_parameter(name).value
     
+    def _load_moving_obstacles(self):
+        self._moving = [MovingObstacle(**spec)
+                        for spec in ast.literal_eval(self.moving_obstacles)]
+        self._moving_by_topic = [i for i, obstacle in enumerate(self._moving)
+                                 if obstacle.trajectory is None]
+        self._moving_poses = None
+        self._moving_start = self.get_clock().now().nanoseconds * 1e-9
+        if not self._moving:
+            return
+
+        self._edge_grid.update_dynamic({i: obstacle.edges
+                                        for i, obstacle in enumerate(self._moving)})
+        if self._moving_by_topic:
+            self.create_subscription(PoseArray, self.moving_obstacles_topic,
+                                     self._moving_obstacles_cb, qos_subber)
+        self.get_logger().info(f"Simulating {len(self._moving)} moving obstacles")
+
+    def _moving_obstacles_cb(self, pose_array_msg):
+        self._moving_poses = pose_array_msg.poses
+
+    def _update_moving_obstacles(self, now):
+        """Moves the moving obstacles and updates those that moved in the
+        edge grid."""
+        moved = [i for i, obstacle in enumerate(self._moving)
+                 if obstacle.update(now - self._moving_start)]
+
+        if self._moving_poses is not None:
+            for i, pose in zip(self._moving_by_topic, self._moving_poses):
+                q = pose.orientation
+                _, _, yaw = euler_from_quaternion([q.x, q.y, q.z, q.w])
+                if self._moving[i].set_pose([pose.position.x, pose.position.y, yaw]):
+                    moved.append(i)
+            self._moving_poses = None
+
+        if moved:
+            self._edge_grid.update_dynamic({i: self._moving[i].edges for i in moved})
+            self._scan_cache.invalidate()
+            self._scheduler.refresh()
+
+    def _map_cb(self, map_msg):
+        self._ray_marcher = OccupancyRayMarcher.from_msg(
+            map_msg, unknown_occupied=self.unknown_occupied)
+        self._scan_cache.invalidate()
+        self.get_logger().info(f"Loaded {map_msg.info.width}x{map_msg.info.height} "
+                               f"occupancy grid from {self.map_topic}")
+
+    def _world_loaded(self):
+        if self.backend == 'gridmap':
+            return self._ray_marcher is not None
+        return self._edge_grid is not None
+
     def sim_loop(self):
-        if self._lidar_position is None or self.obstacles is None:
-            pass
-        else:
+        now = self.get_clock().now().nanoseconds * 1e-9
+        if self._moving:
+            self._update_moving_obstacles(now)
+
+        # one scan per period, skipped if neither odometry arrived nor
+        # obstacles moved since the last
+        scheduled = self._scheduler.tick(now)
+        if scheduled is None or not self._world_loaded():
+            return
+
+        # stamped with the time of the pose the scan is computed from
+        self._lidar_position, self._scan_msg.header.stamp = scheduled
+        if self._ray_marcher is None:
             self._update_visible_edges()
-            self._update_scan()
-            self.publish_scan()
+        self._update_scan()
+        if self._range_noise is not None:
+            # after the cache, so that cached scans get fresh noise
+            self._ranges += self._range_noise.sample()
+            # a real lidar never reports ranges outside of its limits, nan is kept
+            np.clip(self._ranges, self.RANGE_MIN, self.RANGE_MAX, out=self._ranges)
+        self.publish_scan()
+
+        # debug topics are decimated and only built if someone is listening
+        self._scan_count += 1
+        publish_points = self._should_publish(self._viz_points_pub, self.viz_decimation)
+        publish_rays = self._should_publish(self._viz_rays_pub, self.viz_decimation)
+        if publish_points or publish_rays:
+            self._update_viz_points()
+        if publish_points:
             self.publish_viz_points()
+        if publish_rays:
             self.publish_viz_rays()
+        if (self._ray_marcher is None
+                and self._should_publish(self._viz_edges_pub, self.edges_decimation)):
+            self.publish_viz_edges()
+
+    def report_scheduling(self):
+        cache = self._scan_cache
+        self.get_logger().info(f"Last {self.REPORT_TIME:.0f} s: {self._scheduler.report()}, "
+                               f"{cache.hits} cached scans")
+        cache.hits = cache.misses = 0
 
     @property
     def obstacles(self):
@@ -185,49 +399,65 @@ class sim_lidar(rx.Node):
         return self._obstacles
 
     def _update_visible_edges(self):
-        if self._last_visibility_pos is None:
-            self._last_visibility_pos = self._lidar_position
-        elif np.all(self._last_visibility_pos == self._lidar_position):
-            # only update visibilty if lidar has moved
-            return
-
-        self._visible_edges = []
-        for obstacle_edges in self._obstacles:
-            for ind in range(len(obstacle_edges) - 1):
-                edge = [obstacle_edges[ind], obstacle_edges[ind + 1]]
-                self._visible_edges.append(edge)
-
-        self._last_visibility_pos = deepcopy(self._lidar_position)
+        # only cull again if lidar has left the margin of the last culling
+        if self._culler.update(self._lidar_position):
+            self._visible_edges = self._edges[self._culler.visible]
+            if self._shared_edges is not None:
+                self._shared_edges.set_visible(self._culler.visible)
 
     def _update_scan(self):
         """Performs a lidar scan, by computing the closest intersection between
-        the obstacles and the beam generated from the lidar (for each angle)."""
+        the obstacles and the beam generated from the lidar (for each angle).
 
-        def beam_segment(angle):
-            lidar_x = self._lidar_position[0]
-            lidar_y = self._lidar_position[1]
-            lidar_heading = self._lidar_position[2]
-            seg_start = [lidar_x + cos(lidar_heading+angle) * self.RANGE_MIN,
-                         lidar_y + sin(lidar_heading+angle) * self.RANGE_MIN]
-            seg_end = [lidar_x + cos(lidar_heading+angle) * self.RANGE_MAX,
-                       lidar_y + sin(lidar_heading+angle) * self.RANGE_MAX]
-            return [seg_start, seg_end]
+        The ranges are written in place into the buffer held by the scan
+        message, and the beam directions into the buffer of the beam table.
+        """
 
-        angles = np.arange(self.ANGLE_MIN, self.ANGLE_MAX, self.INCREMENT)
-        edges = deepcopy(self._visible_edges)
-        beams_and_edges = [[beam_segment(angle), edges] for angle in angles]
+        lidar_xy = self._lidar_position[:2]
+        directions = self._beams.directions(self._lidar_position[2])
 
-        dist_and_intersections = self._pool.map(beam_intersection, beams_and_edges)
+        cached = self._scan_cache.get(self._lidar_position)
+        if cached is not None:
+            np.copyto(self._ranges, cached)
+            return
 
-        self.ranges = []
-        self.viz_points = []
-        for dist_and_intersection in dist_and_intersections:
-            dist = dist_and_intersection[0]
-            intersection = dist_and_intersection[1]
-            self.ranges.append(dist)
-            if not intersection is None:
-                self.viz_points.append(intersection)
-        self._scan_msg.ranges = self.ranges
+        if self._ray_marcher is not None:
+            self._ray_marcher.cast_rays(lidar_xy, directions,
+                                        self.RANGE_MIN, self.RANGE_MAX, out=self._ranges)
+        elif self._pool is not None:
+            np.copyto(self._ranges, self._update_scan_pool())
+        else:
+            self._edge_grid.cast_rays(lidar_xy, directions,
+                                      self.RANGE_MIN, self.RANGE_MAX,
+                                      mask=self._culler.visible, out=self._ranges)
+
+        self._scan_cache.put(self._lidar_position, self._ranges)
+
+    def _update_viz_points(self):
+        hit = ~np.isnan(self._ranges)
+        self.viz_points = (self._lidar_position[:2]
+                           + self._ranges[hit, None] * self._directions[hit])
+
+    def _should_publish(self, publisher, decimation):
+        return should_publish(self._scan_count, decimation,
+                              publisher.publisher.get_subscription_count())
+
+    def _update_scan_pool(self):
+        """Fallback scan that splits the beams over the worker pool. Each
+        worker reads the visible edges from shared memory."""
+        bounds = np.linspace(0, len(self._angles), self.POOL_SIZE + 1).astype(int)
+        tasks = [(self._shared_edges.handle, self._lidar_position,
+                  self.ANGLE_MIN, self.INCREMENT, start, stop,
+                  self.RANGE_MIN, self.RANGE_MAX)
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+        ranges = np.concatenate(self._pool.map(cast_beams, tasks))
+
+        # the workers only know the static edges
+        dynamic_edges = self._edge_grid.dynamic_edges
+        if len(dynamic_edges):
+            ranges = np.fmin(ranges, cast_rays(self._lidar_position[:2], self._directions,
+                                               dynamic_edges, self.RANGE_MIN, self.RANGE_MAX))
+        return ranges
 
     def publish_scan(self):
         self._scan_pub.publish(self._scan_msg)
@@ -238,75 +468,10 @@ class sim_lidar(rx.Node):
     def publish_viz_rays(self):
         publish_lidar_rays(self._viz_rays_pub, self._lidar_position, self.viz_points)
 
+    def publish_viz_edges(self):
+        edges = np.vstack((self._visible_edges, self._edge_grid.dynamic_edges))
+        publish_edges(self._viz_edges_pub, edges.reshape(-1, 2, 2))
 
-def beam_intersection(beam_and_edges):
-    beam = beam_and_edges[0]
-    visible_edges = beam_and_edges[1]
-    distance, intersection = _compute_closest_intersection(beam, visible_edges)
-    if distance == float('inf'):
-        distance = float('nan')
-    return [distance, intersection]
-
-def _compute_closest_intersection(beam, visible_edges):
-    """Computes all the intersections between a list of obstacles and
-    the segment defined by a position and a beam from the lidar. Then,
-    it returns the closest one.
-
-    :param position: position of the lidar (x, y)
-    :type position: tuple
-    :param beam: beam from the lidar (in radians)
-    :type angle: float
-    :param obstacles: List of obstacles (each one with obstacle edges)
-    :type obstacles: list
-    :return: closest intersection point (p_x, p_y), if it exists
-    :rtype: tuple or None
-    """
-    closest_distance = float('inf')
-    closest_intersection = None
-    for edge in visible_edges:
-        intersection = _compute_segseg_intersection(beam, edge)
-        if not intersection is None:
-            distance = _dist(beam[0], intersection)
-            if distance < closest_distance:
-                closest_distance = distance
-                closest_intersection = intersection
-    return closest_distance, closest_intersection
-
-def _dist(pt1, pt2):
-    return sqrt((pt1[0] - pt2[0]) ** 2
-                + (pt1[1] - pt2[1]) ** 2)
-
-def _compute_segseg_intersection(segment1, segment2):
-    """Algorithm to compute a segment to segment intersection.
-    Based on this article:
-        https://en.wikipedia.org/wiki/Line%E2%80%93line_intersection
-
-    :param segment1: first segment (defined by two endpoints)
-    :type segment1: list
-    :param segment2: second segment (defined by two endpoints)
-    :type segment2: list
-    :return: intersection point (p_x, p_y), if it exists
-    :rtype: tuple or None
-    """
-    (x1, y1), (x2, y2) = segment1
-    (x3, y3), (x4, y4) = segment2
-
-    # Check for parallel lines
-    denominator = (x1 - x2) * (y3 - y4) - (y1 - y2) * (x3 - x4)
-
-    if denominator == 0:
-        return None
-
-    t = ((x1 - x3) * (y3 - y4) - (y1 - y3) * (x3 - x4)) / denominator
-    u = -((x1 - x2) * (y1 - y3) - (y1 - y2) * (x1 - x3)) / denominator
-
-    # Check for intersections outside of the segments
-    if (t < 0 or t > 1) or (u < 0 or u > 1):
-        return None
-
-    p_x = x1 + t * (x2 - x1)
-    p_y = y1 + t * (y2 - y1)
-    return (p_x, p_y)
 
 def _compute_lineline_intersection(line1_pt1, line1_pt2,
                                     line2_pt1, line2_pt2):
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Simulation module for the Lidars of a fleet of vehicles. Creates the same fake
+ROS publications as `sim_lidar.py`, but for several vehicles from one process.
+"""
+
+from functools import partial
+from math import radians
+import ast
+
+import numpy as np
+
+import rclpy.clock
+from rclpy.qos import QoSProfile, QoSDurabilityPolicy, QoSReliabilityPolicy, QoSHistoryPolicy
+from sensor_msgs.msg import LaserScan
+from nav_msgs.msg import Odometry
+from tf_transformations import euler_from_quaternion
+
+from svea_core import rosonic as rx
+from svea_core.simulators.raycast import edges_from_obstacles
+from svea_core.simulators.fleet import LidarFleet
+from svea_core.simulators.obstacle_file import load_obstacles
+from svea_core.simulators.scheduler import ScanScheduler
+from svea_core.simulators.noise import NoiseStream
+
+
+qos_pubber = QoSProfile(
+    reliability=QoSReliabilityPolicy.RELIABLE,
+    durability=QoSDurabilityPolicy.VOLATILE,
+    history=QoSHistoryPolicy.KEEP_LAST,
+    depth=1,
+)
+
+
+qos_subber = QoSProfile(
+    reliability=QoSReliabilityPolicy.RELIABLE,  # Reliable
+    history=QoSHistoryPolicy.KEEP_LAST,         # Keep the last N messages
+    durability=QoSDurabilityPolicy.VOLATILE,    # Volatile
+    depth=10,                                   # Size of the queue
+)
+
+
+class sim_lidar_fleet(rx.Node):
+    """Simulated 1-band lidars for a fleet of vehicles, with the same
+    parameters as `sim_lidar`.
+
+    One node subscribes to the odometry of every vehicle in `vehicles` and
+    publishes a scan to `/<vehicle>/scan` for each of them. All scans are
+    computed in one batched call against a single obstacle index, shared by
+    all vehicles, and the footprints of the other vehicles are simulated as
+    obstacles. As in `sim_lidar`, each vehicle is scanned at most once per
+    `SCAN_TIME`, from its newest pose, and only if new odometry arrived.
+    """
+
+    ## Constants ##
+
+    ANGLE_MIN = radians(-135.0) # start angle of scan [rad]
+    ANGLE_MAX = radians(135.0) # end angle of the scan [rad]
+    INCREMENT = radians(0.25) # angular distance between measurements [rad]
+    TIME_INCREMENT = 0.00002 # time between each beam measurement [s]
+    SCAN_TIME = 0.025 # time between scans/between publication [s]
+    RANGE_MIN = 0.02 # min range of lidar [m]
+    RANGE_MAX = 15.0 # max range of lidar [m]
+
+    LIDAR_OFFSET = 0.30 # dist between SVEA rear axle and lidar mount point [m]
+
+    FOOTPRINT_FRONT = 0.45 # dist from rear axle to front of SVEA [m]
+    FOOTPRINT_REAR = 0.15 # dist from rear axle to back of SVEA [m]
+    FOOTPRINT_WIDTH = 0.30 # width of SVEA [m]
+
+    VISIBILITY_YAW_MARGIN = radians(5) # turn allowed before culling again [rad]
+
+    REPORT_TIME = 10.0 # time between scheduling reports [s]
+
+    ## Parameters ##
+    vehicles = rx.Parameter(['svea0', 'svea1']) # namespaces of the vehicles
+    odometry_top = rx.Parameter('odometry/local')
+    scan_top = rx.Parameter('scan')
+    laser_frame = rx.Parameter('laser')
+    obstacles_file = rx.Parameter('') # binary obstacle map, instead of `obstacles`
+    grid_cell_size = rx.Parameter(1.0) # cell size of obstacle edge grid [m]
+    visibility_margin = rx.Parameter(0.25) # move allowed before culling again [m]
+    range_noise_std = rx.Parameter(0.0) # std of the range noise [m], 0 to disable
+    noise_seed = rx.Parameter(-1) # seed of the range noise, -1 for a random seed
+
+    ## Main Methods ##
+
+    def on_startup(self):
+
+        n = len(self.vehicles)
+        self._vehicle_poses = np.full((n, 3), np.nan) # rear axles [x, y, yaw]
+        self._schedulers = [ScanScheduler(self.SCAN_TIME) for _ in range(n)]
+
+        if self.obstacles_file:
+            edges, polygon_ids = load_obstacles(self.obstacles_file)
+        else:
+            obstacles = ast.literal_eval(self.load_param('obstacles', ''))
+            edges, polygon_ids = edges_from_obstacles(obstacles, return_ids=True)
+
+        self._angles = np.arange(self.ANGLE_MIN, self.ANGLE_MAX, self.INCREMENT)
+        # same noise per vehicle as in sim_lidar, given the same seed
+        self._range_noise = None
+        if self.range_noise_std > 0:
+            self._range_noise = [NoiseStream(self.range_noise_std, shape=len(self._angles),
+                                             seed=self.noise_seed if self.noise_seed >= 0 else None,
+                                             key=(vehicle, 'lidar'), block_size=64)
+                                 for vehicle in self.vehicles]
+        self._fleet = LidarFleet(edges, n, self._angles,
+                                 range_min=self.RANGE_MIN,
+                                 range_max=self.RANGE_MAX,
+                                 polygon_ids=polygon_ids,
+                                 cell_size=self.grid_cell_size,
+                                 margin=self.visibility_margin,
+                                 yaw_margin=self.VISIBILITY_YAW_MARGIN,
+                                 footprint=(self.FOOTPRINT_FRONT,
+                                            self.FOOTPRINT_REAR,
+                                            self.FOOTPRINT_WIDTH))
+
+        self._scan_msgs = []
+        self._scan_pubs = []
+        for i, vehicle in enumerate(self.vehicles):
+            scan_msg = LaserScan()
+            scan_msg.header.stamp = rclpy.clock.Clock().now().to_msg()
+            scan_msg.header.frame_id = vehicle + '/' + self.laser_frame
+            scan_msg.angle_min = self.ANGLE_MIN
+            scan_msg.angle_max = self.ANGLE_MAX
+            scan_msg.angle_increment = self.INCREMENT
+            scan_msg.time_increment = self.TIME_INCREMENT
+            scan_msg.scan_time = self.SCAN_TIME
+            scan_msg.range_min = self.RANGE_MIN
+            scan_msg.range_max = self.RANGE_MAX
+            self._scan_msgs.append(scan_msg)
+
+            self._scan_pubs.append(self.create_publisher(
+                LaserScan, f'/{vehicle}/{self.scan_top}', qos_pubber))
+            self.create_subscription(
+                Odometry, f'/{vehicle}/{self.odometry_top}',
+                partial(self.update_vehicle_pose, i), qos_subber)
+
+        self.get_logger().info(f"Simulating lidars of {n} vehicles "
+                               f"against {len(edges)} obstacle edges.")
+
+        self.create_timer(self.SCAN_TIME, self.sim_loop)
+        self.create_timer(self.REPORT_TIME, self.report_scheduling)
+
+    def load_param(self, name, value=None):
+        try:
+            self.declare_parameter(name, value)
+        except Exception as e:
+            None
+        if value is None:
+            assert self.has_parameter(name), f'Missing parameter "{name}"'
+        return self.get_parameter(name).value
+
+    def update_vehicle_pose(self, index, odometry_msg):
+        """Stores the pose of one of the vehicles
+
+        :param index: Index of the vehicle in `vehicles`
+        :type index: int
+        :param odometry_msg: Odometry of the vehicle
+        :type odometry_msg: Odometry
+        """
+        position = odometry_msg.pose.pose.position
+        quaternion = odometry_msg.pose.pose.orientation
+        _, _, yaw = euler_from_quaternion([quaternion.x, quaternion.y, quaternion.z, quaternion.w])
+        self._vehicle_poses[index] = (position.x, position.y, yaw)
+
+        # lidars are mounted at a known offset in front of the rear axle
+        lidar_pose = (position.x + self.LIDAR_OFFSET * np.cos(yaw),
+                      position.y + self.LIDAR_OFFSET * np.sin(yaw),
+                      yaw)
+        self._schedulers[index].update(lidar_pose, odometry_msg.header.stamp)
+
+    def sim_loop(self):
+        now = self.get_clock().now().nanoseconds * 1e-9
+
+        # vehicles without new odometry are left out of the batch
+        lidar_poses = np.full((len(self._schedulers), 3), np.nan)
+        stamps = {}
+        for i, scheduler in enumerate(self._schedulers):
+            scheduled = scheduler.tick(now)
+            if scheduled is not None:
+                lidar_poses[i], stamps[i] = scheduled
+        if not stamps:
+            return
+
+        ranges = self._fleet.scan(lidar_poses, self._vehicle_poses)
+
+        for i, stamp in stamps.items():
+            scan_msg = self._scan_msgs[i]
+            scan_msg.header.stamp = stamp
+            if self._range_noise is not None:
+                ranges[i] += self._range_noise[i].sample()
+                # a real lidar never reports ranges outside of its limits, nan is kept
+                np.clip(ranges[i], self.RANGE_MIN, self.RANGE_MAX, out=ranges[i])
+            scan_msg.ranges = ranges[i].tolist()
+            self._scan_pubs[i].publish(scan_msg)
+
+    def report_scheduling(self):
+        for vehicle, scheduler in zip(self.vehicles, self._schedulers):
+            self.get_logger().info(f"{vehicle}, last {self.REPORT_TIME:.0f} s: "
+                                   f"{scheduler.report()}")
+
+
+if __name__ == '__main__':
+    sim_lidar_fleet.main()
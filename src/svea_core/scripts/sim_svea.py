@@ -5,23 +5,39 @@ Simulation module for the SVEA platform. Creates fake ROS
 subscriptions and publications that match the real car platform.
 Intended for debugging code BEFORE running on a real car.
 
+By default the simulation runs in real time on the wall clock. It can also
+drive the ROS time itself by publishing `/clock`, with the rest of the system
+launched with `use_sim_time`:
+
+- `free`: the simulated time runs at `real_time_factor` times real time.
+- `lockstep`: the simulation steps as fast as possible. Before every step it
+  handles all control messages that have arrived, and after every step it
+  waits until all reliable subscribers of the odometry and the clock have
+  received it. This only waits for the delivery of the messages, not for
+  the subscribers to process them, and best-effort subscribers are not
+  waited for at all, so a controller that is slow to react still falls
+  behind the simulation.
+
 Author: Frank Jiang
 """
 
 import math
-import numpy as np
 
 import rclpy
 import rclpy.clock
+from rclpy.executors import SingleThreadedExecutor
+from rclpy.duration import Duration
 from rclpy.qos import QoSProfile, QoSDurabilityPolicy, QoSReliabilityPolicy, QoSHistoryPolicy
 import tf2_ros
-from tf_transformations import quaternion_from_euler
 from geometry_msgs.msg import TransformStamped
 from nav_msgs.msg import Odometry
+from rosgraph_msgs.msg import Clock
 from std_msgs.msg import Bool, Int8
+from builtin_interfaces.msg import Time
 
 from svea_core import rosonic as rx
 from svea_core.models.bicycle import Bicycle4DWithESC
+from svea_core.simulators.noise import NoiseStream
 
 qos_pubber = QoSProfile(
     reliability=QoSReliabilityPolicy.RELIABLE,
@@ -55,6 +71,7 @@ class sim_svea(rx.Node):
 
     LOC_PUB_FREQ = 50 # Hz
     CTRL_WAIT_TIME = 0.2 # s
+    MAX_CTRL_MSGS_PER_STEP = 40 # full queues of all four control topics
     MAX_SPEED_0 = 1.7 # [m/s]
     MAX_SPEED_1 = 3.6 # [m/s]
     MAX_STEERING_ANGLE = 40*math.pi/180
@@ -69,6 +86,12 @@ class sim_svea(rx.Node):
 
     time_step = 0.025
     publish_tf = rx.Parameter(True)
+    integrator = rx.Parameter('euler')  # euler, rk4, exact or adaptive, see Bicycle4D
+
+    clock_mode = rx.Parameter('wall')   # wall, free or lockstep
+    real_time_factor = rx.Parameter(1.0)
+    ack_timeout = rx.Parameter(1.0)     # max wait for subscribers in lockstep [s]
+    noise_seed = rx.Parameter(-1)       # seed of the actuation noise, -1 for a random seed
 
     steering_request_top = rx.Parameter('lli/ctrl/steering')
     throttle_request_top = rx.Parameter('lli/ctrl/throttle')
@@ -91,57 +114,129 @@ class sim_svea(rx.Node):
     @rx.Subscriber(Int8, steering_request_top, qos_subber)
     def steering_request_cb(self, steering_request_msg):
         self.steering_req = steering_request_msg.data * -1
-        self.last_ctrl_time = self.clock.now().to_msg()
+        self._control_received()
     
     @rx.Subscriber(Int8, throttle_request_top, qos_subber)
     def throttle_request_cb(self, throttle_request_msg):
         self.velocity_req = throttle_request_msg.data
-        self.last_ctrl_time = self.clock.now().to_msg()
+        self._control_received()
     
     @rx.Subscriber(Bool, highgear_request_top, qos_subber)
     def highgear_request_cb(self, highgear_request_msg):
         self.highgear = highgear_request_msg.data
-        self.last_ctrl_time = self.clock.now().to_msg()
+        self._control_received()
 
     @rx.Subscriber(Bool, diff_request_top, qos_subber)
     def diff_request_cb(self, diff_request_msg):
         self.diff = diff_request_msg.data
-        self.last_ctrl_time = self.clock.now().to_msg()
+        self._control_received()
+
+    def _control_received(self):
+        self.last_ctrl_time = self._now()
+        self.ctrl_msg_count += 1
 
     ## Main Methods ##
 
     def on_startup(self):
 
+        if self.clock_mode not in ('wall', 'free', 'lockstep'):
+            raise ValueError(f"Unknown clock mode {self.clock_mode!r}, "
+                             "expected wall, free or lockstep")
         self.clock = rclpy.clock.Clock()
-        self.last_ctrl_time = self.clock.now().to_msg()
-        self.last_pub_time = self.clock.now().to_msg()
-
-        self.model = Bicycle4DWithESC(initial_state=self.state)
+        self.sim_time = 0 # [ns]
+        self.clock_msg = Clock()
+        # /clock is only advertised when the simulation drives the time, since nodes
+        # with use_sim_time that see the topic wait for it
+        if self.clock_mode != 'wall':
+            self.clock_pub = self.create_publisher(Clock, '/clock', qos_pubber)
+        self.last_ctrl_time = self._now()
+        self.last_pub_time = self._now()
+        self.ctrl_msg_count = 0
+
+        self.model = Bicycle4DWithESC(initial_state=self.state, integrator=self.integrator)
         self.steering_req = 0.0
         self.velocity_req = 0.0
         self.highgear = False
         self.diff = False
 
         namespace = self.get_namespace()
+        self.noise = NoiseStream((self.STEER_NOISE_STD, self.SPEED_NOISE_STD), shape=2,
+                                 seed=self.noise_seed if self.noise_seed >= 0 else None,
+                                 key=(namespace.strip('/'), 'actuation'))
+
         self.odom_frame = namespace + '/' + self.odom_frame if namespace != '/' else self.odom_frame
         self.self_frame = namespace + '/' + self.self_frame if namespace != '/' else self.self_frame
 
+        # messages are allocated once and updated in place every step
+        self.odom_msg = Odometry()
+        self.odom_msg.header.frame_id = self.map_frame
+        self.odom_msg.child_frame_id = self.self_frame
+
+        self.odom2base = TransformStamped()
+        self.odom2base.header.frame_id = self.odom_frame
+        self.odom2base.child_frame_id = self.self_frame
+
         if self.publish_tf:
             # for broadcasting fake tf tree
             self.tf_br = tf2_ros.TransformBroadcaster(self)
+
+            # map -> odom never changes, so it is only sent once
+            self.tf_static_br = tf2_ros.StaticTransformBroadcaster(self)
+            map2odom = TransformStamped()
+            map2odom.header.stamp = self._now()
+            map2odom.header.frame_id = self.map_frame
+            map2odom.child_frame_id = self.odom_frame
+            map2odom.transform.rotation.w = 1.0
+            self.tf_static_br.sendTransform(map2odom)
         
         ## Timers ##
 
-        self.create_timer(self.time_step, self.sim_loop)
+        if self.clock_mode == 'wall':
+            self.create_timer(self.time_step, self.sim_loop)
+        elif self.clock_mode == 'free':
+            self.create_timer(self.time_step / self.real_time_factor, self.sim_loop)
+
+    def run(self):
+        if self.clock_mode != 'lockstep':
+            return super().run()
+        timeout = Duration(seconds=self.ack_timeout)
+        executor = SingleThreadedExecutor()
+        executor.add_node(self)
+        while rclpy.ok():
+            # handle every control message that has arrived, not only the first, so
+            # that the step uses the newest controls rather than queued up ones
+            for _ in range(self.MAX_CTRL_MSGS_PER_STEP):
+                count = self.ctrl_msg_count
+                executor.spin_once(timeout_sec=0)
+                if self.ctrl_msg_count == count:
+                    break
+            self.sim_loop()
+            for publisher in (self.clock_pub, self.odometry_pub.publisher):
+                if not publisher.wait_for_all_acked(timeout):
+                    self.get_logger().warn("Subscribers did not receive step in time",
+                                           throttle_duration_sec=10.0)
+
+    def _now(self):
+        """Current time, simulated unless running on the wall clock."""
+        if self.clock_mode == 'wall':
+            return self.clock.now().to_msg()
+        return Time(sec=self.sim_time // 10**9, nanosec=self.sim_time % 10**9)
 
     def sim_loop(self):
-        curr_time = self.clock.now().to_msg()
+        if self.clock_mode != 'wall':
+            self.sim_time += round(self.time_step * 1e9)
+            self.clock_msg.clock = self._now()
+            self.clock_pub.publish(self.clock_msg)
+
+        curr_time = self._now()
+
+        steer_noise, speed_noise = self.noise.sample().tolist()
 
         steering = self._percent_to_steer(self.steering_req / self.PERC_TO_LLI_COEFF)
-        steering += np.random.normal(0, self.STEER_NOISE_STD)
+        steering += steer_noise
         
         velocity = self._percent_to_vel(self.velocity_req / self.PERC_TO_LLI_COEFF)
-        velocity += np.random.normal(0, self.SPEED_NOISE_STD)
+        velocity += speed_noise
         
         if not (curr_time.sec - self.last_ctrl_time.sec) < self.CTRL_WAIT_TIME:
             steering, velocity = 0.0, 0.0
@@ -150,26 +245,20 @@ class sim_svea(rx.Node):
 
         # update the state message
         x, y, yaw, vel = self.model.state
-        quat = quaternion_from_euler(0.0, 0.0, yaw)
-        odom_msg = Odometry()
-        odom_msg.header.stamp = curr_time
-        odom_msg.header.frame_id = self.map_frame
-        odom_msg.child_frame_id = self.self_frame
+        odom_msg = self.odom_msg
         odom_msg.header.stamp = curr_time
-        odom_msg.pose.pose.position.x = x
-        odom_msg.pose.pose.position.y = y
-        odom_msg.pose.pose.orientation.x = quat[0]
-        odom_msg.pose.pose.orientation.y = quat[1]
-        odom_msg.pose.pose.orientation.z = quat[2]
-        odom_msg.pose.pose.orientation.w = quat[3]
-        odom_msg.twist.twist.linear.x = vel
+        odom_msg.pose.pose.position.x = float(x)
+        odom_msg.pose.pose.position.y = float(y)
+        odom_msg.pose.pose.orientation.z = math.sin(yaw / 2)
+        odom_msg.pose.pose.orientation.w = math.cos(yaw / 2)
+        odom_msg.twist.twist.linear.x = float(vel)
         
         # publish fake localization data
         if self.publish_tf:
             self._broadcast_tf(odom_msg)
 
         self.odometry_pub.publish(odom_msg)
-        self.last_pub_time = self.clock.now().to_msg()
+        self.last_pub_time = curr_time
             
 
     def _percent_to_steer(self, steering):
@@ -189,25 +278,16 @@ class sim_svea(rx.Node):
     def _broadcast_tf(self, odom_msg):
         """Broadcast the tf tree for the fake localization data"""
 
-        # broadcast the tf tree
-        # map -> odom -> base_link
-
-        map2odom = TransformStamped()
-        map2odom.header.stamp = odom_msg.header.stamp
-        map2odom.header.frame_id = self.map_frame
-        map2odom.child_frame_id = self.odom_frame
-        map2odom.transform.rotation.w = 1.0
-        self.tf_br.sendTransform(map2odom)
+        # broadcast the dynamic part of the tf tree, odom -> base_link,
+        # map -> odom is static
 
-        odom2base = TransformStamped()
+        odom2base = self.odom2base
         odom2base.header.stamp = odom_msg.header.stamp
-        odom2base.header.frame_id = self.odom_frame
-        odom2base.child_frame_id = self.self_frame
         odom2base.transform.translation.x = odom_msg.pose.pose.position.x
         odom2base.transform.translation.y = odom_msg.pose.pose.position.y
-        odom2base.transform.translation.z = odom_msg.pose.pose.position.z
-        odom2base.transform.rotation = odom_msg.pose.pose.orientation
-        self.tf_br.sendTransform(odom2base)
+        odom2base.transform.rotation.z = odom_msg.pose.pose.orientation.z
+        odom2base.transform.rotation.w = odom_msg.pose.pose.orientation.w
+        self.tf_br.sendTransform([odom2base])
 
 if __name__ == '__main__':
     sim_svea.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+Simulation module for a fleet of SVEA vehicles. Creates the same fake ROS
+subscriptions and publications as `sim_svea.py`, but for several vehicles
+from one process.
+"""
+
+from functools import partial
+import ast
+import math
+
+import numpy as np
+
+from rclpy.qos import QoSProfile, QoSDurabilityPolicy, QoSReliabilityPolicy, QoSHistoryPolicy
+import tf2_ros
+from geometry_msgs.msg import TransformStamped
+from nav_msgs.msg import Odometry
+from std_msgs.msg import Bool, Int8
+
+from svea_core import rosonic as rx
+from svea_core.models.bicycle import Bicycle4DWithESCEnsemble
+from svea_core.simulators.noise import NoiseStream
+
+qos_pubber = QoSProfile(
+    reliability=QoSReliabilityPolicy.RELIABLE,
+    durability=QoSDurabilityPolicy.VOLATILE,
+    history=QoSHistoryPolicy.KEEP_LAST,
+    depth=1,
+)
+
+
+qos_subber = QoSProfile(
+    reliability=QoSReliabilityPolicy.RELIABLE,  # Reliable
+    history=QoSHistoryPolicy.KEEP_LAST,         # Keep the last N messages
+    durability=QoSDurabilityPolicy.VOLATILE,    # Volatile
+    depth=10,                                   # Size of the queue
+)
+
+
+class sim_svea_fleet(rx.Node):
+    """Simulated SVEA vehicles for a fleet, with the same constants and
+    parameters as `sim_svea`.
+
+    One node subscribes to the low-level interface topics of every vehicle in
+    `vehicles`, e.g. `/<vehicle>/lli/ctrl/steering`, and publishes the
+    odometry of each of them to `/<vehicle>/<odometry_top>`. The models of all
+    vehicles are stepped together in one vectorized update per time step, and
+    the transforms of all vehicles are broadcast as one message.
+
+    `states` is a list with the initial state `[x, y, yaw, velocity]` of each
+    vehicle, vehicles without one start at the origin.
+    """
+
+    ## Constants ##
+
+    CTRL_WAIT_TIME = 0.2 # s
+    MAX_SPEED_0 = 1.7 # [m/s]
+    MAX_SPEED_1 = 3.6 # [m/s]
+    MAX_STEERING_ANGLE = 40*math.pi/180
+
+    SPEED_NOISE_STD = 0.05
+    STEER_NOISE_STD = 0.1
+
+    # scaling factor, percentage to lli actuation
+    PERC_TO_LLI_COEFF = 1.27
+
+    ## Parameters ##
+
+    time_step = 0.025
+    publish_tf = rx.Parameter(True)
+
+    vehicles = rx.Parameter(['svea0', 'svea1']) # namespaces of the vehicles
+    states = rx.Parameter('[]') # initial states, see class description
+    noise_seed = rx.Parameter(-1) # seed of the actuation noise, -1 for a random seed
+
+    steering_request_top = rx.Parameter('lli/ctrl/steering')
+    throttle_request_top = rx.Parameter('lli/ctrl/throttle')
+    highgear_request_top = rx.Parameter('lli/ctrl/highgear')
+    diff_request_top = rx.Parameter('lli/ctrl/diff')
+
+    odometry_top = rx.Parameter('odometry/local')
+
+    map_frame = rx.Parameter('map')
+    odom_frame = rx.Parameter('odom')
+    self_frame = rx.Parameter('base_link')
+
+    ## Main Methods ##
+
+    def on_startup(self):
+
+        n = len(self.vehicles)
+        states = np.zeros((n, 4))
+        for i, state in enumerate(ast.literal_eval(self.states)[:n]):
+            states[i] = state
+        self.model = Bicycle4DWithESCEnsemble(states, dt=self.time_step)
+
+        self.steering_req = np.zeros(n)
+        self.velocity_req = np.zeros(n)
+        self.highgear = np.zeros(n, dtype=bool)
+        self.diff = np.zeros(n, dtype=bool)
+        self.last_ctrl_time = np.full(n, -np.inf) # [s]
+
+        # same noise per vehicle as in sim_svea, given the same seed
+        self._noise = [NoiseStream((self.STEER_NOISE_STD, self.SPEED_NOISE_STD), shape=2,
+                                   seed=self.noise_seed if self.noise_seed >= 0 else None,
+                                   key=(vehicle, 'actuation'))
+                       for vehicle in self.vehicles]
+        self._noise_samples = np.empty((n, 2))
+
+        self._odometry_pubs = []
+        self._odom_msgs = []
+        self._transforms = []
+        static_transforms = []
+        for i, vehicle in enumerate(self.vehicles):
+            for top, msg_type, callback in ((self.steering_request_top, Int8, self.steering_request_cb),
+                                            (self.throttle_request_top, Int8, self.throttle_request_cb),
+                                            (self.highgear_request_top, Bool, self.highgear_request_cb),
+                                            (self.diff_request_top, Bool, self.diff_request_cb)):
+                self.create_subscription(msg_type, f'/{vehicle}/{top}',
+                                         partial(callback, i), qos_subber)
+            self._odometry_pubs.append(self.create_publisher(
+                Odometry, f'/{vehicle}/{self.odometry_top}', qos_pubber))
+
+            odom_msg = Odometry()
+            odom_msg.header.frame_id = self.map_frame
+            odom_msg.child_frame_id = vehicle + '/' + self.self_frame
+            self._odom_msgs.append(odom_msg)
+
+            map2odom = TransformStamped()
+            map2odom.header.stamp = self.get_clock().now().to_msg()
+            map2odom.header.frame_id = self.map_frame
+            map2odom.child_frame_id = vehicle + '/' + self.odom_frame
+            map2odom.transform.rotation.w = 1.0
+            static_transforms.append(map2odom)
+
+            odom2base = TransformStamped()
+            odom2base.header.frame_id = vehicle + '/' + self.odom_frame
+            odom2base.child_frame_id = vehicle + '/' + self.self_frame
+            self._transforms.append(odom2base)
+
+        if self.publish_tf:
+            # for broadcasting fake tf tree
+            self.tf_br = tf2_ros.TransformBroadcaster(self)
+
+            # map -> odom never changes, so it is only sent once
+            self.tf_static_br = tf2_ros.StaticTransformBroadcaster(self)
+            self.tf_static_br.sendTransform(static_transforms)
+
+        self.get_logger().info(f"Simulating {n} vehicles.")
+
+        ## Timers ##
+
+        self.create_timer(self.time_step, self.sim_loop)
+
+    ## Callbacks ##
+
+    def _control_received(self, index):
+        self.last_ctrl_time[index] = self.get_clock().now().nanoseconds * 1e-9
+
+    def steering_request_cb(self, index, steering_request_msg):
+        self.steering_req[index] = steering_request_msg.data * -1
+        self._control_received(index)
+
+    def throttle_request_cb(self, index, throttle_request_msg):
+        self.velocity_req[index] = throttle_request_msg.data
+        self._control_received(index)
+
+    def highgear_request_cb(self, index, highgear_request_msg):
+        self.highgear[index] = highgear_request_msg.data
+        self._control_received(index)
+
+    def diff_request_cb(self, index, diff_request_msg):
+        self.diff[index] = diff_request_msg.data
+        self._control_received(index)
+
+    def sim_loop(self):
+        now = self.get_clock().now()
+        for i, noise in enumerate(self._noise):
+            self._noise_samples[i] = noise.sample()
+
+        # same conversions as sim_svea, for all vehicles at once
+        steering = self.steering_req / self.PERC_TO_LLI_COEFF / 100 * self.MAX_STEERING_ANGLE
+        steering += self._noise_samples[:, 0]
+
+        max_speed = np.where(self.highgear, self.MAX_SPEED_1, self.MAX_SPEED_0)
+        velocity = self.velocity_req / self.PERC_TO_LLI_COEFF / 100 * max_speed
+        velocity += self._noise_samples[:, 1]
+
+        timed_out = now.nanoseconds * 1e-9 - self.last_ctrl_time >= self.CTRL_WAIT_TIME
+        steering[timed_out] = 0.0
+        velocity[timed_out] = 0.0
+
+        states = self.model.update(steering, velocity)
+
+        # yaw-only quaternions [0, 0, z, w]
+        half_yaw = states[:, 2] / 2
+        quat_z, quat_w = np.sin(half_yaw), np.cos(half_yaw)
+
+        stamp = now.to_msg()
+        for i, odom_msg in enumerate(self._odom_msgs):
+            x, y, _, vel = states[i].tolist()
+            odom_msg.header.stamp = stamp
+            odom_msg.pose.pose.position.x = x
+            odom_msg.pose.pose.position.y = y
+            odom_msg.pose.pose.orientation.z = float(quat_z[i])
+            odom_msg.pose.pose.orientation.w = float(quat_w[i])
+            odom_msg.twist.twist.linear.x = vel
+
+            odom2base = self._transforms[i]
+            odom2base.header.stamp = stamp
+            odom2base.transform.translation.x = x
+            odom2base.transform.translation.y = y
+            odom2base.transform.rotation.z = odom_msg.pose.pose.orientation.z
+            odom2base.transform.rotation.w = odom_msg.pose.pose.orientation.w
+
+            self._odometry_pubs[i].publish(odom_msg)
+
+        # publish fake localization data of all vehicles in one message
+        if self.publish_tf:
+            self.tf_br.sendTransform(self._transforms)
+
+
+if __name__ == '__main__':
+    sim_svea_fleet.main()
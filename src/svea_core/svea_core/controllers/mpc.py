@@ -1,11 +1,31 @@
 #! /usr/bin/env python3
 
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
 import casadi as ca
 import numpy as np
 from rclpy.node import Node
 
 class MPC:
 
+    # Bump when the structure of the problem changes, to invalidate compiled solvers.
+    CODEGEN_VERSION = 2
+
+    # Weight matrices of the objective, which are parameters of the problem.
+    WEIGHTS = ('Q1', 'Q2', 'Q3', 'Qf', 'Qv')
+
+    # Options to silence the QP solvers of the real-time iteration, by CasADi plugin.
+    QP_SOLVER_OPTIONS = {
+        'qrqp': {'print_header': False, 'print_iter': False, 'print_info': False},
+        'osqp': {'osqp': {'verbose': False}},
+        'qpoases': {'printLevel': 'none'},
+    }
+
     def __init__(self, node: Node, config_ns='/mpc') -> None:
         """
         This is the release 0 of a general-purpose Nonlinear Model Predictive Controller (NMPC) 
@@ -42,6 +62,11 @@ class MPC:
         :param Q3: Control weight matrix (2x2)
         :param Qf: Final state weight matrix (4x4)
         :param Qv: Forward_speed_weight scalar
+        :param warm_start: Start each solve from the shifted previous solution
+        :param real_time_iteration: Solve a single QP per call instead of the full NLP
+        :param qp_solver: QP solver of the real-time iteration, any CasADi conic plugin
+        :param codegen: Evaluate the NLP through generated and compiled C code
+        :param codegen_dir: Directory where the compiled solvers are cached
         """
 
         ## Core Parameters
@@ -89,16 +114,55 @@ class MPC:
 
         # Wheelbase of the vehicle (unit [m]).
         self.L = ca.DM(self.load_param('wheelbase', 0.32))
-        
+
+        ## Warm Start
+
+        # Start each solve from the previous solution, shifted by one step.
+        self.warm_start = self.load_param('warm_start', True)
+        self.sol = None
+        self._x_opt = None
+        self._u_opt = None
+        self._lam_g_opt = None
+        self._x_guess = None
+        self._u_guess = None
+        self._lam_g = None
+
+        ## Real-Time Iteration
+
+        # Take a single SQP step per call: the problem is linearized around the shifted
+        # previous solution and one sparse QP is solved, which bounds the computation time.
+        # The linearization needs the previous solution, so warm starting is implied.
+        self.real_time_iteration = self.load_param('real_time_iteration', False)
+        self.qp_solver = self.load_param('qp_solver', 'qrqp')
+        self.warm_start = self.warm_start or self.real_time_iteration
+
+        ## Code Generation
+
+        # Evaluate the NLP through compiled C code instead of the CasADi virtual machine.
+        self.codegen = self.load_param('codegen', False)
+        self.codegen_dir = os.path.expanduser(self.load_param('codegen_dir', '~/.cache/svea_core/mpc'))
+        self.library = os.path.join(self.codegen_dir, f'mpc_{self.problem_hash()}.so')
+        self.solver = None
+        self.bounds = None
+        self._compiler = None
+
         ## Setup CasADi
 
-        self.opti = ca.Opti()
+        self.opti = None
+        self.nlp = None
 
-        self.define_state_and_control_variables()
-        self.set_objective_function()
-        self.set_state_constraints()
-        self.set_control_input_constraints()
-        self.set_solver_options()
+        # Values of the parameters of the problem, stacked as the compiled solver takes them.
+        self.init_parameter_values()
+
+        if self.codegen and os.path.exists(self.library):
+            # The compiled solver does not need the symbolic problem at all.
+            self.load_compiled_solver()
+        if self.solver is None:
+            self.setup_problem()
+            if self.codegen:
+                # Compiling takes from seconds to minutes, until then the problem is solved
+                # through the CasADi virtual machine.
+                self.start_compile()
 
     def load_param(self, name, value=None):
         try:
@@ -125,15 +189,42 @@ class MPC:
         reference_trajectory = ca.vertcat(reference_trajectory,ca.DM.zeros(1, reference_trajectory.shape[1]))
 
         # Set current state and reference trajectory for the active part of the horizon
-        self.opti.set_value(self.x_init, bounded_state)
-        self.opti.set_value(self.x_ref[:, :self.current_horizon+1], reference_trajectory[:, :self.current_horizon+1])
+        x_ref = self.parameter_values['x_ref'].copy()
+        x_ref[:, :self.current_horizon+1] = np.array(reference_trajectory[:, :self.current_horizon+1])
+        self.set_parameter('x_init', bounded_state)
+        self.set_parameter('x_ref', x_ref)
+
+        # Start from the previous solution, if there is one
+        if self.warm_start and self._x_guess is not None:
+            self._x_guess[:, 0] = np.ravel(bounded_state)
+            guess = (self._x_guess, self._u_guess, self._lam_g)
+        elif self.real_time_iteration:
+            # Without a previous solution, linearize around holding the current state
+            guess = (np.tile(np.reshape(bounded_state, (-1, 1)), self.N + 1), np.zeros((2, self.N)), None)
+        else:
+            guess = None
+
+        # Switch to the compiled solver as soon as it is compiled
+        if self._compiler is not None:
+            self.poll_compiled_solver()
 
         # Solve the optimization problem
-        self.sol = self.opti.solve()
+        try:
+            if self.solver is not None:
+                self.solve_compiled(guess)
+            else:
+                self.solve_opti(guess)
+        except RuntimeError:
+            # do not start the next solve from a failed one
+            self.reset_warm_start()
+            raise
+
+        if self.warm_start:
+            self.update_warm_start()
 
         # Extract control actions (acceleration and steering rate)
-        acceleration = self.sol.value(self.u[0, 0])
-        steering_rate = self.sol.value(self.u[1, 0])
+        acceleration = self._u_opt[0, 0]
+        steering_rate = self._u_opt[1, 0]
 
         return steering_rate, acceleration
     
@@ -148,7 +239,7 @@ class MPC:
         :rtype: NumPy array
         """
         if self.sol is not None:
-            u_opt = np.array(self.sol.value(self.u))
+            u_opt = self._u_opt
             if all:
                 return u_opt
             else:
@@ -164,10 +255,257 @@ class MPC:
         :rtype: NumPy array
         """
         if self.sol is not None:
-            return np.array(self.sol.value(self.x))   # Note: to get only optimized one: self.sol.value(self.x[:, :self.current_horizon])
+            return self._x_opt   # Note: to get only optimized one: self._x_opt[:, :self.current_horizon+1]
         else: 
             return None
 
+    def init_parameter_values(self):
+        """
+        Lays out the parameters of the problem in one vector, in the order they are declared
+        in `define_state_and_control_variables`, as Opti and the compiled solver stack them.
+        `parameter_values` holds a view of each parameter into the vector.
+        """
+        shapes = {
+            'x_init': (5, 1),
+            'x_ref': (5, self.N + 1),
+            'Q1': (4, 4),
+            'Q2': (2, 2),
+            'Q3': (2, 2),
+            'Qf': (4, 4),
+            'Qv': (1, 1),
+            'step_mask': (self.N, 1),
+            'rate_mask': (self.N, 1),
+            'final_mask': (self.N + 1, 1),
+        }
+        self._p = np.zeros(sum(rows*cols for rows, cols in shapes.values()))
+        self.parameter_values = {}
+        start = 0
+        for name, (rows, cols) in shapes.items():
+            # CasADi stacks matrices column by column
+            self.parameter_values[name] = self._p[start:start + rows*cols].reshape((rows, cols), order='F')
+            start += rows*cols
+
+        for name in self.WEIGHTS:
+            self.set_parameter(name, getattr(self, name))
+        self.set_horizon_masks()
+
+    def set_parameter(self, name, value):
+        """
+        Sets the value of a parameter of the problem.
+
+        :param name: Name of the parameter, a key of `parameter_values`
+        :type name: str
+        :param value: New value, with as many elements as the parameter
+        """
+        parameter = self.parameter_values[name]
+        parameter[...] = np.reshape(np.asarray(value), parameter.shape)
+        if self.opti is not None:
+            self.opti.set_value(self.parameters[name], parameter)
+
+    def solve_opti(self, guess):
+        """
+        Solves the problem through the CasADi virtual machine.
+
+        :param guess: Initial guess of the states, inputs and multipliers, or None to start
+            from the previous initial guess
+        """
+        if guess is not None:
+            x_guess, u_guess, lam_g = guess
+            self.opti.set_initial(self.x, x_guess)
+            self.opti.set_initial(self.u, u_guess)
+            if lam_g is not None:
+                self.opti.set_initial(self.nlp['lam_g'], lam_g)
+
+        if self.real_time_iteration:
+            # stopping after the first iteration is the point, not a failure
+            self.sol = self.opti.solve_limited()
+        else:
+            self.sol = self.opti.solve()
+
+        self._x_opt = np.reshape(self.sol.value(self.x), (5, self.N + 1))
+        self._u_opt = np.reshape(self.sol.value(self.u), (2, self.N))
+        self._lam_g_opt = self.sol.value(self.nlp['lam_g'])
+
+    def solve_compiled(self, guess):
+        """
+        Solves the problem with the compiled solver. The solver takes the variables and
+        parameters stacked in vectors, so the states and inputs are the first 5*(N+1) and the
+        last 2*N elements of its solution.
+
+        :param guess: Initial guess of the states, inputs and multipliers, or None to start
+            from zero
+        """
+        x0, lam_g0 = 0, 0
+        if guess is not None:
+            x_guess, u_guess, lam_g = guess
+            x0 = np.concatenate((np.ravel(x_guess, order='F'), np.ravel(u_guess, order='F')))
+            if lam_g is not None:
+                lam_g0 = lam_g
+        # The bounds of the constraints depend on parameters, e.g. the initial state.
+        lbg, ubg = self.bounds(self._p)
+        result = self.solver(x0=x0, p=self._p, lbg=lbg, ubg=ubg, lam_g0=lam_g0)
+        stats = self.solver.stats()
+        # as in `opti.solve_limited`, stopping at the iteration limit is accepted
+        limited = self.real_time_iteration and stats['unified_return_status'] == 'SOLVER_RET_LIMITED'
+        if not (stats['success'] or limited):
+            raise RuntimeError(f"MPC solve failed: {stats['return_status']}")
+
+        x = np.array(result['x']).ravel()
+        self._x_opt = np.reshape(x[:5*(self.N + 1)], (5, self.N + 1), order='F')
+        self._u_opt = np.reshape(x[5*(self.N + 1):], (2, self.N), order='F')
+        self._lam_g_opt = np.array(result['lam_g']).ravel()
+        self.sol = CompiledSolution(stats)
+
+    def problem_hash(self):
+        """
+        Hash of everything that defines the structure of the problem, used as the key of the
+        compiled solver. Weights, horizon masks, initial state and reference are parameters of
+        the problem and do not change the generated code.
+        """
+        spec = (self.CODEGEN_VERSION, ca.__version__, self.solver_plugin(), self.N, float(self.dt), float(self.L),
+                self.min_steering, self.max_steering, self.min_steering_rate, self.max_steering_rate,
+                self.min_velocity, self.max_velocity, self.min_acceleration, self.max_acceleration)
+        return hashlib.sha256(repr(spec).encode()).hexdigest()[:16]
+
+    def load_compiled_solver(self):
+        """
+        Loads the compiled solver from the cache. If it cannot be loaded, the problem is
+        solved through the CasADi virtual machine.
+        """
+        try:
+            self.solver = ca.nlpsol('mpc', self.solver_plugin(), self.library, self.solver_options())
+            self.bounds = ca.external('mpc_bounds', self.library)
+        except RuntimeError as e:
+            self._node.get_logger().warn(f"Could not load the compiled MPC, solving without generated code: {e}")
+            self.solver = None
+            self.bounds = None
+            return
+        # The symbolic problem is not used anymore
+        self.opti = None
+        self.nlp = None
+
+    def generate_solver(self, directory):
+        """
+        Generates C code for the functions of the NLP (objective, constraints and their
+        derivatives) and for the bounds of the constraints, which depend on the parameters.
+
+        :param directory: Directory to generate the code into
+        :type directory: str
+        """
+        # The compiled solver takes the variables in the layout of `solve_compiled` and the
+        # parameters in the layout of `parameter_values`.
+        assert self.opti.nx == self.x.numel() + self.u.numel()
+        parameters = ca.symvar(self.nlp['p'])
+        assert len(parameters) == len(self.parameters) and all(
+            ca.is_equal(symbol, self.parameters[name]) for symbol, name in zip(parameters, self.parameters))
+
+        nlp = {name: self.nlp[name] for name in ('x', 'p', 'f', 'g')}
+        solver = ca.nlpsol('mpc', self.solver_plugin(), nlp, self.solver_options())
+        generator = ca.CodeGenerator('mpc_nlp.c')
+        # The solver loads the NLP itself as 'nlp' and its derivatives as 'nlp_*'.
+        generator.add(ca.Function('nlp', [nlp['x'], nlp['p']], [nlp['f'], nlp['g']],
+                                  ['x', 'p'], ['f', 'g']))
+        for name in solver.get_function():
+            generator.add(solver.get_function(name))
+        generator.add(ca.Function('mpc_bounds', [nlp['p']], [self.nlp['lbg'], self.nlp['ubg']],
+                                  ['p'], ['lbg', 'ubg']))
+        generator.generate(directory + os.sep)
+
+    def start_compile(self):
+        """
+        Generates the code of the solver and starts compiling it in the background, at low
+        priority to leave the processor to the control loop. The compiler runs on its own and
+        moves the library into the cache when done, so that it is cached even if the node
+        stops before. See `poll_compiled_solver` for switching to it.
+        """
+        try:
+            os.makedirs(self.codegen_dir, exist_ok=True)
+            build = tempfile.mkdtemp(dir=self.codegen_dir)
+        except OSError as e:
+            self._node.get_logger().warn(f"Could not compile the MPC, solving without generated code: {e}")
+            return
+        try:
+            self.generate_solver(build)
+            # Moved atomically, so that nodes starting at the same time never load half a library.
+            script = ('cd "$1" && nice -n 19 "$0" -fPIC -shared -O3 mpc_nlp.c -o mpc_nlp.so && mv mpc_nlp.so "$2"; '
+                      'status=$?; rm -rf "$1"; exit $status')
+            compiler = os.environ.get('CC', 'gcc')
+            self._compiler = subprocess.Popen(['sh', '-c', script, compiler, build, self.library],
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                              text=True, start_new_session=True)
+        except OSError as e:
+            shutil.rmtree(build, ignore_errors=True)
+            self._node.get_logger().warn(f"Could not compile the MPC, solving without generated code: {e}")
+
+    def poll_compiled_solver(self, timeout=0):
+        """
+        Switches to the compiled solver once it is compiled. Compiling the solver ahead of
+        time, e.g. before the vehicle starts to drive, is a matter of waiting for it here.
+
+        :param timeout: Time to wait for the compiler, None to wait until it is done
+        :type timeout: float
+        :return: True if the compiled solver is used
+        :rtype: bool
+        """
+        if self._compiler is not None:
+            try:
+                # also drains the output of the compiler, which would block on a full pipe
+                _, errors = self._compiler.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                return False
+            if self._compiler.returncode == 0:
+                self.load_compiled_solver()
+            else:
+                self._node.get_logger().warn(f"Could not compile the MPC, solving without generated code: {errors}")
+            self._compiler = None
+        return self.solver is not None
+
+    def update_warm_start(self):
+        """
+        Stores the current solution, shifted by one step, as the initial guess of the
+        next solve. The last step is repeated to fill the end of the horizon. The dual
+        variables are kept as they are, since the constraints do not change between solves.
+        """
+        self._x_guess = self.shift(self._x_opt)
+        self._u_guess = self.shift(self._u_opt)
+        self._lam_g = self._lam_g_opt
+
+    def reset_warm_start(self):
+        """
+        Forgets the previous solution, so that the next solve starts cold.
+        """
+        self._x_guess = None
+        self._u_guess = None
+        self._lam_g = None
+
+    @staticmethod
+    def shift(values):
+        """
+        Shifts a trajectory of states or inputs one step ahead, repeating the last step.
+
+        :param values: Trajectory with one column per step
+        :type values: NumPy array
+        :return: Shifted trajectory
+        :rtype: NumPy array
+        """
+        return np.hstack((values[:, 1:], values[:, -1:]))
+
+    def setup_problem(self):
+        """
+        Builds the symbolic problem that is solved through the CasADi virtual machine, and
+        from which the compiled solver is generated.
+        """
+        self.opti = ca.Opti()
+
+        self.define_state_and_control_variables()
+        self.set_objective_function()
+        self.set_state_constraints()
+        self.set_control_input_constraints()
+        self.set_solver_options()
+
+        # Opti assembles the stacked problem on every access, so it is assembled once.
+        self.nlp = {name: getattr(self.opti, name) for name in ('x', 'p', 'f', 'g', 'lbg', 'ubg', 'lam_g')}
+
     def define_state_and_control_variables(self):
         # Define state and control variables
         self.x = self.opti.variable(5, self.N + 1)  # state = [x, y, theta, v, steering]
@@ -176,32 +514,65 @@ class MPC:
         self.x_init = self.opti.parameter(5)             # Initial state
         self.x_ref = self.opti.parameter(5, self.N + 1)  # Reference trajectory
 
+        # Weights and active horizon are parameters as well, so that they can be
+        # changed at runtime without rebuilding the problem.
+        self.weights = {
+            'Q1': self.opti.parameter(4, 4),
+            'Q2': self.opti.parameter(2, 2),
+            'Q3': self.opti.parameter(2, 2),
+            'Qf': self.opti.parameter(4, 4),
+            'Qv': self.opti.parameter(1, 1),
+        }
+
+        self.step_mask = self.opti.parameter(self.N)       # 1 for steps within the active horizon
+        self.rate_mask = self.opti.parameter(self.N)       # 1 for steps with a following input
+        self.final_mask = self.opti.parameter(self.N + 1)  # 1 for the last step of the active horizon
+
+        # In the order of declaration, as in `parameter_values`. Only the active part of the
+        # reference is set by `compute_control`, the rest must still have a value when the
+        # horizon is reduced before the first solve, hence all parameters start from there.
+        self.parameters = {'x_init': self.x_init, 'x_ref': self.x_ref, **self.weights,
+                           'step_mask': self.step_mask, 'rate_mask': self.rate_mask,
+                           'final_mask': self.final_mask}
+        for name, parameter in self.parameters.items():
+            self.opti.set_value(parameter, self.parameter_values[name])
+
+    def set_horizon_masks(self):
+        """
+        Sets the masks that select the active part of the horizon in the objective.
+        """
+        k = np.arange(self.N + 1)
+        self.set_parameter('step_mask', k[:-1] < self.current_horizon)
+        self.set_parameter('rate_mask', k[:-1] < self.current_horizon - 1)
+        self.set_parameter('final_mask', k == self.current_horizon)
+
     def set_objective_function(self):
         # Define the objective function: 
         # J = (x[k]-x_ref[k])^T Q1 (x[k]-x_ref[k]) + (u[k+1] - u[k])^T Q2 (u[k+1] - u[k]) + u[k]^T Q3 u[k] + Qv max(0,-x[3])^2
+        # The objective covers the whole horizon, the masks select the active part of it.
+        Q1, Q2, Q3, Qf, Qv = (self.weights[name] for name in self.WEIGHTS)
         self.objective = 0
-        for k in range(self.current_horizon):
+        for k in range(self.N):
             # State error term (ignore delta in reference trajectory)
             state_error = self.compute_state_error(self.x[:, k], self.x_ref[:, k])
 
             # Control input rate of change term (u[k+1] - u[k])
-            if k < self.current_horizon - 1:
+            if k < self.N - 1:
                 input_cost = self.u[:, k+1] - self.u[:, k]
-            else:
-                input_cost = ca.DM.zeros(self.u.shape[0], 1)
+                self.objective += self.rate_mask[k] * ca.mtimes([input_cost.T, Q2, input_cost])
 
             # Penalize for negative velocity (soft constraint)
             velocity_penalty = ca.fmax(0, -self.x[3, k])  # Penalize if v < 0
 
             # Accumulate the terms into the objective
-            self.objective += (ca.mtimes([state_error.T, self.Q1, state_error]) 
-                               + ca.mtimes([input_cost.T, self.Q2, input_cost])
-                               + ca.mtimes([self.u[:, k].T, self.Q3, self.u[:, k]])
-                               + ca.mtimes([velocity_penalty.T, self.Qv, velocity_penalty]))
+            self.objective += self.step_mask[k] * (ca.mtimes([state_error.T, Q1, state_error])
+                                                   + ca.mtimes([self.u[:, k].T, Q3, self.u[:, k]])
+                                                   + ca.mtimes([velocity_penalty.T, Qv, velocity_penalty]))
 
         # Final state cost
-        final_state_error = self.compute_state_error(self.x[:, self.current_horizon], self.x_ref[:, self.current_horizon])
-        self.objective += ca.mtimes([final_state_error.T, self.Qf, final_state_error])
+        for k in range(1, self.N + 1):
+            final_state_error = self.compute_state_error(self.x[:, k], self.x_ref[:, k])
+            self.objective += self.final_mask[k] * ca.mtimes([final_state_error.T, Qf, final_state_error])
 
         # Specify type of optimization problem
         self.opti.minimize(self.objective)
@@ -244,8 +615,36 @@ class MPC:
 
     def set_solver_options(self):
         # Set solver options
+        self.opti.solver(self.solver_plugin(), self.solver_options())
+
+    def solver_plugin(self):
+        return "sqpmethod" if self.real_time_iteration else "ipopt"
+
+    def solver_options(self):
+        if self.real_time_iteration:
+            # One SQP iteration, i.e. one QP. The exact Hessian is indefinite away from the
+            # reference (yaw error, velocity penalty), so its negative eigenvalues are clipped to
+            # keep the QP convex. Unlike regularizing the whole Hessian, this keeps the curvature
+            # of the convex directions, and the iterates converge much faster.
+            return {"qpsol": self.qp_solver,
+                    "qpsol_options": dict(self.QP_SOLVER_OPTIONS.get(self.qp_solver, {}),
+                                          error_on_fail=False),
+                    "max_iter": 1,
+                    "convexify_strategy": "eigen-clip",
+                    "error_on_fail": False,
+                    "print_header": False,
+                    "print_iteration": False,
+                    "print_status": False,
+                    "print_time": 0}
         opts = {"ipopt.print_level": 0, "print_time": 0}
-        self.opti.solver("ipopt", opts)
+        if self.warm_start:
+            # The initial guess is close to the solution, so trust its dual variables,
+            # do not push it away from the bounds and start with a small barrier parameter.
+            opts.update({"ipopt.warm_start_init_point": "yes",
+                         "ipopt.warm_start_bound_push": 1e-6,
+                         "ipopt.warm_start_mult_bound_push": 1e-6,
+                         "ipopt.mu_init": 1e-4})
+        return opts
     
     def bound_initial_state(self,state):
         """
@@ -276,12 +675,12 @@ class MPC:
         Dynamically adjust one of the weight matrices.
         Check if the matrix exists as an attribute and if so, update it.
         """
-        if hasattr(self, matrix_name):
+        if matrix_name in self.WEIGHTS:
             try:
-                # Overwrite with the new dense matrix
-                setattr(self, matrix_name, ca.DM(new_value))
-                # Redefine objective function with updated matrix.
-                self.set_objective_function()
+                # Overwrite with the new dense matrix, flattened lists as in the config are reshaped
+                setattr(self, matrix_name, ca.DM(np.reshape(new_value, self.parameter_values[matrix_name].shape)))
+                # Only the value of the weight parameter changes, not the problem.
+                self.set_parameter(matrix_name, getattr(self, matrix_name))
             except Exception as e:
                 print(f"Failed to update {matrix_name}: {e}")
         else:
@@ -294,10 +693,12 @@ class MPC:
         When the horizon is reduced, you simply freeze unused variables and update the reference trajectory 
         and state for the active part of the horizon. The solver will then only optimize over the active steps.
         """
+        if not 1 <= new_horizon <= self.N:
+            raise ValueError(f"Horizon must be between 1 and {self.N}, got {new_horizon}")
         self.current_horizon = new_horizon
         
-        # Redefine objective function with new horizon.
-        self.set_objective_function()
+        # Select the new horizon in the objective, without rebuilding it.
+        self.set_horizon_masks()
 
 
     def reset_parameters(self):
@@ -313,5 +714,199 @@ class MPC:
         self.Q3 = ca.DM(np.array(self.Q3_list).reshape((2, 2)))
         self.Qf = ca.DM(np.array(self.Qf_list).reshape((4, 4)))
         self.Qv = ca.DM(self.Qv_num)
-        # Reset objective function with initial values.
-        self.set_objective_function()
\ No newline at end of file
+        # Reset the parameters of the objective function to the initial values.
+        for name in self.WEIGHTS:
+            self.set_parameter(name, getattr(self, name))
+        self.set_horizon_masks()
+
+class AsyncMPC:
+    """
+    Runs an `MPC` in a worker thread, so that the control loop never waits for the optimizer.
+
+    The control loop hands the current state and reference to `request`, which returns at once.
+    The worker always solves the newest request, requests that arrive during a solve replace
+    each other. `get_control` reads the newest completed solution, interpolated to the current
+    time, so the open-loop plan bridges the time until the next solution is ready.
+
+    Changes to the MPC, such as `set_new_weight_matrix`, are queued and applied by the worker
+    between two solves. Only the active part of the horizon of each solution is kept, the
+    steps after it are not optimized.
+
+    Args:
+        controller: MPC to run, e.g. `MPC(node)`.
+        max_age: Age after which a solution is too old to be used [s]. A solution is never
+            used beyond its active horizon, which is also the default.
+    """
+
+    def __init__(self, controller, max_age=None):
+        self.controller = controller
+        self.dt = float(controller.dt)
+        self.max_age = max_age
+        self.failures = 0
+
+        self._cond = threading.Condition()
+        self._request = None
+        self._changes = []
+        self._solution = None # (stamp, times, states, controls)
+        self._generation = 0 # increased by `clear`, to discard solves started before
+        self._running = True
+
+        self._worker = threading.Thread(target=self._run, name='mpc', daemon=True)
+        self._worker.start()
+
+    def request(self, state, reference_trajectory, stamp):
+        """
+        Requests a solve for the given state, without waiting for it.
+
+        :param state: State of the vehicle at `stamp` [x, y, theta, v, delta]
+        :param reference_trajectory: Reference trajectory [4, N+1]
+        :param stamp: Time the state was measured at [s]
+        :raises RuntimeError: If the worker is not running
+        """
+        if not self._worker.is_alive():
+            raise RuntimeError("The MPC worker is not running")
+        with self._cond:
+            self._request = (np.array(state, dtype=float), reference_trajectory, stamp, self._generation)
+            self._cond.notify()
+
+    def get_control(self, now):
+        """
+        Control actions of the newest solution at the given time, linearly interpolated between
+        the steps of the solution.
+
+        :param now: Current time [s], on the same clock as the stamps of the requests
+        :return: steering_rate, acceleration, or None if there is no solution younger than
+            `max_age` and its active horizon
+        :rtype: tuple or None
+        """
+        solution = self._solution
+        if solution is None:
+            return None
+        stamp, times, _, controls = solution
+        max_age = times[-1] - stamp
+        if self.max_age is not None:
+            max_age = min(max_age, self.max_age)
+        if now - stamp > max_age:
+            return None
+        acceleration = np.interp(now, times[:-1], controls[0])
+        steering_rate = np.interp(now, times[:-1], controls[1])
+        return steering_rate, acceleration
+
+    def get_state(self, now):
+        """
+        Predicted state of the newest solution at the given time, linearly interpolated.
+
+        :param now: Current time [s]
+        :return: Predicted state [x, y, theta, v, delta], or None if there is no solution
+        :rtype: NumPy array or None
+        """
+        solution = self._solution
+        if solution is None:
+            return None
+        _, times, states, _ = solution
+        return np.array([np.interp(now, times, row) for row in states])
+
+    def get_optimal_states(self):
+        """
+        Optimal states of the newest solution for the active part of the prediction horizon.
+
+        :return: The optimal states, or None if there is no solution
+        :rtype: NumPy array or None
+        """
+        solution = self._solution
+        return None if solution is None else solution[2]
+
+    def age(self, now):
+        """
+        Age of the newest solution, i.e. the time since the state it was computed for.
+
+        :param now: Current time [s]
+        :return: Age [s], infinite if there is no solution or the worker is not running, so
+            that there never will be a new one
+        :rtype: float
+        """
+        solution = self._solution
+        if solution is None or not self._worker.is_alive():
+            return float('inf')
+        return now - solution[0]
+
+    def clear(self):
+        """
+        Drops the newest solution and any pending request, e.g. when the goal changes.
+        """
+        with self._cond:
+            self._request = None
+            self._solution = None
+            self._generation += 1
+
+    def set_new_weight_matrix(self, matrix_name, new_value):
+        self._change(self.controller.set_new_weight_matrix, matrix_name, new_value)
+
+    def set_new_prediction_horizon(self, new_horizon):
+        self._change(self.controller.set_new_prediction_horizon, new_horizon)
+
+    def reset_parameters(self):
+        self._change(self.controller.reset_parameters)
+
+    def shutdown(self):
+        """
+        Stops the worker after the current solve.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._worker.join()
+
+    def _failed(self, message):
+        self.failures += 1
+        self.controller._node.get_logger().warn(message)
+
+    def _change(self, method, *args):
+        with self._cond:
+            self._changes.append((method, args))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._request is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                state, reference_trajectory, stamp, generation = self._request
+                self._request = None
+                changes, self._changes = self._changes, []
+
+            # The worker must outlive any error, otherwise the control loop would be left
+            # with its last solution for good.
+            for method, args in changes:
+                try:
+                    method(*args)
+                except Exception as e:
+                    self._failed(f"Could not apply {method.__name__}{args}: {e}")
+            try:
+                self.controller.compute_control(state, reference_trajectory)
+                controls = self.controller.get_optimal_control()
+                states = self.controller.get_optimal_states()
+                horizon = self.controller.current_horizon
+            except Exception as e:
+                self._failed(f"MPC solve failed, keeping the last solution: {e}")
+                continue
+
+            # the steps after the active horizon carry no cost and are meaningless
+            states, controls = states[:, :horizon+1], controls[:, :horizon]
+            times = stamp + self.dt * np.arange(horizon + 1)
+            with self._cond:
+                if generation == self._generation:
+                    self._solution = (stamp, times, states, controls)
+
+
+class CompiledSolution:
+    """
+    Solution of the compiled solver of `MPC`, with the statistics of the solver as in `OptiSol`.
+    """
+
+    def __init__(self, stats):
+        self._stats = stats
+
+    def stats(self):
+        return self._stats
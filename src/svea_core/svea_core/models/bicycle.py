@@ -1,17 +1,16 @@
 """
 Author: Frank Jiang
 """
+from collections import OrderedDict
 import numpy as np
 import math
 
-from rclpy.clock import ClockType
-from builtin_interfaces.msg import Time
-from nav_msgs.msg import Odometry
-import tf_transformations as tf
-
 __all__ = [
     'Bicycle4D',
     'Bicycle4DWithESC',
+    'Bicycle4DEnsemble',
+    'Bicycle4DWithESCEnsemble',
+    'rollout',
 ]
 
 class Bicycle4D:
@@ -34,17 +33,44 @@ class Bicycle4D:
     based on the set sampling time and the embedded bicycle model. Units are
     `[m, rad, s, m/s]`.
 
+    The inputs are held constant over each update, which is integrated with
+    one of the following integrators:
+
+    - `euler`: A single explicit Euler step.
+    - `rk4`: A single classic Runge-Kutta step.
+    - `exact`: Exact integration. With a constant steering angle the car
+      follows a circular arc, so the pose follows in closed form from the
+      distance travelled along it.
+    - `adaptive`: Heun steps with embedded Euler error estimates, the update
+      is split into as many steps as needed to keep the estimated error of
+      each step below `TOLERANCE`.
+
     Args:
         initial_state: Initial state of model, defaults to origin.
+        dt: Sampling time [s].
+        integrator: Name of the integrator.
     """
 
     L = 0.32
     DELTA_MAX = 40 * (math.pi/180)  # max steering angle [rad]
     ACCEL_MAX = 2.                  # max acceleration [m/s]
 
-    def __init__(self, initial_state=(0., 0., 0., 0.), dt=0.1):
+    TOLERANCE = 1e-4                # max error per adaptive step [m]
+    MAX_SUBSTEPS = 64               # max adaptive steps per update
+
+    JACOBIAN_CACHE_SIZE = 128       # number of cached linearizations
+
+    INTEGRATORS = ('euler', 'rk4', 'exact', 'adaptive')
+
+    def __init__(self, initial_state=(0., 0., 0., 0.), dt=0.1, integrator='euler'):
+        if integrator not in self.INTEGRATORS:
+            raise ValueError(f"Unknown integrator {integrator!r}, "
+                             f"expected one of {self.INTEGRATORS}")
         self.state = initial_state
         self.dt = dt
+        self.integrator = integrator
+        self._step = getattr(self, '_step_' + integrator)
+        self._jacobians = OrderedDict()
 
     x = property(lambda self: self.state[0])
     y = property(lambda self: self.state[1])
@@ -57,21 +83,154 @@ class Bicycle4D:
             dt = self.dt
 
         # Input
-        delta = np.clip(delta, -self.DELTA_MAX, self.DELTA_MAX)
-        accel = np.clip(accel, -self.ACCEL_MAX, self.ACCEL_MAX)
-
-        # State        
-        x, y, yaw, vel = self.state
+        delta = min(max(delta, -self.DELTA_MAX), self.DELTA_MAX)
 
         # Update
-        x += vel * np.cos(yaw) * dt
-        y += vel * np.sin(yaw) * dt
-        yaw += vel / self.L * np.tan(delta) * dt
-        vel += accel * dt
-        self.state = (x, y, yaw, vel)
+        self.state = tuple(self._step(self.state, delta, accel, dt))
 
         return self.state
 
+    def linearize(self, state, control, dt=None):
+        """Jacobians of the Euler discretization of the model, i.e. of
+        `update` with the `euler` integrator, at an operating point.
+
+        Linearizations are cached, so repeated operating points, e.g. a
+        constant reference, are only linearized once.
+
+        :param state: State `[x, y, yaw, vel]`
+        :type state: array_like
+        :param control: Inputs, as passed to `update`
+        :type control: array_like
+        :param dt: Sampling time [s], defaults to `dt` of the model
+        :type dt: float, optional
+        :return: Read-only Jacobians `A` with respect to the state, shape
+                 (4, 4), and `B` with respect to the inputs, shape (4, 2)
+        :rtype: tuple of numpy.ndarray
+        """
+        if dt is None:
+            dt = self.dt
+        key = (*map(float, state), *map(float, control), dt)
+        jacobians = self._jacobians.get(key)
+        if jacobians is not None:
+            self._jacobians.move_to_end(key)
+            return jacobians
+
+        A, B = self.linearize_trajectory([state], [control], dt)
+        A, B = A[0], B[0]
+        A.flags.writeable = B.flags.writeable = False
+        self._jacobians[key] = A, B
+        if len(self._jacobians) > self.JACOBIAN_CACHE_SIZE:
+            self._jacobians.popitem(last=False)
+        return A, B
+
+    def linearize_trajectory(self, states, controls, dt=None, out=None):
+        """Jacobians of the Euler discretization of the model at every point
+        of a trajectory, see `linearize`.
+
+        :param states: States `[x, y, yaw, vel]` of the trajectory
+        :type states: array_like with shape (T, 4)
+        :param controls: Inputs at each state, as passed to `update`
+        :type controls: array_like with shape (T, 2)
+        :param dt: Sampling time [s], defaults to `dt` of the model
+        :type dt: float, optional
+        :param out: Arrays to write `A` and `B` to
+        :type out: tuple of numpy.ndarray, optional
+        :return: Jacobians `A`, shape (T, 4, 4), and `B`, shape (T, 4, 2)
+        :rtype: tuple of numpy.ndarray
+        """
+        if dt is None:
+            dt = self.dt
+        states = np.asarray(states, dtype=float).reshape(-1, 4)
+        controls = np.asarray(controls, dtype=float).reshape(-1, 2)
+        if out is None:
+            out = np.empty((len(states), 4, 4)), np.empty((len(states), 4, 2))
+        A, B = out
+
+        yaw, vel = states[:, 2], states[:, 3]
+        delta = controls[:, 0]
+        cos_yaw, sin_yaw = np.cos(yaw), np.sin(yaw)
+        # the clipped inputs have no effect where they saturate
+        steerable = np.abs(delta) <= self.DELTA_MAX
+        delta = np.clip(delta, -self.DELTA_MAX, self.DELTA_MAX)
+        dvel_dvel, dvel_du = self._velocity_jacobian(vel, controls[:, 1])
+
+        A[:] = np.eye(4)
+        A[:, 0, 2] = -dt * vel * sin_yaw
+        A[:, 0, 3] = dt * cos_yaw
+        A[:, 1, 2] = dt * vel * cos_yaw
+        A[:, 1, 3] = dt * sin_yaw
+        A[:, 2, 3] = dt / self.L * np.tan(delta)
+        A[:, 3, 3] += dt * dvel_dvel
+
+        B[:] = 0.0
+        B[:, 2, 0] = np.where(steerable, dt * vel / (self.L * np.cos(delta)**2), 0.0)
+        B[:, 3, 1] = dt * dvel_du
+
+        return A, B
+
+    def _velocity_jacobian(self, vel, accel):
+        """Derivatives of the acceleration with respect to the velocity and
+        the acceleration input."""
+        unsaturated = np.abs(accel) <= self.ACCEL_MAX
+        return np.zeros_like(vel), unsaturated.astype(float)
+
+    def _acceleration(self, vel, accel):
+        """Acceleration of the car given the acceleration input."""
+        return min(max(accel, -self.ACCEL_MAX), self.ACCEL_MAX)
+
+    def _travel(self, vel, accel, dt):
+        """Exact distance travelled and final velocity over `dt`."""
+        accel = self._acceleration(vel, accel)
+        return vel*dt + accel*dt**2/2, vel + accel*dt
+
+    def _derivative(self, state, delta, accel):
+        _, _, yaw, vel = state
+        return (vel * math.cos(yaw),
+                vel * math.sin(yaw),
+                vel / self.L * math.tan(delta),
+                self._acceleration(vel, accel))
+
+    def _step_euler(self, state, delta, accel, dt):
+        derivative = self._derivative(state, delta, accel)
+        return [s + dt*d for s, d in zip(state, derivative)]
+
+    def _step_rk4(self, state, delta, accel, dt):
+        k1 = self._derivative(state, delta, accel)
+        k2 = self._derivative([s + dt/2*k for s, k in zip(state, k1)], delta, accel)
+        k3 = self._derivative([s + dt/2*k for s, k in zip(state, k2)], delta, accel)
+        k4 = self._derivative([s + dt*k for s, k in zip(state, k3)], delta, accel)
+        return [s + dt/6*(a + 2*b + 2*c + d)
+                for s, a, b, c, d in zip(state, k1, k2, k3, k4)]
+
+    def _step_exact(self, state, delta, accel, dt):
+        x, y, yaw, vel = state
+        dist, vel = self._travel(vel, accel, dt)
+        dyaw = dist / self.L * math.tan(delta)
+        # the chord of the arc points along the mean heading
+        half = dyaw / 2
+        chord = dist * math.sin(half) / half if half else dist
+        x += chord * math.cos(yaw + half)
+        y += chord * math.sin(yaw + half)
+        return x, y, yaw + dyaw, vel
+
+    def _step_adaptive(self, state, delta, accel, dt):
+        t, h = 0.0, dt
+        h_min = dt / self.MAX_SUBSTEPS
+        k1 = self._derivative(state, delta, accel)
+        while dt - t > 1e-12 * dt:
+            h = min(h, dt - t)
+            euler = [s + h*k for s, k in zip(state, k1)]
+            k2 = self._derivative(euler, delta, accel)
+            error = h/2 * max(abs(b - a) for a, b in zip(k1, k2))
+            if error > self.TOLERANCE and h > h_min:
+                h = max(0.9 * h * math.sqrt(self.TOLERANCE / error), h_min)
+                continue
+            state = [s + h/2*(a + b) for s, a, b in zip(state, k1, k2)]
+            k1 = self._derivative(state, delta, accel)
+            t += h
+            h *= min(2.0, 0.9 * math.sqrt(self.TOLERANCE / error)) if error else 2.0
+        return state
+
 class Bicycle4DWithESC(Bicycle4D):
 
     TAU = 0.1 # gain for simulating SVEA's ESC
@@ -86,8 +245,196 @@ class Bicycle4DWithESC(Bicycle4D):
             velocity: Input velocity for the car
         """
 
+        # With ESC dynamics, see `_acceleration`
+        return super().update(steering, velocity, **kwds)
+
+    def _acceleration(self, vel, velocity):
+        return super()._acceleration(vel, 1/self.TAU * (velocity - vel))
+
+    def _velocity_jacobian(self, vel, velocity):
+        unsaturated = np.abs(velocity - vel) <= self.ACCEL_MAX * self.TAU
+        gain = np.where(unsaturated, 1/self.TAU, 0.0)
+        return -gain, gain
+
+    def _travel(self, vel, velocity, dt):
+        # the ESC saturates at the max acceleration while far from the target
+        # velocity, and then approaches it exponentially
+        error = velocity - vel
+        saturated = min(max(abs(error) / self.ACCEL_MAX - self.TAU, 0.0), dt)
+        accel = math.copysign(self.ACCEL_MAX, error)
+        dist = vel*saturated + accel*saturated**2/2
+        vel += accel*saturated
+
+        rest = dt - saturated
+        decay = math.exp(-rest / self.TAU)
+        error = velocity - vel
+        dist += velocity*rest - error*self.TAU*(1 - decay)
+        return dist, velocity - error*decay
+
+
+class Bicycle4DEnsemble:
+    """Ensemble of simple bicycle models, stepped together.
+
+    Same dynamics as `Bicycle4D`, but the states of all N models are stored as
+    rows `[x, y, yaw, vel]` of one contiguous array and every update is a few
+    vectorized operations over the whole ensemble, written in place. Inputs
+    are either scalars, shared by all models, or arrays with one value per
+    model.
+
+    Args:
+        initial_states: Initial states with shape (N, 4), or the number of
+            models to start at the origin.
+        dt: Sampling time [s].
+    """
+
+    L = Bicycle4D.L
+    DELTA_MAX = Bicycle4D.DELTA_MAX
+    ACCEL_MAX = Bicycle4D.ACCEL_MAX
+
+    def __init__(self, initial_states=1, dt=0.1):
+        if np.ndim(initial_states) == 0:
+            initial_states = np.zeros((int(initial_states), 4))
+        self.states = np.array(initial_states, dtype=float).reshape(-1, 4)
+        self.dt = dt
+
+        # work buffers, so that updates do not allocate
+        n = len(self.states)
+        self._delta = np.empty(n)
+        self._accel = np.empty(n)
+        self._tmp = np.empty(n)
+
+    def __len__(self):
+        return len(self.states)
+
+    x = property(lambda self: self.states[:, 0])
+    y = property(lambda self: self.states[:, 1])
+    yaw = property(lambda self: self.states[:, 2])
+    vel = property(lambda self: self.states[:, 3])
+
+    def update(self, delta, accel, dt=None):
+        """Updates the states of all models.
+
+        :param delta: Steering angle [rad]
+        :type delta: float or numpy.ndarray with shape (N,)
+        :param accel: Acceleration [m/s^2]
+        :type accel: float or numpy.ndarray with shape (N,)
+        :param dt: Sampling time [s], defaults to `dt` of the ensemble
+        :type dt: float, optional
+        :return: States of all models, updated in place
+        :rtype: numpy.ndarray with shape (N, 4)
+        """
+        if dt is None:
+            dt = self.dt
+
+        # Input
+        delta = np.clip(delta, -self.DELTA_MAX, self.DELTA_MAX, out=self._delta)
+        accel = np.clip(accel, -self.ACCEL_MAX, self.ACCEL_MAX, out=self._accel)
+
+        # State
+        x, y, yaw, vel = self.states.T
+        tmp = self._tmp
+
+        # Update, every step only uses the previous state
+        np.cos(yaw, out=tmp)
+        tmp *= vel
+        tmp *= dt
+        x += tmp
+        np.sin(yaw, out=tmp)
+        tmp *= vel
+        tmp *= dt
+        y += tmp
+        np.tan(delta, out=tmp)
+        tmp *= vel
+        tmp *= dt / self.L
+        yaw += tmp
+        accel *= dt
+        vel += accel
+
+        return self.states
+
+    def rollout(self, controls, dt=None, out=None):
+        """Simulates a sequence of inputs for every model.
+
+        The states of the ensemble are advanced to the end of the sequence.
+
+        :param controls: Inputs `[u1, u2]` of each step, as passed to `update`,
+                         shared by all models or one sequence per model
+        :type controls: numpy.ndarray with shape (T, 2) or (N, T, 2)
+        :param dt: Sampling time [s], defaults to `dt` of the ensemble
+        :type dt: float, optional
+        :param out: Array to write the trajectories to
+        :type out: numpy.ndarray with shape (N, T+1, 4), optional
+        :return: Trajectory of each model, starting with its current state
+        :rtype: numpy.ndarray with shape (N, T+1, 4)
+        """
+        controls = np.asarray(controls, dtype=float)
+        steps = controls.shape[-2]
+        if out is None:
+            out = np.empty((len(self), steps + 1, 4))
+
+        out[:, 0] = self.states
+        for t in range(steps):
+            u = controls[..., t, :]
+            out[:, t+1] = self.update(u[..., 0], u[..., 1], dt=dt)
+        return out
+
+
+class Bicycle4DWithESCEnsemble(Bicycle4DEnsemble):
+    """Ensemble of `Bicycle4DWithESC` models, stepped together.
+
+    Takes the same inputs as the low-level interface of the SVEA vehicles,
+    one value per model or a shared scalar.
+    """
+
+    TAU = Bicycle4DWithESC.TAU
+
+    def update(self, steering, velocity, **kwds):
+        """Updates the states of all models.
+
+        :param steering: Input steering angle [rad]
+        :type steering: float or numpy.ndarray with shape (N,)
+        :param velocity: Input velocity [m/s]
+        :type velocity: float or numpy.ndarray with shape (N,)
+        :return: States of all models, updated in place
+        :rtype: numpy.ndarray with shape (N, 4)
+        """
+
         # With ESC dynamics
-        delta = steering
-        accel = 1/self.TAU * (velocity - self.vel)
+        accel = np.subtract(velocity, self.vel, out=self._accel)
+        accel *= 1/self.TAU
+
+        return super().update(steering, accel, **kwds)
+
+
+def rollout(initial_state, controls, dt=0.1, model=Bicycle4DEnsemble, out=None):
+    """Simulates one or a batch of input sequences from an initial state.
+
+    All sequences of a batch are simulated together, one vectorized update per
+    step.
+
+    :param initial_state: Initial state `[x, y, yaw, vel]`, shared by all
+                          sequences, or one per sequence
+    :type initial_state: array_like with shape (4,) or (K, 4)
+    :param controls: Inputs of each step, e.g. `[delta, accel]`
+    :type controls: numpy.ndarray with shape (T, 2) or (K, T, 2)
+    :param dt: Sampling time [s]
+    :type dt: float
+    :param model: Ensemble model to simulate, e.g. `Bicycle4DWithESCEnsemble`
+                  for `[steering, velocity]` inputs
+    :type model: type
+    :param out: Array to write the trajectory to
+    :type out: numpy.ndarray with shape (T+1, 4) or (K, T+1, 4), optional
+    :return: Trajectory, starting with the initial state
+    :rtype: numpy.ndarray with shape (T+1, 4) or (K, T+1, 4)
+    """
+    controls = np.asarray(controls, dtype=float)
+    batched = controls.ndim == 3
+    if not batched:
+        controls = controls[None]
+        if out is not None:
+            out = out[None]
 
-        return super().update(delta, accel, **kwds)
+    states = np.asarray(initial_state, dtype=float).reshape(-1, 4)
+    ensemble = model(np.broadcast_to(states, (len(controls), 4)), dt=dt)
+    trajectory = ensemble.rollout(controls, out=out)
+    return trajectory if batched else trajectory[0]
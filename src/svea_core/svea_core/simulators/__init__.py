@@ -0,0 +1,11 @@
+from .raycast import *
+from .spatial import *
+from .visibility import *
+from .shared import *
+from .gridmap import *
+from .fleet import *
+from .scheduler import *
+from .cache import *
+from .obstacle_file import *
+from .moving import *
+from .noise import *
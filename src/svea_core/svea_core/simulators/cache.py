@@ -0,0 +1,102 @@
+"""
+Scan cache for simulated lidars.
+
+A parked vehicle, e.g. while docking at a charger, keeps reporting the same
+pose, so the lidar keeps computing the same scan. The cache maps the pose,
+quantized to a given resolution, to the ranges computed for it, so repeated
+scans from (practically) the same pose are not computed again.
+"""
+
+from collections import OrderedDict
+import math
+
+import numpy as np
+
+__all__ = [
+    'ScanCache',
+]
+
+
+class ScanCache:
+    """Least recently used cache of scans keyed on quantized poses.
+
+    Scans from poses within the same quantization cell share one entry, so
+    the cached ranges may be off by up to the resolution. The key includes
+    the version of the obstacles, and `invalidate` must be called whenever
+    the obstacles change.
+
+    Args:
+        capacity: Maximum number of cached scans.
+        resolution: Quantization of the position [m].
+        yaw_resolution: Quantization of the heading [rad].
+    """
+
+    def __init__(self, capacity=16, resolution=0.01, yaw_resolution=math.radians(0.25)):
+        self.capacity = capacity
+        self.resolution = resolution
+        self.yaw_resolution = yaw_resolution
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._scans = OrderedDict()
+
+    def __len__(self):
+        return len(self._scans)
+
+    def key(self, pose):
+        """Quantized key of a pose [x, y, yaw]."""
+        yaw = math.remainder(pose[2], 2*math.pi)
+        yaw_bins = max(1, round(2*math.pi / self.yaw_resolution))
+        return (self.version,
+                math.floor(pose[0] / self.resolution),
+                math.floor(pose[1] / self.resolution),
+                math.floor(yaw / self.yaw_resolution) % yaw_bins)
+
+    def get(self, pose):
+        """Returns the cached ranges for a pose.
+
+        :param pose: Pose of the lidar [x, y, yaw]
+        :type pose: array_like
+        :return: Cached ranges, or `None` if the pose is not cached
+        :rtype: numpy.ndarray or None
+        """
+        key = self.key(pose)
+        ranges = self._scans.get(key)
+        if ranges is None:
+            self.misses += 1
+            return None
+        self._scans.move_to_end(key)
+        self.hits += 1
+        return ranges
+
+    def put(self, pose, ranges):
+        """Caches a copy of the ranges computed for a pose.
+
+        Once the cache is full, the array of the least recently used scan is
+        reused for the copy, so a warm cache does not allocate. Cached ranges
+        are read-only since they are shared by all later scans from the same
+        pose.
+
+        :param pose: Pose of the lidar [x, y, yaw]
+        :type pose: array_like
+        :param ranges: Ranges of the scan
+        :type ranges: numpy.ndarray
+        """
+        if self.capacity <= 0:
+            return
+        key = self.key(pose)
+        cached = self._scans.pop(key, None)
+        while len(self._scans) >= self.capacity:
+            _, cached = self._scans.popitem(last=False)
+        if cached is None or cached.shape != ranges.shape or cached.dtype != ranges.dtype:
+            cached = ranges.copy()
+        else:
+            cached.flags.writeable = True
+            np.copyto(cached, ranges)
+        cached.flags.writeable = False
+        self._scans[key] = cached
+
+    def invalidate(self):
+        """Drops all scans, to be called when the obstacles change."""
+        self._scans.clear()
+        self.version += 1
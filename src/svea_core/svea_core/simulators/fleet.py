@@ -0,0 +1,159 @@
+"""
+Batched lidar simulation for fleets of vehicles.
+
+Instead of one simulator per vehicle, each with its own copy of the obstacles,
+all lidars share one obstacle index. The beams of every lidar are stacked with
+their own origin and cast in a single call, and the footprints of the vehicles
+are added as dynamic obstacles so that the vehicles see each other.
+"""
+
+import numpy as np
+
+from .raycast import footprint_edges, _intersect
+from .spatial import EdgeGrid
+from .visibility import VisibilityCuller, _expand
+
+__all__ = [
+    'LidarFleet',
+]
+
+
+class LidarFleet:
+    """Simulated lidars of several vehicles sharing one obstacle map.
+
+    Scans are cast against the union of the edges visible to any of the
+    lidars, which keeps the candidate set small while staying valid for every
+    lidar. A lidar never sees the footprint of its own vehicle.
+
+    Args:
+        edges: Edges with rows `[x1, y1, x2, y2]`, shape (M, 4).
+        num_vehicles: Number of vehicles in the fleet.
+        angles: Beam angles relative to the heading of the lidar, in
+            ascending order [rad].
+        range_min: Minimum detectable range [m].
+        range_max: Maximum detectable range [m].
+        polygon_ids: Obstacle index of each edge, used for back-face culling.
+        cell_size: Side length of the cells of the edge grid [m].
+        margin: Distance a lidar can move before culling again [m].
+        yaw_margin: Angle a lidar can turn before culling again [rad].
+        footprint: Footprint of the vehicles `(front, rear, width)` relative
+            to their pose, or `None` to not simulate the vehicles.
+    """
+
+    def __init__(self, edges, num_vehicles, angles, range_min=0.02,
+                 range_max=15.0, polygon_ids=None, cell_size=1.0, margin=0.25,
+                 yaw_margin=np.radians(5), footprint=None):
+
+        self.angles = np.asarray(angles, dtype=float)
+        self.range_min = range_min
+        self.range_max = range_max
+        self.footprint = footprint
+
+        self.grid = EdgeGrid(edges, cell_size)
+        self.cullers = [VisibilityCuller(self.grid.edges, polygon_ids,
+                                         range_max=range_max,
+                                         angle_min=self.angles.min(initial=-np.pi),
+                                         angle_max=self.angles.max(initial=np.pi),
+                                         margin=margin, yaw_margin=yaw_margin)
+                        for _ in range(num_vehicles)]
+
+        self.visible = np.ones(len(self.grid), dtype=bool)
+        self._active = ()
+
+    def __len__(self):
+        return len(self.cullers)
+
+    def scan(self, lidar_poses, vehicle_poses=None):
+        """Computes the scans of all lidars in one batch.
+
+        Vehicles whose pose is not known yet, i.e. contains `nan`, are skipped
+        and get no hits.
+
+        :param lidar_poses: Pose of each lidar [x, y, yaw]
+        :type lidar_poses: numpy.ndarray with shape (N, 3)
+        :param vehicle_poses: Pose of each vehicle footprint [x, y, yaw],
+                              defaults to the lidar poses
+        :type vehicle_poses: numpy.ndarray with shape (N, 3), optional
+        :return: Range of each beam of each lidar, `nan` where nothing is hit
+        :rtype: numpy.ndarray with shape (N, B)
+        """
+        poses = np.asarray(lidar_poses, dtype=float).reshape(-1, 3)
+        ranges = np.full((len(poses), len(self.angles)), np.nan)
+        active = np.flatnonzero(np.isfinite(poses).all(axis=1))
+        if not len(active):
+            return ranges
+
+        self._update_visible(poses, active)
+
+        world_angles = poses[active, 2:3] + self.angles
+        directions = np.stack((np.cos(world_angles), np.sin(world_angles)), axis=-1).reshape(-1, 2)
+        origins = np.repeat(poses[active, :2], len(self.angles), axis=0)
+
+        flat = self.grid.cast_rays(origins, directions, self.range_min, self.range_max,
+                                   mask=self.visible)
+
+        if self.footprint is not None:
+            if vehicle_poses is None:
+                vehicle_poses = poses
+            hits = self._cast_footprints(poses, active, directions, vehicle_poses)
+            flat = np.fmin(flat, hits)
+
+        ranges[active] = flat.reshape(len(active), len(self.angles))
+        return ranges
+
+    def _update_visible(self, poses, active):
+        # every culler is updated, the union only changes if one of them did
+        changed = [self.cullers[i].update(poses[i]) for i in active]
+        if any(changed) or self._active != tuple(active):
+            self.visible = np.logical_or.reduce([self.cullers[i].visible for i in active])
+            self._active = tuple(active)
+
+    def _cast_footprints(self, poses, active, directions, vehicle_poses):
+        """Closest hit with the footprints of the other vehicles.
+
+        Only the beams that can reach the bounding circle of a footprint are
+        tested against its edges.
+        """
+        vehicle_poses = np.asarray(vehicle_poses, dtype=float).reshape(-1, 3)
+        vehicles = np.flatnonzero(np.isfinite(vehicle_poses).all(axis=1))
+        hits = np.full(len(directions), np.inf)
+
+        front, rear, width = self.footprint
+        edges = footprint_edges(vehicle_poses, front, rear, width)
+        heading = np.column_stack((np.cos(vehicle_poses[:, 2]), np.sin(vehicle_poses[:, 2])))
+        centers = vehicle_poses[:, :2] + (front - rear) / 2 * heading
+        radius = np.hypot((front + rear) / 2, width / 2)
+
+        # (lidar, vehicle) pairs where the vehicle can be in range
+        rows, cars = (a.ravel() for a in np.meshgrid(np.arange(len(active)), vehicles,
+                                                      indexing='ij'))
+        lidars = active[rows]
+        offset = centers[cars] - poses[lidars, :2]
+        dist = np.hypot(offset[:, 0], offset[:, 1])
+        keep = (lidars != cars) & (dist - radius <= self.range_max)
+        rows, cars, lidars, offset, dist = rows[keep], cars[keep], lidars[keep], offset[keep], dist[keep]
+        if not len(rows):
+            return np.full(len(directions), np.nan)
+
+        # beams within the bearing spanned by the bounding circle, all beams
+        # if the lidar is inside of it
+        half = np.arcsin(np.minimum(radius / np.maximum(dist, radius), 1))
+        half[dist <= radius] = np.pi
+        bearing = np.arctan2(offset[:, 1], offset[:, 0]) - poses[lidars, 2]
+        bearing = (bearing + np.pi) % (2*np.pi) - np.pi
+        lo, hi = [], []
+        for k in (-2*np.pi, 0, 2*np.pi):
+            lo.append(np.searchsorted(self.angles, bearing - half + k))
+            hi.append(np.searchsorted(self.angles, bearing + half + k, side='right'))
+        beams, pair = _expand(np.concatenate(lo), np.concatenate(hi))
+        pair %= len(rows)
+
+        ray_ids = np.repeat(rows[pair] * len(self.angles) + beams, 4)
+        edge_ids = (4 * cars[pair][:, None] + np.arange(4)).ravel()
+        origin = poses[np.repeat(lidars[pair], 4), :2].T
+        dist = _intersect(origin, directions[ray_ids, 0], directions[ray_ids, 1],
+                          edges[edge_ids], self.range_min, self.range_max)
+        np.minimum.at(hits, ray_ids, dist)
+
+        hits[np.isinf(hits)] = np.nan
+        return hits
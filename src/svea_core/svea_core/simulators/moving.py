@@ -0,0 +1,84 @@
+"""
+Moving obstacles for simulated lidars.
+
+A moving obstacle is a polygon given in its own frame together with its pose
+in the map. The pose either follows a trajectory of timed waypoints or is set
+externally, e.g. from a topic. The edges of the obstacle are only recomputed
+when its pose changes.
+"""
+
+import numpy as np
+
+from .raycast import edges_from_obstacles
+
+__all__ = [
+    'MovingObstacle',
+]
+
+
+class MovingObstacle:
+    """Polygon obstacle moving through the map.
+
+    Args:
+        polygon: Vertices `[[x, y], ...]` of the obstacle in its own frame.
+        trajectory: Waypoints `[[t, x, y, yaw], ...]` with increasing times
+            [s], the pose is linearly interpolated between them. Without a
+            trajectory, the pose is set with `set_pose`.
+        loop: Repeat the trajectory, otherwise the obstacle stops at the last
+            waypoint.
+        pose: Initial pose `[x, y, yaw]`.
+    """
+
+    def __init__(self, polygon, trajectory=None, loop=True, pose=(0.0, 0.0, 0.0)):
+        self.local_edges = edges_from_obstacles([polygon])
+        self.loop = loop
+        self.trajectory = None
+        if trajectory is not None:
+            self.trajectory = np.array(trajectory, dtype=float).reshape(-1, 4)
+            # unwrap so that the heading interpolates the short way around
+            self.trajectory[:, 3] = np.unwrap(self.trajectory[:, 3])
+            pose = self.trajectory[0, 1:]
+        self.pose = np.array(pose, dtype=float)
+        self._edges = None
+
+    @property
+    def edges(self):
+        """Edges of the obstacle at its current pose, shape (k, 4)."""
+        if self._edges is None:
+            x, y, yaw = self.pose
+            rot = np.array([[np.cos(yaw), np.sin(yaw)],
+                            [-np.sin(yaw), np.cos(yaw)]])
+            points = self.local_edges.reshape(-1, 2) @ rot + (x, y)
+            self._edges = points.reshape(-1, 4)
+        return self._edges
+
+    def set_pose(self, pose):
+        """Moves the obstacle.
+
+        :param pose: Pose of the obstacle [x, y, yaw]
+        :type pose: array_like
+        :return: `True` if the obstacle moved
+        :rtype: bool
+        """
+        pose = np.asarray(pose, dtype=float)
+        if np.array_equal(pose, self.pose):
+            return False
+        self.pose = pose
+        self._edges = None
+        return True
+
+    def update(self, t):
+        """Moves the obstacle along its trajectory.
+
+        :param t: Time since the start of the trajectory [s]
+        :type t: float
+        :return: `True` if the obstacle moved
+        :rtype: bool
+        """
+        if self.trajectory is None:
+            return False
+        times = self.trajectory[:, 0]
+        if self.loop and times[-1] > times[0]:
+            t = times[0] + (t - times[0]) % (times[-1] - times[0])
+        pose = [np.interp(t, times, self.trajectory[:, i]) for i in range(1, 4)]
+        return self.set_pose(pose)
@@ -0,0 +1,76 @@
+"""
+Reproducible noise for the simulators.
+
+Drawing one sample at a time from NumPy costs about as much as drawing
+thousands, so a noise stream draws its samples in large blocks and hands them
+out one by one. Every stream has its own generator, seeded from a common seed
+and a key, e.g. the name of the vehicle and of the sensor. The noise of one
+vehicle is therefore the same in every run with the same seed, no matter how
+many other vehicles or sensors are simulated, or in which process.
+"""
+
+import zlib
+
+import numpy as np
+
+__all__ = [
+    'seed_sequence',
+    'NoiseStream',
+]
+
+
+def seed_sequence(seed, *key):
+    """Seed sequence of the stream with the given key.
+
+    :param seed: Common seed, `None` for a random one
+    :type seed: int or None
+    :param key: Key of the stream, e.g. `('svea0', 'lidar')`
+    :type key: int or str
+    :return: Seed sequence, independent of those of other keys
+    :rtype: numpy.random.SeedSequence
+    """
+    spawn_key = tuple(k if isinstance(k, int) else zlib.crc32(str(k).encode())
+                      for k in key)
+    return np.random.SeedSequence(seed, spawn_key=spawn_key)
+
+
+class NoiseStream:
+    """Stream of pre-generated, zero mean Gaussian noise.
+
+    Args:
+        std: Standard deviation, broadcast to `shape`.
+        shape: Shape of each sample, e.g. `(2,)` for steering and speed noise
+            or the number of beams for lidar range noise.
+        seed: Common seed, `None` for a random one.
+        key: Key of the stream, or a tuple of keys, see `seed_sequence`.
+        block_size: Number of samples drawn at once.
+    """
+
+    def __init__(self, std, shape=(), seed=None, key=(), block_size=1024):
+        self.shape = (shape,) if isinstance(shape, int) else tuple(shape)
+        self.std = np.broadcast_to(np.asarray(std, dtype=float), self.shape)
+        self.block_size = block_size
+        key = (key,) if isinstance(key, (int, str)) else tuple(key)
+        self._rng = np.random.default_rng(seed_sequence(seed, *key))
+        self._block = np.empty((block_size,) + self.shape)
+        self._index = block_size
+
+    def _refill(self):
+        self._rng.standard_normal(out=self._block)
+        self._block *= self.std
+        self._index = 0
+
+    def sample(self):
+        """Returns the next sample.
+
+        The returned array is only valid until the next block is drawn, copy
+        it if it is kept.
+
+        :return: Next sample
+        :rtype: float or numpy.ndarray with shape `shape`
+        """
+        if self._index == self.block_size:
+            self._refill()
+        sample = self._block[self._index]
+        self._index += 1
+        return float(sample) if not self.shape else sample
@@ -0,0 +1,68 @@
+"""
+Binary obstacle map files for simulated lidars.
+
+Obstacles are stored as their edges in a single flat float64 `.npy` array:
+
+    [FORMAT_VERSION, M, x1, y1, x2, y2, ... (M x 4 edges), ids ... (M)]
+
+where `ids` is the obstacle index of each edge. The file is memory-mapped when
+loaded, so loading does not depend on the size of the map, and all simulator
+processes loading the same file share the same pages. The edges are returned
+as a contiguous `(M, 4)` view into the map.
+
+Obstacle parameter files, e.g. `params/floor2_obstacles.yaml`, are converted
+with `scripts/convert_obstacles.py`.
+"""
+
+import numpy as np
+
+from .raycast import edges_from_obstacles
+
+__all__ = [
+    'save_obstacles',
+    'load_obstacles',
+]
+
+FORMAT_VERSION = 1
+HEADER_SIZE = 2
+
+
+def save_obstacles(path, obstacles):
+    """Saves obstacles as a binary obstacle map.
+
+    :param path: Path of the file, should end with `.npy`
+    :type path: str
+    :param obstacles: List of obstacles (each one a list of vertices)
+    :type obstacles: list
+    """
+    edges, ids = edges_from_obstacles(obstacles, return_ids=True)
+    data = np.concatenate(([FORMAT_VERSION, len(edges)], edges.ravel(), ids))
+    np.save(path, data)
+
+
+def load_obstacles(path, mmap=True):
+    """Loads a binary obstacle map.
+
+    :param path: Path of the file
+    :type path: str
+    :param mmap: Memory-map the file instead of reading it
+    :type mmap: bool
+    :return: Read-only edges with rows `[x1, y1, x2, y2]` and the obstacle
+             index of each edge
+    :rtype: numpy.ndarray with shape (M, 4), numpy.ndarray with shape (M,)
+    """
+    data = np.load(path, mmap_mode='r' if mmap else None)
+    if data.dtype != np.float64 or data.ndim != 1 or len(data) < HEADER_SIZE:
+        raise ValueError(f"{path} is not an obstacle map")
+    version, size = int(data[0]), int(data[1])
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} has obstacle map format {version}, "
+                         f"expected {FORMAT_VERSION}")
+    if len(data) != HEADER_SIZE + 5 * size:
+        raise ValueError(f"{path} is truncated")
+
+    edges = np.asarray(data[HEADER_SIZE:HEADER_SIZE + 4 * size]).reshape(size, 4)
+    ids = np.asarray(data[HEADER_SIZE + 4 * size:]).astype(int)
+    edges.flags.writeable = False
+    return edges, ids
+
@@ -0,0 +1,203 @@
+"""
+Vectorized ray casting for simulated single channel lidars.
+
+Obstacles are handled as a flat array of edges with shape `(M, 4)`, where each
+row is `[x1, y1, x2, y2]`. Beams are given as unit direction vectors, so a
+whole scan is intersected against all edges in one `(beams x edges)` NumPy
+computation instead of one Python call per (beam, edge) pair.
+"""
+
+import math
+
+import numpy as np
+
+__all__ = [
+    'edges_from_obstacles',
+    'beam_directions',
+    'BeamTable',
+    'footprint_edges',
+    'cast_rays',
+]
+
+
+def edges_from_obstacles(obstacles, return_ids=False):
+    """Converts a list of obstacles into an edge array.
+
+    Each obstacle is a polygon given by its vertices `[[x, y], ...]`. The
+    polygon is closed, i.e. an edge from the last to the first vertex is added
+    unless the polygon is already explicitly closed.
+
+    :param obstacles: List of obstacles (each one a list of vertices)
+    :type obstacles: list
+    :param return_ids: Also return the index of the obstacle of each edge
+    :type return_ids: bool
+    :return: Edges with rows `[x1, y1, x2, y2]`, and optionally obstacle ids
+    :rtype: numpy.ndarray with shape (M, 4), (numpy.ndarray with shape (M,))
+    """
+    edges, ids = [], []
+    for i, vertices in enumerate(obstacles):
+        vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+        if len(vertices) < 2:
+            continue
+        if not np.array_equal(vertices[0], vertices[-1]):
+            vertices = np.vstack((vertices, vertices[:1]))
+        edges.append(np.hstack((vertices[:-1], vertices[1:])))
+        ids.append(np.full(len(vertices) - 1, i))
+    if not edges:
+        edges, ids = np.empty((0, 4)), np.empty(0, dtype=int)
+    else:
+        edges, ids = np.ascontiguousarray(np.vstack(edges)), np.concatenate(ids)
+    return (edges, ids) if return_ids else edges
+
+
+def beam_directions(heading, angles):
+    """Unit direction vectors of the beams in the world frame.
+
+    :param heading: Heading of the lidar [rad]
+    :type heading: float
+    :param angles: Beam angles relative to the heading [rad]
+    :type angles: numpy.ndarray with shape (B,)
+    :return: Directions with rows `[cos, sin]`
+    :rtype: numpy.ndarray with shape (B, 2)
+    """
+    world_angles = heading + np.asarray(angles)
+    return np.column_stack((np.cos(world_angles), np.sin(world_angles)))
+
+
+class BeamTable:
+    """Precomputed directions of the beams of a lidar.
+
+    The cosine and sine of the beam angles are computed once. The directions
+    in the world frame are then obtained by rotating the table by the heading
+    of the lidar, written into a buffer that is reused for every scan.
+
+    Args:
+        angles: Beam angles relative to the heading [rad], shape (B,).
+    """
+
+    def __init__(self, angles):
+        self.angles = np.asarray(angles, dtype=float)
+        self.cos = np.cos(self.angles)
+        self.sin = np.sin(self.angles)
+        self._directions = np.empty((len(self.angles), 2))
+        self._tmp = np.empty(len(self.angles))
+
+    def __len__(self):
+        return len(self.angles)
+
+    def directions(self, heading, out=None):
+        """Unit direction vectors of the beams in the world frame.
+
+        :param heading: Heading of the lidar [rad]
+        :type heading: float
+        :param out: Array to write the directions to, defaults to an internal
+                    buffer that is overwritten by the next call
+        :type out: numpy.ndarray with shape (B, 2), optional
+        :return: Directions with rows `[cos, sin]`
+        :rtype: numpy.ndarray with shape (B, 2)
+        """
+        out = self._directions if out is None else out
+        c, s = math.cos(heading), math.sin(heading)
+        # cos(h + a) = cos(a)cos(h) - sin(a)sin(h), sin(h + a) = sin(a)cos(h) + cos(a)sin(h)
+        np.multiply(self.cos, c, out=out[:, 0])
+        np.multiply(self.sin, s, out=self._tmp)
+        np.subtract(out[:, 0], self._tmp, out=out[:, 0])
+        np.multiply(self.sin, c, out=out[:, 1])
+        np.multiply(self.cos, s, out=self._tmp)
+        np.add(out[:, 1], self._tmp, out=out[:, 1])
+        return out
+
+
+def footprint_edges(poses, front, rear, width):
+    """Edges of the rectangular footprints of vehicles.
+
+    :param poses: Poses of the vehicles [x, y, yaw], e.g. of the rear axles
+    :type poses: numpy.ndarray with shape (N, 3)
+    :param front: Distance from the pose to the front of the vehicle [m]
+    :type front: float
+    :param rear: Distance from the pose to the rear of the vehicle [m]
+    :type rear: float
+    :param width: Width of the vehicle [m]
+    :type width: float
+    :return: Edges with rows `[x1, y1, x2, y2]`, four per vehicle in order
+    :rtype: numpy.ndarray with shape (4N, 4)
+    """
+    poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+    corners = np.array([[front, width/2], [-rear, width/2],
+                        [-rear, -width/2], [front, -width/2]])
+    cos, sin = np.cos(poses[:, 2:3]), np.sin(poses[:, 2:3])
+    x = poses[:, 0:1] + cos * corners[:, 0] - sin * corners[:, 1]
+    y = poses[:, 1:2] + sin * corners[:, 0] + cos * corners[:, 1]
+    points = np.stack((x, y), axis=-1)
+    return np.concatenate((points, np.roll(points, -1, axis=1)), axis=-1).reshape(-1, 4)
+
+
+def cast_rays(origin, directions, edges, range_min, range_max,
+              max_pairs=2**20, out=None):
+    """Computes the range to the closest edge along every beam.
+
+    A beam starting at `origin` hits an edge if the intersection lies on the
+    edge and between `range_min` and `range_max` from the origin. The work is
+    split in chunks of edges so that at most `max_pairs` (beam, edge) pairs are
+    held in memory at once.
+
+    :param origin: Position of the lidar (x, y), or of each beam
+    :type origin: array_like with shape (2,) or (B, 2)
+    :param directions: Unit direction vectors of the beams
+    :type directions: numpy.ndarray with shape (B, 2)
+    :param edges: Edges with rows `[x1, y1, x2, y2]`
+    :type edges: numpy.ndarray with shape (M, 4)
+    :param range_min: Minimum detectable range [m]
+    :type range_min: float
+    :param range_max: Maximum detectable range [m]
+    :type range_max: float
+    :param max_pairs: Maximum number of (beam, edge) pairs per chunk
+    :type max_pairs: int
+    :param out: Array to write the ranges to, e.g. a reused scan buffer
+    :type out: numpy.ndarray with shape (B,), optional
+    :return: Range for each beam, `nan` where nothing is hit
+    :rtype: numpy.ndarray with shape (B,)
+    """
+    origin = np.asarray(origin, dtype=float)
+    if origin.ndim == 2:
+        origin = (origin[:, 0:1], origin[:, 1:2])
+    dx = directions[:, 0:1]
+    dy = directions[:, 1:2]
+    ranges = _init_ranges(len(directions), out)
+
+    chunk = max(1, max_pairs // max(1, len(directions)))
+    for start in range(0, len(edges), chunk):
+        s = _intersect(origin, dx, dy, edges[start:start+chunk], range_min, range_max)
+        np.minimum(ranges, s.min(axis=1), out=ranges)
+
+    ranges[np.isinf(ranges)] = np.nan
+    return ranges
+
+
+def _init_ranges(size, out=None):
+    """Ranges of a scan before any hit, written to `out` if given."""
+    ranges = np.empty(size) if out is None else out
+    ranges.fill(np.inf)
+    return ranges
+
+
+def _intersect(origin, dx, dy, edges, range_min, range_max):
+    """Distance along rays to edges, `inf` where the ray misses the edge.
+
+    Ray directions `dx, dy` broadcast against the edge columns, so this works
+    both for all (beam, edge) combinations, with `dx, dy` of shape (B, 1), and
+    for matched pairs, with `dx, dy` and `edges` of the same length.
+    """
+    ex = edges[:, 2] - edges[:, 0]
+    ey = edges[:, 3] - edges[:, 1]
+    wx = edges[:, 0] - origin[0]
+    wy = edges[:, 1] - origin[1]
+
+    # origin + s*d = a + u*e  =>  s = (w x e) / (d x e),  u = (w x d) / (d x e)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = dx * ey - dy * ex
+        s = (wx * ey - wy * ex) / denom
+        u = (wx * dy - wy * dx) / denom
+
+    hit = (denom != 0) & (u >= 0) & (u <= 1) & (s >= range_min) & (s <= range_max)
+    return np.where(hit, s, np.inf)
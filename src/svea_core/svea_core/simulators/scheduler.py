@@ -0,0 +1,109 @@
+"""
+Scan scheduling for simulated lidars.
+
+Poses arrive at the rate of the odometry, which is unrelated to the scan rate
+of the lidar. The scheduler keeps only the newest pose and hands it out once
+per scan period, so exactly one scan is computed per period no matter how fast
+the odometry is, and none at all when the vehicle has not reported a new pose.
+"""
+
+__all__ = [
+    'ScanScheduler',
+    'should_publish',
+]
+
+
+def should_publish(count, decimation, subscribers):
+    """Whether a decimated debug topic is published with the current scan.
+
+    :param count: Number of scans so far, including the current one
+    :type count: int
+    :param decimation: Publish every `decimation` scans, 0 to never publish
+    :type decimation: int
+    :param subscribers: Number of subscribers of the topic, nothing is built
+                        for a topic nobody listens to
+    :type subscribers: int
+    :rtype: bool
+    """
+    return decimation > 0 and count % decimation == 0 and subscribers > 0
+
+
+class ScanScheduler:
+    """Coalesces pose updates into one scan per scan period.
+
+    Counters, since the last `report`:
+
+    - `scans`: periods in which a scan was handed out,
+    - `coalesced`: poses replaced by a newer one before they were scanned,
+    - `skipped`: periods without a new pose, where no scan was computed,
+    - `dropped`: periods missed entirely, e.g. because a scan took too long.
+
+    Args:
+        period: Time between scans [s].
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.pose = None
+        self.stamp = None
+        self._fresh = False
+        self._last_tick = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.scans = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def update(self, pose, stamp=None):
+        """Sets the newest pose of the lidar.
+
+        :param pose: Pose of the lidar [x, y, yaw]
+        :type pose: array_like
+        :param stamp: Time the pose is valid at, e.g. from the odometry header
+        """
+        if self._fresh:
+            self.coalesced += 1
+        self.pose = pose
+        self.stamp = stamp
+        self._fresh = True
+
+    def refresh(self):
+        """Schedules the last pose again, e.g. because the obstacles moved."""
+        if self.pose is not None:
+            self._fresh = True
+
+    def tick(self, now=None):
+        """Called once per scan period, returns the pose to scan if any.
+
+        :param now: Current time [s], used to count missed periods
+        :type now: float, optional
+        :return: Pose and its stamp, or `None` if no new pose has arrived
+                 since the last scan
+        :rtype: tuple or None
+        """
+        if now is not None:
+            if self._last_tick is not None:
+                missed = round((now - self._last_tick) / self.period) - 1
+                self.dropped += max(missed, 0)
+            self._last_tick = now
+
+        if not self._fresh:
+            self.skipped += 1
+            return None
+
+        self._fresh = False
+        self.scans += 1
+        return self.pose, self.stamp
+
+    def report(self):
+        """Returns the counters as a summary and resets them.
+
+        :return: Summary of the scheduling since the last report
+        :rtype: str
+        """
+        summary = (f"{self.scans} scans, {self.coalesced} poses coalesced, "
+                   f"{self.skipped} periods skipped, {self.dropped} periods dropped")
+        self.reset_counters()
+        return summary
@@ -0,0 +1,132 @@
+"""
+Shared-memory obstacle store for simulated lidar worker processes.
+
+The edges are written once into a shared-memory segment together with a mask
+of the currently visible edges. Worker processes attach to the segment by name
+and read the edges in place, so a task only carries the pose of the lidar and
+the range of beams to compute. A new segment, with a new version, is only
+published when the obstacles change; the visibility mask is updated in place.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .raycast import beam_directions, cast_rays
+
+__all__ = [
+    'SharedEdges',
+    'cast_beams',
+]
+
+
+class SharedEdges:
+    """Owner of the shared-memory edge buffer.
+
+    The segment holds the edges as float64 `(M, 4)` followed by the visibility
+    mask as uint8 `(M,)`. Workers get a small, picklable `handle` to it.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.edges = None
+        self.mask = None
+        self._shm = None
+
+    @property
+    def handle(self):
+        """Picklable reference to the current segment `(name, version, size)`."""
+        if self._shm is None:
+            return None
+        return (self._shm.name, self.version, len(self.edges))
+
+    def publish(self, edges):
+        """Publishes a new set of edges, all visible, as a new version.
+
+        :param edges: Edges with rows `[x1, y1, x2, y2]`
+        :type edges: numpy.ndarray with shape (M, 4)
+        """
+        edges = np.asarray(edges, dtype=np.float64).reshape(-1, 4)
+        size = len(edges)
+
+        old = self._shm
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, size * 33))
+        self.edges, self.mask = _views(self._shm.buf, size)
+        self.edges[:] = edges
+        self.mask[:] = 1
+        self.edges.flags.writeable = False
+        self.version += 1
+
+        if old is not None:
+            _release(old, unlink=True)
+
+    def set_visible(self, visible):
+        """Updates the visibility mask in place.
+
+        Must not be called while workers are computing a scan.
+
+        :param visible: Mask of visible edges
+        :type visible: numpy.ndarray with shape (M,)
+        """
+        self.mask[:] = visible
+
+    def close(self):
+        """Releases and removes the shared-memory segment."""
+        if self._shm is not None:
+            self.edges = self.mask = None
+            _release(self._shm, unlink=True)
+            self._shm = None
+
+
+## Worker side ##
+
+_attached = {} # name -> (version, shm, edges, mask)
+
+
+def cast_beams(task):
+    """Worker task computing the ranges of a slice of a scan.
+
+    :param task: `(handle, pose, angle_min, increment, start, stop, range_min,
+                 range_max)` where beams `start:stop` are computed
+    :type task: tuple
+    :return: Range of each beam in the slice, `nan` where nothing is hit
+    :rtype: numpy.ndarray
+    """
+    handle, pose, angle_min, increment, start, stop, range_min, range_max = task
+    edges, mask = _attach(handle)
+    angles = angle_min + increment * np.arange(start, stop)
+    directions = beam_directions(pose[2], angles)
+    return cast_rays(pose[:2], directions, edges[mask.view(bool)], range_min, range_max)
+
+
+def _attach(handle):
+    name, version, size = handle
+    if name not in _attached:
+        # only one version is in use at a time, drop the stale ones
+        for stale in list(_attached):
+            _release(_attached.pop(stale)[1])
+
+        shm = shared_memory.SharedMemory(name=name)
+        edges, mask = _views(shm.buf, size)
+        edges.flags.writeable = False
+        mask.flags.writeable = False
+        _attached[name] = (version, shm, edges, mask)
+
+    _, _, edges, mask = _attached[name]
+    return edges, mask
+
+
+def _views(buf, size):
+    edges = np.ndarray((size, 4), dtype=np.float64, buffer=buf)
+    mask = np.ndarray((size,), dtype=np.uint8, buffer=buf, offset=size * 32)
+    return edges, mask
+
+
+def _release(shm, unlink=False):
+    try:
+        shm.close()
+    except BufferError:
+        # views are still alive, the segment is freed once they are collected
+        pass
+    if unlink:
+        shm.unlink()
@@ -0,0 +1,244 @@
+"""
+Spatial acceleration structures for simulated lidars.
+
+The obstacle edges are binned into a uniform grid once. A scan then traverses
+the grid along every beam (vectorized over all beams) and only tests the edges
+stored in the cells each beam actually crosses, so the cost of a scan depends
+on the local density of the map rather than on its total size.
+
+Moving obstacles are kept in a separate, dynamic layer of the grid. When one
+of them moves, only its own edges are binned again, the static layer is never
+rebuilt, and scans look up both layers from the same traversal.
+"""
+
+import numpy as np
+
+from .raycast import _intersect, _init_ranges
+
+__all__ = [
+    'EdgeGrid',
+]
+
+
+class EdgeGrid:
+    """Uniform grid over obstacle edges.
+
+    Edges are stored in compressed rows: the edges in cell `c` are
+    `cell_edges[cell_start[c]:cell_start[c+1]]`. An edge is stored in every
+    cell it passes through.
+
+    Dynamic edges, e.g. of moving obstacles, are added with `set_dynamic` and
+    stored in a second set of compressed rows. Dynamic edges outside of the
+    bounds of the grid are tested against every beam. `version` is increased
+    whenever the dynamic edges change.
+
+    Args:
+        edges: Edges with rows `[x1, y1, x2, y2]`, shape (M, 4).
+        cell_size: Side length of the grid cells [m].
+    """
+
+    def __init__(self, edges, cell_size=1.0):
+        self.edges = np.ascontiguousarray(edges, dtype=float).reshape(-1, 4)
+        self.cell_size = float(cell_size)
+
+        if len(self.edges):
+            points = self.edges.reshape(-1, 2)
+            lower, upper = points.min(axis=0), points.max(axis=0)
+        else:
+            lower = upper = np.zeros(2)
+
+        # pad by half a cell so that no edge lies on the border of the grid
+        self.origin = lower - self.cell_size / 2
+        self.shape = tuple((np.floor((upper - self.origin) / self.cell_size) + 1).astype(int))
+
+        starts = (self.edges[:, :2] - self.origin) / self.cell_size
+        deltas = (self.edges[:, 2:] - self.edges[:, :2]) / self.cell_size
+        edge_ids, cells = self._traverse(starts, deltas, 0.0, 1.0)
+
+        order = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=self.shape[0] * self.shape[1])
+        self.cell_start = np.concatenate(([0], np.cumsum(counts)))
+        self.cell_edges = edge_ids[order]
+
+        self.version = 0
+        self._dynamic = {} # key -> (edges, edge ids, cells, outside)
+        self._build_dynamic()
+
+    def __len__(self):
+        return len(self.edges)
+
+    @property
+    def dynamic_edges(self):
+        """All dynamic edges, shape (K, 4)."""
+        return self._dynamic_edges
+
+    def set_dynamic(self, key, edges):
+        """Adds a dynamic obstacle, or moves it if it already exists.
+
+        :param key: Identifier of the obstacle
+        :type key: hashable
+        :param edges: Edges of the obstacle with rows `[x1, y1, x2, y2]`
+        :type edges: numpy.ndarray with shape (k, 4)
+        """
+        self.update_dynamic({key: edges})
+
+    def update_dynamic(self, obstacles):
+        """Adds or moves several dynamic obstacles at once. Only the edges of
+        these obstacles are binned again.
+
+        :param obstacles: Edges of each obstacle by identifier
+        :type obstacles: dict
+        """
+        for key, edges in obstacles.items():
+            edges = np.array(edges, dtype=float).reshape(-1, 4)
+            points = (edges.reshape(-1, 2, 2) - self.origin) / self.cell_size
+            inside = np.all((points >= 0) & (points < self.shape), axis=(1, 2))
+            local_ids, cells = self._traverse(points[inside, 0],
+                                              points[inside, 1] - points[inside, 0], 0.0, 1.0)
+            self._dynamic[key] = (edges, np.flatnonzero(inside)[local_ids], cells, ~inside)
+        self._build_dynamic()
+
+    def remove_dynamic(self, key):
+        """Removes a dynamic obstacle, if it exists.
+
+        :param key: Identifier of the obstacle
+        :type key: hashable
+        """
+        if self._dynamic.pop(key, None) is not None:
+            self._build_dynamic()
+
+    def _build_dynamic(self):
+        """Assembles the dynamic layer from the already binned obstacles."""
+        obstacles = list(self._dynamic.values())
+        if obstacles:
+            offsets = np.cumsum([0] + [len(edges) for edges, _, _, _ in obstacles])
+            self._dynamic_edges = np.vstack([edges for edges, _, _, _ in obstacles])
+            edge_ids = np.concatenate([ids + offset for (_, ids, _, _), offset
+                                       in zip(obstacles, offsets)])
+            cells = np.concatenate([cells for _, _, cells, _ in obstacles])
+            outside = np.concatenate([outside for _, _, _, outside in obstacles])
+        else:
+            self._dynamic_edges = np.empty((0, 4))
+            edge_ids = cells = np.empty(0, dtype=int)
+            outside = np.empty(0, dtype=bool)
+
+        order = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=self.shape[0] * self.shape[1])
+        self._dynamic_start = np.concatenate(([0], np.cumsum(counts)))
+        self._dynamic_cell_edges = edge_ids[order]
+        self._dynamic_outside = np.flatnonzero(outside)
+        self.version += 1
+
+    def cast_rays(self, origin, directions, range_min, range_max, mask=None, out=None):
+        """Computes the range to the closest edge along every beam.
+
+        :param origin: Position of the lidar (x, y), or of each beam
+        :type origin: array_like with shape (2,) or (B, 2)
+        :param directions: Unit direction vectors of the beams
+        :type directions: numpy.ndarray with shape (B, 2)
+        :param range_min: Minimum detectable range [m]
+        :type range_min: float
+        :param range_max: Maximum detectable range [m]
+        :type range_max: float
+        :param mask: Static edges to consider, e.g. the visible ones, defaults
+                     to all. Dynamic edges are always considered.
+        :type mask: numpy.ndarray with shape (M,), optional
+        :param out: Array to write the ranges to, e.g. a reused scan buffer
+        :type out: numpy.ndarray with shape (B,), optional
+        :return: Range for each beam, `nan` where nothing is hit
+        :rtype: numpy.ndarray with shape (B,)
+        """
+        ranges = _init_ranges(len(directions), out)
+
+        origin = np.asarray(origin, dtype=float)[..., :2]
+        starts = np.broadcast_to((origin - self.origin) / self.cell_size, directions.shape)
+        ray_ids, cells = self._traverse(starts, directions / self.cell_size,
+                                        range_min, range_max)
+
+        beam_ids, edge_ids = self._candidates(ray_ids, cells, self.cell_start, self.cell_edges)
+        if mask is not None:
+            keep = mask[edge_ids]
+            beam_ids, edge_ids = beam_ids[keep], edge_ids[keep]
+        self._closest(ranges, origin, directions, beam_ids, self.edges[edge_ids],
+                      range_min, range_max)
+
+        if len(self._dynamic_edges):
+            beam_ids, edge_ids = self._candidates(ray_ids, cells, self._dynamic_start,
+                                                  self._dynamic_cell_edges)
+            self._closest(ranges, origin, directions, beam_ids,
+                          self._dynamic_edges[edge_ids], range_min, range_max)
+
+            # edges outside of the grid are tested against all beams
+            outside = self._dynamic_outside
+            beam_ids = np.repeat(np.arange(len(directions)), len(outside))
+            self._closest(ranges, origin, directions, beam_ids,
+                          self._dynamic_edges[np.tile(outside, len(directions))],
+                          range_min, range_max)
+
+        ranges[np.isinf(ranges)] = np.nan
+        return ranges
+
+    def _closest(self, ranges, origin, directions, beam_ids, edges, range_min, range_max):
+        """Lowers `ranges` to the closest hit of each beam, given (beam, edge)
+        pairs grouped by beam."""
+        if not len(beam_ids):
+            return
+        # beams from several lidars carry their own origin
+        pair_origin = origin[beam_ids].T if origin.ndim == 2 else origin
+        dist = _intersect(pair_origin, directions[beam_ids, 0], directions[beam_ids, 1],
+                          edges, range_min, range_max)
+        # pairs are grouped by beam, so the closest hit is a segmented min
+        first = np.flatnonzero(np.diff(beam_ids, prepend=-1))
+        hit_ids = beam_ids[first]
+        ranges[hit_ids] = np.minimum(ranges[hit_ids], np.minimum.reduceat(dist, first))
+
+    def _candidates(self, ray_ids, cells, cell_start, cell_edges):
+        """Expands (ray, cell) pairs into (ray, edge) pairs."""
+        counts = cell_start[cells + 1] - cell_start[cells]
+        ray_ids = np.repeat(ray_ids, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        edge_ids = cell_edges[np.repeat(cell_start[cells], counts) + offsets]
+        return ray_ids, edge_ids
+
+    def _traverse(self, starts, deltas, t_min, t_max):
+        """Finds the cells crossed by the segments `start + t*delta`,
+        `t_min <= t <= t_max`, given in grid units.
+
+        All crossings of vertical and horizontal grid lines are computed at
+        once, sorted along each segment and the cell of every piece between two
+        consecutive crossings is looked up from its midpoint. Cells are returned
+        grouped by segment and ordered along it.
+
+        :return: Segment index and linear cell index of each crossed cell
+        :rtype: tuple of numpy.ndarray
+        """
+        n = len(starts)
+        if n == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        t_min = np.broadcast_to(np.asarray(t_min, dtype=float), (n,))
+        t_max = np.broadcast_to(np.asarray(t_max, dtype=float), (n,))
+
+        span = np.abs(deltas) * t_max[:, None]
+        steps = int(np.ceil(span.max())) + 1 if span.size else 1
+        k = np.arange(steps)
+
+        crossings = [t_min[:, None], t_max[:, None]]
+        for axis in range(2):
+            p, d = starts[:, axis:axis+1], deltas[:, axis:axis+1]
+            lines = np.where(d > 0, np.floor(p) + 1 + k, np.floor(p) - k)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (lines - p) / d
+            t[~np.isfinite(t)] = np.inf
+            crossings.append(t)
+
+        t = np.sort(np.clip(np.hstack(crossings), t_min[:, None], t_max[:, None]), axis=1)
+        valid = t[:, 1:] > t[:, :-1]
+        mid = (t[:, 1:] + t[:, :-1]) / 2
+
+        ix = np.floor(starts[:, 0:1] + mid * deltas[:, 0:1]).astype(int)
+        iy = np.floor(starts[:, 1:2] + mid * deltas[:, 1:2]).astype(int)
+        valid &= (ix >= 0) & (ix < self.shape[0]) & (iy >= 0) & (iy < self.shape[1])
+
+        seg_ids = np.broadcast_to(np.arange(n)[:, None], valid.shape)[valid]
+        return seg_ids, ix[valid] * self.shape[1] + iy[valid]
@@ -0,0 +1,199 @@
+"""
+Visibility culling of obstacle edges for simulated lidars.
+
+Before a scan, edges that cannot be hit by any beam are removed from the
+candidate set. An edge is culled when it is
+
+1. out of range, i.e. its closest point is farther away than the max range,
+2. outside the field of view of the lidar,
+3. back-facing, i.e. it belongs to a polygon and faces away from the lidar,
+4. occluded, i.e. hidden behind closer edges in every direction it spans.
+
+All tests are conservative with respect to a margin in position and heading.
+The culled set therefore stays valid while the lidar moves less than the
+margin, and is only recomputed when the lidar leaves it.
+"""
+
+import numpy as np
+
+__all__ = [
+    'VisibilityCuller',
+]
+
+
+class VisibilityCuller:
+    """Keeps track of the obstacle edges visible to a lidar.
+
+    Args:
+        edges: Edges with rows `[x1, y1, x2, y2]`, shape (M, 4).
+        polygon_ids: Obstacle index of each edge, shape (M,). Edges of the
+            same obstacle must be consecutive. Back-face culling is skipped
+            if not given.
+        range_max: Max range of the lidar [m].
+        angle_min: Start angle of the scan relative to the heading [rad].
+        angle_max: End angle of the scan relative to the heading [rad].
+        margin: Distance the lidar can move before updating [m].
+        yaw_margin: Angle the lidar can turn before updating [rad].
+        occlusion_bins: Number of bearing bins used for occlusion culling, or
+            zero to disable occlusion culling.
+    """
+
+    def __init__(self, edges, polygon_ids=None, range_max=15.0,
+                 angle_min=-np.pi, angle_max=np.pi, margin=0.25,
+                 yaw_margin=np.radians(5), occlusion_bins=720):
+
+        self.edges = np.ascontiguousarray(edges, dtype=float).reshape(-1, 4)
+        self.range_max = range_max
+        self.angle_min = angle_min
+        self.angle_max = angle_max
+        self.margin = margin
+        self.yaw_margin = yaw_margin
+        self.occlusion_bins = occlusion_bins
+
+        self._a = self.edges[:, :2]
+        self._e = self.edges[:, 2:] - self.edges[:, :2]
+        self._len2 = np.maximum(np.einsum('ij,ij->i', self._e, self._e), 1e-12)
+
+        self._polygons = None
+        if polygon_ids is not None and len(self.edges):
+            polygon_ids = np.asarray(polygon_ids)
+            starts = np.flatnonzero(np.diff(polygon_ids, prepend=polygon_ids[0] - 1))
+            sizes = np.diff(np.append(starts, len(polygon_ids)))
+            # orientation of each polygon from its signed (shoelace) area
+            cross = self.edges[:, 0] * self.edges[:, 3] - self.edges[:, 2] * self.edges[:, 1]
+            orientation = np.sign(np.add.reduceat(cross, starts))
+            self._polygons = (starts, sizes, np.repeat(orientation, sizes))
+
+        self.pose = None
+        self.visible = np.ones(len(self.edges), dtype=bool)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.visible))
+
+    def update(self, pose):
+        """Updates the visible edges if the lidar has left the margin.
+
+        :param pose: Pose of the lidar [x, y, yaw]
+        :type pose: array_like
+        :return: `True` if the visible edges were recomputed
+        :rtype: bool
+        """
+        pose = np.asarray(pose, dtype=float)
+        if self.pose is not None:
+            moved = np.hypot(*(pose[:2] - self.pose[:2]))
+            turned = abs((pose[2] - self.pose[2] + np.pi) % (2*np.pi) - np.pi)
+            if moved <= self.margin and turned <= self.yaw_margin:
+                return False
+
+        self.pose = pose
+        self.visible = self.compute(pose)
+        return True
+
+    def compute(self, pose):
+        """Computes which edges are possibly visible from anywhere within the
+        margin around a pose.
+
+        :param pose: Pose of the lidar [x, y, yaw]
+        :type pose: array_like
+        :return: Mask of possibly visible edges
+        :rtype: numpy.ndarray with shape (M,)
+        """
+        if not len(self.edges):
+            return np.zeros(0, dtype=bool)
+
+        r = self.margin
+        w = np.asarray(pose[:2], dtype=float) - self._a
+
+        # closest point on each edge
+        t = np.clip(np.einsum('ij,ij->i', w, self._e) / self._len2, 0, 1)
+        d_min = np.hypot(*(self._a + t[:, None] * self._e - pose[:2]).T)
+        d_max = np.maximum(np.hypot(*w.T), np.hypot(*(w - self._e).T))
+
+        near = d_min <= r
+        # the bearing to an edge shifts at most asin(r/d) when moving r
+        spread = np.arcsin(np.clip(r / np.maximum(d_min, r), 0, 1))
+
+        in_range = d_min <= self.range_max + r
+        visible = in_range.copy()
+        visible &= near | self._in_field_of_view(pose, spread)
+        if self._polygons is not None:
+            visible &= near | self._front_facing(pose, w, d_min)
+        if self.occlusion_bins:
+            visible &= near | ~self._occluded(pose, visible, in_range, spread, d_min, d_max)
+        return visible
+
+    def _bearings(self, pose):
+        """Bearing interval `[lo, hi]` spanned by each edge, `hi - lo <= pi`."""
+        a1 = np.arctan2(self.edges[:, 1] - pose[1], self.edges[:, 0] - pose[0])
+        a2 = np.arctan2(self.edges[:, 3] - pose[1], self.edges[:, 2] - pose[0])
+        delta = (a2 - a1 + np.pi) % (2*np.pi) - np.pi
+        lo = np.where(delta >= 0, a1, a1 + delta)
+        return lo, lo + np.abs(delta)
+
+    def _in_field_of_view(self, pose, spread):
+        lo, hi = self._bearings(pose)
+        widen = spread + self.yaw_margin
+        width = hi - lo + 2*widen
+        lo = (lo - pose[2] - widen + np.pi) % (2*np.pi) - np.pi
+        hi = lo + width
+        fov = np.zeros(len(lo), dtype=bool)
+        for k in (-1, 0, 1):
+            fov |= (lo <= self.angle_max + 2*np.pi*k) & (hi >= self.angle_min + 2*np.pi*k)
+        return fov | (hi - lo >= 2*np.pi)
+
+    def _front_facing(self, pose, w, d_min):
+        starts, sizes, orientation = self._polygons
+
+        # signed distance to the line of each edge, positive to the left
+        side = (self._e[:, 0] * w[:, 1] - self._e[:, 1] * w[:, 0]) / np.sqrt(self._len2)
+
+        # crossing number test to find the polygons containing the lidar
+        x, y = pose[0], pose[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = self.edges[:, 0] + w[:, 1] * self._e[:, 0] / self._e[:, 1]
+        crosses = ((self.edges[:, 1] > y) != (self.edges[:, 3] > y)) & (x < x_cross)
+        inside = np.add.reduceat(crosses.astype(int), starts) % 2 == 1
+
+        # the faces visible from outside lie on the outer side (right of a
+        # counter-clockwise polygon), from inside on the inner side
+        facing = np.where(np.repeat(inside, sizes), 1, -1) * orientation * side
+
+        # skip polygons that are degenerate or close to the lidar
+        close = np.repeat(np.minimum.reduceat(d_min, starts) <= self.margin, sizes)
+        return (orientation == 0) | close | (facing > -self.margin)
+
+    def _occluded(self, pose, candidates, occluders, spread, d_min, d_max):
+        n = self.occlusion_bins
+        size = 2*np.pi / n
+        lo, hi = self._bearings(pose)
+
+        # occluders: conservative depth over the bins they fully cover
+        occ = np.flatnonzero(occluders & (lo >= -np.pi) & (hi < np.pi))
+        b_lo = np.ceil((lo[occ] + spread[occ] + np.pi) / size).astype(int)
+        b_hi = np.floor((hi[occ] - spread[occ] + np.pi) / size).astype(int)
+        keep = b_hi > b_lo
+        depth = np.full(n, np.inf)
+        bins, owner = _expand(b_lo[keep], b_hi[keep])
+        np.minimum.at(depth, bins, d_max[occ[keep]][owner] + self.margin)
+
+        # candidates: hidden if farther than the occluders in all their bins
+        # candidates wrapping around the back are never considered hidden
+        cand = np.flatnonzero(candidates & (lo - spread >= -np.pi) & (hi + spread < np.pi))
+        b_lo = np.floor((lo[cand] - spread[cand] + np.pi) / size).astype(int)
+        b_hi = np.minimum(np.floor((hi[cand] + spread[cand] + np.pi) / size).astype(int) + 1, n)
+        bins, owner = _expand(b_lo, b_hi)
+        hidden = np.zeros(len(self.edges), dtype=bool)
+        if len(bins):
+            first = np.flatnonzero(np.diff(owner, prepend=-1))
+            farthest = np.full(len(cand), np.inf)
+            farthest[owner[first]] = np.maximum.reduceat(depth[bins], first)
+            hidden[cand] = farthest < d_min[cand] - self.margin
+        return hidden
+
+
+def _expand(lo, hi):
+    """Expands the ranges `[lo, hi)` into their elements and owner index."""
+    counts = np.maximum(hi - lo, 0)
+    owner = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(lo, counts) + offsets, owner
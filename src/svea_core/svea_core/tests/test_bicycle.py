@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""
+Test module for the bicycle models in svea_core.models
+"""
+
+import math
+import unittest
+
+import numpy as np
+
+from svea_core.models.bicycle import (Bicycle4D, Bicycle4DWithESC,
+                                      Bicycle4DEnsemble, Bicycle4DWithESCEnsemble,
+                                      rollout)
+
+
+class Bicycle4DEnsembleTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.states = np.column_stack([rng.uniform(-5, 5, 8), rng.uniform(-5, 5, 8),
+                                       rng.uniform(-math.pi, math.pi, 8), rng.uniform(0, 2, 8)])
+        self.delta = rng.uniform(-1, 1, (20, 8))
+        self.accel = rng.uniform(-3, 3, (20, 8))
+
+    def test_matches_single_model(self):
+        """Every model of the ensemble follows the single model"""
+        ensemble = Bicycle4DEnsemble(self.states, dt=0.05)
+        models = [Bicycle4D(tuple(state), dt=0.05) for state in self.states]
+        for delta, accel in zip(self.delta, self.accel):
+            ensemble.update(delta, accel)
+            for model, d, a in zip(models, delta, accel):
+                model.update(d, a)
+        np.testing.assert_allclose(ensemble.states, [model.state for model in models])
+
+    def test_esc_matches_single_model(self):
+        ensemble = Bicycle4DWithESCEnsemble(self.states)
+        models = [Bicycle4DWithESC(tuple(state)) for state in self.states]
+        for steering, velocity in zip(self.delta, self.accel):
+            ensemble.update(steering, velocity, dt=0.025)
+            for model, s, v in zip(models, steering, velocity):
+                model.update(s, v, dt=0.025)
+        np.testing.assert_allclose(ensemble.states, [model.state for model in models])
+
+    def test_scalar_inputs(self):
+        """Scalar inputs are shared by all models, states update in place"""
+        ensemble = Bicycle4DEnsemble(3)
+        states = ensemble.states
+        self.assertEqual(states.shape, (3, 4))
+        ensemble.update(0.0, 1.0, dt=1.0)
+        self.assertIs(ensemble.states, states)
+        np.testing.assert_allclose(ensemble.vel, [1.0, 1.0, 1.0])
+        ensemble.update(0.0, 10.0, dt=1.0)
+        np.testing.assert_allclose(ensemble.x, [1.0, 1.0, 1.0])
+        np.testing.assert_allclose(ensemble.vel, [1.0 + Bicycle4D.ACCEL_MAX] * 3)
+
+
+class IntegratorTest(unittest.TestCase):
+
+    def simulate(self, model_type, integrator, dt, duration=2.0):
+        model = model_type((0.0, 0.0, 0.5, 1.0), dt=dt, integrator=integrator)
+        for _ in range(round(duration / dt)):
+            model.update(0.4, 3.0)
+        return np.array(model.state)
+
+    def test_exact(self):
+        """The exact integrator matches a fine reference for any step"""
+        for model_type in (Bicycle4D, Bicycle4DWithESC):
+            reference = self.simulate(model_type, 'rk4', 1e-4)
+            for dt in (0.01, 0.1, 0.5):
+                np.testing.assert_allclose(self.simulate(model_type, 'exact', dt),
+                                           reference, atol=1e-6)
+
+    def test_accuracy(self):
+        """Higher order integrators are more accurate at the same step"""
+        reference = self.simulate(Bicycle4DWithESC, 'exact', 0.1)
+        errors = {integrator: np.abs(self.simulate(Bicycle4DWithESC, integrator, 0.1)
+                                     - reference)[:2].max()
+                  for integrator in Bicycle4D.INTEGRATORS}
+        self.assertLess(errors['rk4'], errors['euler'] / 10)
+        self.assertLess(errors['adaptive'], errors['euler'] / 10)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            Bicycle4D(integrator='midpoint')
+
+
+class LinearizationTest(unittest.TestCase):
+
+    def finite_difference(self, model, state, control, eps=1e-6):
+        def step(state, control):
+            model.state = tuple(state)
+            return np.array(model.update(*control))
+        state, control = np.array(state), np.array(control)
+        A = np.column_stack([(step(state + eps*e, control) - step(state - eps*e, control)) / (2*eps)
+                             for e in np.eye(4)])
+        B = np.column_stack([(step(state, control + eps*e) - step(state, control - eps*e)) / (2*eps)
+                             for e in np.eye(2)])
+        return A, B
+
+    def test_jacobians(self):
+        """Analytic Jacobians match finite differences, also where the inputs
+        saturate"""
+        for model_type, controls in ((Bicycle4D, [(0.3, 1.0), (1.0, 5.0)]),
+                                     (Bicycle4DWithESC, [(-0.2, 1.2), (0.2, 3.0)])):
+            model = model_type(dt=0.05)
+            for control in controls:
+                state = (1.0, 2.0, 0.7, 1.1)
+                A, B = model.linearize(state, control)
+                A_fd, B_fd = self.finite_difference(model, state, control)
+                np.testing.assert_allclose(A, A_fd, atol=1e-7)
+                np.testing.assert_allclose(B, B_fd, atol=1e-7)
+
+    def test_trajectory(self):
+        model = Bicycle4DWithESC(dt=0.05)
+        controls = np.column_stack([np.linspace(-0.5, 0.5, 10), np.linspace(0, 2, 10)])
+        states = rollout((0.0, 0.0, 0.2, 0.5), controls, dt=0.05,
+                         model=Bicycle4DWithESCEnsemble)[:-1]
+        A, B = model.linearize_trajectory(states, controls)
+        self.assertEqual((A.shape, B.shape), ((10, 4, 4), (10, 4, 2)))
+        for i in range(10):
+            A_i, B_i = model.linearize(states[i], controls[i])
+            np.testing.assert_allclose(A[i], A_i)
+            np.testing.assert_allclose(B[i], B_i)
+
+    def test_cache(self):
+        model = Bicycle4D()
+        A, B = model.linearize((0.0, 0.0, 0.1, 1.0), (0.2, 0.0))
+        self.assertIs(model.linearize((0.0, 0.0, 0.1, 1.0), (0.2, 0.0))[0], A)
+        self.assertFalse(A.flags.writeable)
+        self.assertIsNot(model.linearize((0.0, 0.0, 0.1, 1.0), (0.2, 0.0), dt=0.2)[0], A)
+
+
+class RolloutTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.controls = np.column_stack([rng.uniform(-0.5, 0.5, 30), rng.uniform(-1, 1, 30)])
+        self.initial_state = (1.0, -2.0, 0.3, 0.5)
+
+    def test_matches_update(self):
+        model = Bicycle4DWithESC(self.initial_state, dt=0.05)
+        expected = [model.state] + [model.update(*u) for u in self.controls]
+        trajectory = rollout(self.initial_state, self.controls, dt=0.05,
+                             model=Bicycle4DWithESCEnsemble)
+        self.assertEqual(trajectory.shape, (31, 4))
+        np.testing.assert_allclose(trajectory, expected)
+
+    def test_batch(self):
+        """Every sequence of a batch matches its own rollout"""
+        batch = np.stack([self.controls, -self.controls, 0.5 * self.controls])
+        out = np.empty((3, 31, 4))
+        trajectories = rollout(self.initial_state, batch, out=out)
+        self.assertIs(trajectories, out)
+        for controls, trajectory in zip(batch, trajectories):
+            np.testing.assert_allclose(trajectory, rollout(self.initial_state, controls))
+
+    def test_preallocated(self):
+        out = np.empty((31, 4))
+        trajectory = rollout(self.initial_state, self.controls, out=out)
+        self.assertTrue(np.shares_memory(trajectory, out))
+        np.testing.assert_allclose(out[0], self.initial_state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""
+Test module for the MPC controllers in svea_core.controllers.mpc
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from svea_core.controllers.mpc import MPC, AsyncMPC
+
+# Same as params/mpc_default.yaml, with a shorter horizon
+PARAMETERS = {
+    'time_step': 0.4,
+    'prediction_horizon': 6,
+    'warm_start': True,
+    'real_time_iteration': False,
+    'qp_solver': 'qrqp',
+    'codegen': False,
+    'codegen_dir': '~/.cache/svea_core/mpc',
+    'state_weight_matrix': [1.0, 0.0, 0.0, 0.0,
+                            0.0, 1.0, 0.0, 0.0,
+                            0.0, 0.0, 1.0, 0.0,
+                            0.0, 0.0, 0.0, 0.0],
+    'control_rate_weight_matrix': [0.0, 0.0, 0.0, 0.0],
+    'control_weight_matrix': [0.1, 0.0, 0.0, 0.1],
+    'final_state_weight_matrix': [1.0, 0.0, 0.0, 0.0,
+                                  0.0, 1.0, 0.0, 0.0,
+                                  0.0, 0.0, 1.0, 0.0,
+                                  0.0, 0.0, 0.0, 0.0],
+    'forward_speed_weight': 0,
+    'steering_min': -40.0,
+    'steering_max': 40.0,
+    'steering_rate_min': -35.0,
+    'steering_rate_max': 35.0,
+    'velocity_min': -0.4,
+    'velocity_max': 0.4,
+    'acceleration_min': -0.2,
+    'acceleration_max': 0.4,
+    'wheelbase': 0.32,
+}
+
+
+class FakeParameter:
+
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeNode:
+    """The part of a ROS node that the MPC uses, without ROS."""
+
+    def __init__(self, **parameters):
+        self.parameters = dict(PARAMETERS, **parameters)
+        self.warnings = []
+
+    def declare_parameter(self, name, value):
+        self.parameters.setdefault(name, value)
+
+    def has_parameter(self, name):
+        return name in self.parameters
+
+    def get_parameter(self, name):
+        return FakeParameter(self.parameters[name])
+
+    def get_logger(self):
+        return self
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+def reference(offset=0.0, steps=7):
+    """Straight reference trajectory [x, y, theta, v] with one column per step."""
+    k = np.arange(steps)
+    return np.vstack((0.15*k + 0.3 + offset, 0.05*k, np.full(steps, 0.3), np.full(steps, 0.3)))
+
+
+def closed_loop(mpc, steps=5):
+    """Controls of the first step of each solve, following the predicted states."""
+    state = np.zeros(5)
+    controls = []
+    for i in range(steps):
+        controls.append(mpc.compute_control(state.copy(), reference(0.1*i)))
+        state = mpc.get_optimal_states()[:, 1].copy()
+    return np.array(controls)
+
+
+class MPCTest(unittest.TestCase):
+
+    def test_warm_start(self):
+        """Warm and cold started solves reach the same solution"""
+        warm = closed_loop(MPC(FakeNode(warm_start=True)))
+        cold = closed_loop(MPC(FakeNode(warm_start=False)))
+        np.testing.assert_allclose(warm, cold, atol=1e-6)
+
+    @unittest.skipUnless(shutil.which(os.environ.get('CC', 'gcc')), "no C compiler")
+    def test_codegen(self):
+        """The solver is compiled in the background, reaches the same solution and is cached"""
+        with tempfile.TemporaryDirectory() as cache:
+            compiled, opti = MPC(FakeNode(codegen=True, codegen_dir=cache)), MPC(FakeNode())
+            self.assertIsNone(compiled.solver)
+            np.testing.assert_allclose(compiled.compute_control(np.zeros(5), reference()),
+                                       opti.compute_control(np.zeros(5), reference()))
+            # switching solvers keeps the parameters and the warm start
+            self.assertTrue(compiled.poll_compiled_solver(timeout=None))
+            self.assertIsNone(compiled.opti)
+            np.testing.assert_allclose(closed_loop(compiled), closed_loop(opti), atol=1e-6)
+
+            libraries = os.listdir(cache)
+            self.assertEqual(len(libraries), 1)
+            mtime = os.path.getmtime(os.path.join(cache, libraries[0]))
+            cached = MPC(FakeNode(codegen=True, codegen_dir=cache))
+            self.assertIsNotNone(cached.solver)
+            self.assertIsNone(cached.opti)
+            np.testing.assert_allclose(closed_loop(cached), closed_loop(MPC(FakeNode())), atol=1e-6)
+            self.assertEqual(os.listdir(cache), libraries)
+            self.assertEqual(os.path.getmtime(os.path.join(cache, libraries[0])), mtime)
+
+    def test_codegen_without_compiler(self):
+        """Without a compiler the problem is solved without generated code"""
+        node = FakeNode(codegen=True)
+        with tempfile.TemporaryDirectory() as cache, mock.patch.dict(os.environ, CC=os.path.join(cache, 'cc')):
+            node.parameters['codegen_dir'] = cache
+            mpc = MPC(node)
+            self.assertFalse(mpc.poll_compiled_solver(timeout=None))
+            self.assertEqual(len(node.warnings), 1)
+            self.assertEqual(os.listdir(cache), [])
+            mpc.compute_control(np.zeros(5), reference())
+
+    def test_weight_matrix(self):
+        """Changing a weight changes the solution, not the problem"""
+        mpc = MPC(FakeNode(warm_start=False))
+        opti, objective = mpc.opti, mpc.nlp['f']
+        initial = mpc.compute_control(np.zeros(5), reference())
+
+        mpc.set_new_weight_matrix('Qf', [70.0, 0.0, 0.0, 0.0,
+                                         0.0, 70.0, 0.0, 0.0,
+                                         0.0, 0.0, 20.0, 0.0,
+                                         0.0, 0.0, 0.0, 0.0])
+        changed = mpc.compute_control(np.zeros(5), reference())
+        self.assertGreater(np.abs(np.subtract(changed, initial)).max(), 1e-3)
+
+        mpc.reset_parameters()
+        np.testing.assert_allclose(mpc.compute_control(np.zeros(5), reference()), initial, atol=1e-6)
+        self.assertIs(mpc.opti, opti)
+        self.assertIs(mpc.nlp['f'], objective)
+
+    def test_prediction_horizon(self):
+        """Changing the horizon changes the solution, not the problem"""
+        mpc = MPC(FakeNode(warm_start=False))
+        opti, constraints = mpc.opti, mpc.opti.ng
+        initial = mpc.compute_control(np.zeros(5), reference())
+
+        mpc.set_new_prediction_horizon(2)
+        changed = mpc.compute_control(np.zeros(5), reference())
+        self.assertGreater(np.abs(np.subtract(changed, initial)).max(), 1e-3)
+
+        mpc.set_new_prediction_horizon(mpc.N)
+        np.testing.assert_allclose(mpc.compute_control(np.zeros(5), reference()), initial, atol=1e-6)
+        self.assertIs(mpc.opti, opti)
+        self.assertEqual(mpc.opti.ng, constraints)
+
+        for horizon in (0, mpc.N + 1):
+            with self.assertRaises(ValueError):
+                mpc.set_new_prediction_horizon(horizon)
+
+    def test_reduced_horizon_first(self):
+        """The horizon can be reduced before the first solve"""
+        mpc = MPC(FakeNode(warm_start=False))
+        mpc.set_new_prediction_horizon(2)
+        mpc.compute_control(np.zeros(5), reference())
+        self.assertEqual(mpc.current_horizon, 2)
+
+    def test_real_time_iteration(self):
+        """Single QP steps converge toward the full solution in closed loop"""
+        rti = MPC(FakeNode(real_time_iteration=True))
+        ipopt = MPC(FakeNode(warm_start=False))
+        state = np.zeros(5)
+        errors = []
+        for i in range(8):
+            rti.compute_control(state.copy(), reference(0.1*i))
+            ipopt.compute_control(state.copy(), reference(0.1*i))
+            self.assertEqual(rti.sol.stats()['iter_count'], 1)
+            errors.append(np.abs(rti.get_optimal_control() - ipopt.get_optimal_control()).max())
+            state = rti.get_optimal_states()[:, 1].copy()
+        self.assertGreater(errors[0], 0.1)
+        self.assertLess(max(errors[3:]), 0.05)
+
+
+class AsyncMPCTest(unittest.TestCase):
+
+    TIMEOUT = 10.0 # s
+
+    def setUp(self):
+        self.node = FakeNode()
+        self.mpc = AsyncMPC(MPC(self.node))
+
+    def tearDown(self):
+        if self.mpc._worker.is_alive():
+            self.mpc.shutdown()
+
+    def wait_for_solution(self, stamp):
+        deadline = time.monotonic() + self.TIMEOUT
+        while self.mpc.age(stamp) != 0.0:
+            self.assertLess(time.monotonic(), deadline, "no solution in time")
+            time.sleep(0.001)
+
+    def test_request(self):
+        """The newest solution is interpolated to the current time"""
+        self.assertIsNone(self.mpc.get_control(0.0))
+        self.mpc.request(np.zeros(5), reference(), 1.0)
+        self.wait_for_solution(1.0)
+
+        controls = self.mpc.controller.get_optimal_control()
+        steering_rate, acceleration = self.mpc.get_control(1.0)
+        self.assertAlmostEqual(steering_rate, controls[1, 0])
+        self.assertAlmostEqual(acceleration, controls[0, 0])
+
+        steering_rate, acceleration = self.mpc.get_control(1.0 + self.mpc.dt/2)
+        self.assertAlmostEqual(steering_rate, controls[1, :2].mean())
+        self.assertAlmostEqual(acceleration, controls[0, :2].mean())
+
+        np.testing.assert_allclose(self.mpc.get_state(1.0 + self.mpc.dt),
+                                   self.mpc.get_optimal_states()[:, 1])
+
+    def test_max_age(self):
+        """Solutions are not used beyond their horizon or max_age"""
+        self.mpc.request(np.zeros(5), reference(), 1.0)
+        self.wait_for_solution(1.0)
+        horizon = self.mpc.dt * self.mpc.controller.N
+        self.assertIsNotNone(self.mpc.get_control(1.0 + horizon))
+        self.assertIsNone(self.mpc.get_control(1.0 + horizon + 0.01))
+        self.assertAlmostEqual(self.mpc.age(3.0), 2.0)
+
+        self.mpc.max_age = 0.5
+        self.assertIsNotNone(self.mpc.get_control(1.5))
+        self.assertIsNone(self.mpc.get_control(1.51))
+
+    def test_active_horizon(self):
+        """Only the active part of the horizon is used"""
+        self.mpc.set_new_prediction_horizon(2)
+        self.mpc.request(np.zeros(5), reference(), 1.0)
+        self.wait_for_solution(1.0)
+        self.assertEqual(self.mpc.get_optimal_states().shape, (5, 3))
+        self.assertIsNotNone(self.mpc.get_control(1.0 + 2*self.mpc.dt))
+        self.assertIsNone(self.mpc.get_control(1.0 + 2*self.mpc.dt + 0.01))
+        np.testing.assert_allclose(self.mpc.get_state(1.0 + 5*self.mpc.dt),
+                                   self.mpc.get_optimal_states()[:, 2])
+
+    def test_clear(self):
+        """A solve started before clear is discarded"""
+        started, proceed = threading.Event(), threading.Event()
+        compute_control = self.mpc.controller.compute_control
+
+        def blocked(*args):
+            started.set()
+            proceed.wait()
+            return compute_control(*args)
+
+        self.mpc.controller.compute_control = blocked
+        self.mpc.request(np.zeros(5), reference(), 1.0)
+        self.assertTrue(started.wait(self.TIMEOUT))
+        self.mpc.clear()
+        proceed.set()
+        self.mpc.shutdown() # after the current solve
+
+        self.assertIsNone(self.mpc.get_optimal_states())
+        self.assertEqual(self.mpc.age(1.0), float('inf'))
+
+    def test_failed_change(self):
+        """The worker outlives a failing change and keeps solving"""
+        self.mpc.set_new_prediction_horizon(999)
+        self.mpc.request(np.zeros(5), reference(), 1.0)
+        self.wait_for_solution(1.0)
+        self.assertTrue(self.mpc._worker.is_alive())
+        self.assertEqual(self.mpc.failures, 1)
+        self.assertEqual(len(self.node.warnings), 1)
+
+    def test_shutdown(self):
+        """A stopped worker does not accept requests"""
+        self.mpc.request(np.zeros(5), reference(), 1.0)
+        self.wait_for_solution(1.0)
+        self.mpc.shutdown()
+        self.assertEqual(self.mpc.age(1.0), float('inf'))
+        with self.assertRaises(RuntimeError):
+            self.mpc.request(np.zeros(5), reference(), 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+"""
+Test module for the lidar simulation in svea_core.simulators
+"""
+
+import math
+from multiprocessing import Pool, shared_memory
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from svea_core.simulators.raycast import (edges_from_obstacles, beam_directions,
+                                          footprint_edges, cast_rays, BeamTable)
+from svea_core.simulators.spatial import EdgeGrid
+from svea_core.simulators.visibility import VisibilityCuller
+from svea_core.simulators.shared import SharedEdges, cast_beams
+from svea_core.simulators.gridmap import OccupancyRayMarcher
+from svea_core.simulators.fleet import LidarFleet
+from svea_core.simulators.scheduler import ScanScheduler, should_publish
+from svea_core.simulators.cache import ScanCache
+from svea_core.simulators.obstacle_file import save_obstacles, load_obstacles
+from svea_core.simulators.moving import MovingObstacle
+from svea_core.simulators.noise import NoiseStream
+
+
+def reference_range(origin, angle, edges, range_min, range_max):
+    """Scalar ray-segment intersection used as ground truth"""
+    dx, dy = math.cos(angle), math.sin(angle)
+    closest = math.inf
+    for x1, y1, x2, y2 in edges:
+        ex, ey = x2 - x1, y2 - y1
+        wx, wy = x1 - origin[0], y1 - origin[1]
+        denom = dx * ey - dy * ex
+        if denom == 0:
+            continue
+        s = (wx * ey - wy * ex) / denom
+        u = (wx * dy - wy * dx) / denom
+        if 0 <= u <= 1 and range_min <= s <= range_max:
+            closest = min(closest, s)
+    return closest if closest < math.inf else math.nan
+
+
+class RaycastTest(unittest.TestCase):
+
+    square = [[[1.0, -1.0], [3.0, -1.0], [3.0, 1.0], [1.0, 1.0]]]
+
+    def test_edges_closed(self):
+        """Test that polygons are closed"""
+        edges = edges_from_obstacles(self.square)
+        self.assertEqual(edges.shape, (4, 4))
+        np.testing.assert_array_equal(edges[-1], [1.0, 1.0, 1.0, -1.0])
+
+    def test_straight_ahead(self):
+        """Test range to a wall in front of the lidar"""
+        edges = edges_from_obstacles(self.square)
+        directions = beam_directions(0.0, np.array([0.0, math.pi]))
+        ranges = cast_rays((0.0, 0.0), directions, edges, 0.02, 15.0)
+        self.assertAlmostEqual(ranges[0], 1.0)
+        self.assertTrue(np.isnan(ranges[1]))
+
+    def test_beam_table(self):
+        """Test that rotated tables match the beam directions"""
+        angles = np.arange(-2.35, 2.35, 0.01)
+        table = BeamTable(angles)
+        out = np.empty((len(angles), 2))
+        for heading in (0.0, 1.3, -2.9):
+            self.assertIs(table.directions(heading, out=out), out)
+            np.testing.assert_allclose(out, beam_directions(heading, angles), atol=1e-12)
+
+    def test_out(self):
+        """Test writing ranges into a float32 scan buffer"""
+        edges = edges_from_obstacles(self.square)
+        directions = beam_directions(0.0, np.array([0.0, math.pi]))
+        out = np.zeros(2, dtype=np.float32)
+        self.assertIs(cast_rays((0.0, 0.0), directions, edges, 0.02, 15.0, out=out), out)
+        self.assertAlmostEqual(out[0], 1.0)
+        self.assertTrue(np.isnan(out[1]))
+
+    def test_against_reference(self):
+        """Test random scenes against the scalar implementation"""
+        rng = np.random.default_rng(42)
+        edges = rng.uniform(-10, 10, size=(60, 4))
+        angles = np.linspace(-math.pi, math.pi, 181)
+        origin = (0.5, -0.3)
+        heading = 0.7
+        ranges = cast_rays(origin, beam_directions(heading, angles), edges,
+                           0.02, 8.0, max_pairs=1000)
+        for angle, r in zip(angles, ranges):
+            expected = reference_range(origin, heading + angle, edges, 0.02, 8.0)
+            if math.isnan(expected):
+                self.assertTrue(math.isnan(r))
+            else:
+                self.assertAlmostEqual(r, expected)
+
+
+class EdgeGridTest(unittest.TestCase):
+
+    def random_edges(self, n, seed=7):
+        rng = np.random.default_rng(seed)
+        centers = rng.uniform(-20, 20, size=(n, 2))
+        angles = rng.uniform(0, 2*math.pi, size=n)
+        lengths = rng.uniform(0.1, 4.0, size=n)
+        ends = centers + lengths[:, None] * np.column_stack((np.cos(angles), np.sin(angles)))
+        return np.hstack((centers, ends))
+
+    def test_matches_brute_force(self):
+        """Test that the grid gives the same ranges as testing all edges"""
+        edges = self.random_edges(500)
+        grid = EdgeGrid(edges, cell_size=0.7)
+        angles = np.arange(-2.35, 2.35, 0.01)
+        for origin in [(0.0, 0.0), (13.1, -4.2), (-30.0, 5.0)]:
+            directions = beam_directions(0.4, angles)
+            expected = cast_rays(origin, directions, edges, 0.02, 15.0)
+            ranges = grid.cast_rays(origin, directions, 0.02, 15.0)
+            np.testing.assert_allclose(ranges, expected, equal_nan=True)
+
+    def test_dynamic_edges(self):
+        """Test that moved dynamic edges are hit where they are now"""
+        edges = self.random_edges(200)
+        grid = EdgeGrid(edges, cell_size=0.7)
+        angles = np.arange(-math.pi, math.pi, 0.01)
+        directions = beam_directions(0.0, angles)
+        rng = np.random.default_rng(1)
+        for _ in range(3):
+            # one obstacle inside and one partly outside of the grid
+            obstacles = {'a': self.random_edges(5, rng.integers(100)) / 4,
+                         'b': self.random_edges(5, rng.integers(100)) / 4 + [24, 0, 24, 0]}
+            grid.update_dynamic(obstacles)
+            expected = cast_rays((1.0, 2.0), directions, np.vstack([edges, *obstacles.values()]),
+                                 0.02, 30.0)
+            ranges = grid.cast_rays((1.0, 2.0), directions, 0.02, 30.0)
+            np.testing.assert_allclose(ranges, expected, equal_nan=True)
+
+        version = grid.version
+        grid.remove_dynamic('a')
+        grid.remove_dynamic('b')
+        self.assertGreater(grid.version, version)
+        np.testing.assert_allclose(grid.cast_rays((1.0, 2.0), directions, 0.02, 30.0),
+                                   cast_rays((1.0, 2.0), directions, edges, 0.02, 30.0),
+                                   equal_nan=True)
+
+    def test_empty(self):
+        """Test a grid without edges"""
+        grid = EdgeGrid(np.empty((0, 4)))
+        ranges = grid.cast_rays((0.0, 0.0), beam_directions(0.0, np.zeros(3)), 0.02, 15.0)
+        self.assertTrue(np.all(np.isnan(ranges)))
+
+
+class VisibilityCullerTest(unittest.TestCase):
+
+    def random_rectangles(self, n, seed=3):
+        rng = np.random.default_rng(seed)
+        obstacles = []
+        for _ in range(n):
+            center = rng.uniform(-30, 30, size=2)
+            half = rng.uniform(0.1, 1.5, size=2)
+            corners = center + half * np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+            # mix clockwise and counter-clockwise polygons
+            obstacles.append(corners[::rng.choice([-1, 1])].tolist())
+        # enclosing room, the lidar is inside it
+        obstacles.append([[-40, -40], [40, -40], [40, 40], [-40, 40]])
+        return obstacles
+
+    def test_culling_is_conservative(self):
+        """Test that culled scans match full scans within the margin"""
+        edges, ids = edges_from_obstacles(self.random_rectangles(300), return_ids=True)
+        angles = np.arange(math.radians(-135), math.radians(135), math.radians(1))
+        culler = VisibilityCuller(edges, ids, 15.0, angles[0], angles[-1],
+                                  margin=0.25, yaw_margin=math.radians(5))
+        rng = np.random.default_rng(11)
+        for _ in range(20):
+            pose = np.append(rng.uniform(-30, 30, size=2), rng.uniform(-math.pi, math.pi))
+            culler.pose = None
+            self.assertTrue(culler.update(pose))
+            self.assertLess(len(culler), len(edges))
+            moved = pose + [0.15, -0.15, math.radians(4)]
+            self.assertFalse(culler.update(moved))
+            directions = beam_directions(moved[2], angles)
+            expected = cast_rays(moved[:2], directions, edges, 0.02, 15.0)
+            ranges = cast_rays(moved[:2], directions, edges[culler.visible], 0.02, 15.0)
+            np.testing.assert_allclose(ranges, expected, equal_nan=True)
+
+
+class SharedEdgesTest(unittest.TestCase):
+
+    square = [[[1.0, -1.0], [3.0, -1.0], [3.0, 1.0], [1.0, 1.0]]]
+    pose = np.array([0.0, 0.2, 0.1])
+    angle_min, increment, beams = -math.pi, 2*math.pi / 360, 360
+
+    def setUp(self):
+        self.shared = SharedEdges()
+        self.addCleanup(self.shared.close)
+        self.pool = Pool(2)
+        self.addCleanup(self.pool.join)
+        self.addCleanup(self.pool.terminate)
+
+    def scan(self):
+        """Scan split over the workers, as in sim_lidar"""
+        tasks = [(self.shared.handle, self.pose, self.angle_min, self.increment,
+                  start, stop, 0.02, 15.0)
+                 for start, stop in ((0, 150), (150, self.beams))]
+        return np.concatenate(self.pool.map(cast_beams, tasks))
+
+    def expected(self, edges):
+        angles = self.angle_min + self.increment * np.arange(self.beams)
+        return cast_rays(self.pose[:2], beam_directions(self.pose[2], angles), edges, 0.02, 15.0)
+
+    def test_matches_cast_rays(self):
+        """Test that the workers compute the same scan from shared memory"""
+        edges = edges_from_obstacles(self.square)
+        self.shared.publish(edges)
+        np.testing.assert_allclose(self.scan(), self.expected(edges))
+
+    def test_republish(self):
+        """Test that workers see new versions of the edges and of the mask"""
+        self.shared.publish(edges_from_obstacles(self.square))
+        self.scan()
+        old_name = self.shared.handle[0]
+
+        edges = edges_from_obstacles(self.square + [[[-2.0, -1.0], [-1.0, -1.0], [-1.0, 1.0]]])
+        self.shared.publish(edges)
+        self.assertEqual(self.shared.version, 2)
+        np.testing.assert_allclose(self.scan(), self.expected(edges))
+
+        visible = np.arange(len(edges)) % 2 == 0
+        self.shared.set_visible(visible)
+        np.testing.assert_allclose(self.scan(), self.expected(edges[visible]))
+
+        # the previous version is removed once replaced
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=old_name)
+
+    def test_close(self):
+        """Test that the segment is removed when closed"""
+        self.shared.publish(edges_from_obstacles(self.square))
+        name = self.shared.handle[0]
+        self.scan()
+        self.shared.close()
+        self.assertIsNone(self.shared.handle)
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+class OccupancyRayMarcherTest(unittest.TestCase):
+
+    def test_matches_cell_edges(self):
+        """Test the ray marcher against the edges of the occupied cells"""
+        rng = np.random.default_rng(5)
+        occupied = rng.random((60, 90)) < 0.03
+        resolution, origin = 0.1, (-3.0, -2.0, 0.3)
+        marcher = OccupancyRayMarcher(occupied, resolution, origin)
+
+        rot = np.array([[math.cos(origin[2]), math.sin(origin[2])],
+                        [-math.sin(origin[2]), math.cos(origin[2])]])
+        cells = []
+        for iy, ix in zip(*np.nonzero(occupied)):
+            corners = np.array([[ix, iy], [ix+1, iy], [ix+1, iy+1], [ix, iy+1]]) * resolution
+            cells.append((corners @ rot + origin[:2]).tolist())
+        edges = edges_from_obstacles(cells)
+
+        angles = np.arange(-2.35, 2.35, 0.01)
+        for pose in [(1.0, 2.0, 0.2), (4.0, 1.0, 2.0), (-5.0, -5.0, 0.7)]:
+            directions = beam_directions(pose[2], angles)
+            expected = cast_rays(pose[:2], directions, edges, 0.02, 6.0)
+            ranges = marcher.cast_rays(pose[:2], directions, 0.02, 6.0)
+            np.testing.assert_allclose(ranges, expected, equal_nan=True)
+
+
+class LidarFleetTest(unittest.TestCase):
+
+    def test_matches_single_scans(self):
+        """Test batched scans against one scan per vehicle"""
+        obstacles = VisibilityCullerTest().random_rectangles(100)
+        edges, ids = edges_from_obstacles(obstacles, return_ids=True)
+        angles = np.arange(math.radians(-135), math.radians(135), math.radians(1))
+        footprint = (0.45, 0.15, 0.3)
+        fleet = LidarFleet(edges, 4, angles, 0.02, 15.0, polygon_ids=ids,
+                           cell_size=0.8, footprint=footprint)
+
+        # close together so that they see each other, the last one without pose
+        poses = np.array([[0.0, 0.0, 0.0], [2.0, 0.3, 2.5],
+                          [-1.0, 1.5, -1.0], [np.nan, np.nan, np.nan]])
+        ranges = fleet.scan(poses)
+
+        self.assertTrue(np.all(np.isnan(ranges[3])))
+        for i in range(3):
+            others = footprint_edges(np.delete(poses[:3], i, axis=0), *footprint)
+            directions = beam_directions(poses[i, 2], angles)
+            expected = cast_rays(poses[i, :2], directions, np.vstack((edges, others)),
+                                 0.02, 15.0)
+            np.testing.assert_allclose(ranges[i], expected, equal_nan=True)
+
+    def test_own_footprint_ignored(self):
+        """Test that a lidar does not see its own vehicle"""
+        fleet = LidarFleet(np.empty((0, 4)), 1, np.zeros(1), footprint=(0.45, 0.15, 0.3))
+        self.assertTrue(np.isnan(fleet.scan([[0.0, 0.0, math.pi]])[0, 0]))
+
+
+class ScanSchedulerTest(unittest.TestCase):
+
+    def test_coalesce_and_skip(self):
+        """Test that only the newest pose is scanned, once"""
+        scheduler = ScanScheduler(0.025)
+        self.assertIsNone(scheduler.tick(0.0))
+        scheduler.update((0.0, 0.0, 0.0), stamp=1)
+        scheduler.update((1.0, 0.0, 0.0), stamp=2)
+        self.assertEqual(scheduler.tick(0.025), ((1.0, 0.0, 0.0), 2))
+        self.assertIsNone(scheduler.tick(0.05))
+        self.assertEqual((scheduler.scans, scheduler.coalesced, scheduler.skipped), (1, 1, 2))
+
+    def test_dropped(self):
+        """Test that late ticks count the missed periods"""
+        scheduler = ScanScheduler(0.025)
+        scheduler.tick(0.0)
+        scheduler.tick(0.1)
+        self.assertEqual(scheduler.dropped, 3)
+        scheduler.report()
+        self.assertEqual(scheduler.dropped, 0)
+
+    def test_should_publish(self):
+        """Test that debug topics are decimated and need a subscriber"""
+        published = [count for count in range(1, 13) if should_publish(count, 4, 1)]
+        self.assertEqual(published, [4, 8, 12])
+        self.assertTrue(all(should_publish(count, 1, 2) for count in range(1, 5)))
+        self.assertFalse(any(should_publish(count, 4, 0) for count in range(1, 13)))
+        self.assertFalse(any(should_publish(count, 0, 1) for count in range(1, 13)))
+
+
+class ScanCacheTest(unittest.TestCase):
+
+    def test_quantized_hit(self):
+        """Test that poses within the resolution share a scan"""
+        cache = ScanCache(capacity=2, resolution=0.01, yaw_resolution=0.01)
+        ranges = np.arange(3.0)
+        cache.put((1.001, 2.001, 0.3001), ranges)
+        cached = cache.get((1.002, 2.003, 0.3002))
+        np.testing.assert_array_equal(cached, ranges)
+        self.assertFalse(cached.flags.writeable)
+        self.assertIsNone(cache.get((1.02, 2.003, 0.3002)))
+
+    def test_reuse_evicted(self):
+        """Test that a full cache copies into the evicted arrays"""
+        cache = ScanCache(capacity=1)
+        cache.put((0.0, 0.0, 0.0), np.zeros(3))
+        evicted = cache.get((0.0, 0.0, 0.0))
+        cache.put((1.0, 0.0, 0.0), np.ones(3))
+        cached = cache.get((1.0, 0.0, 0.0))
+        self.assertIs(cached, evicted)
+        np.testing.assert_array_equal(cached, np.ones(3))
+
+    def test_lru_and_invalidate(self):
+        """Test eviction of the least recently used scan and invalidation"""
+        cache = ScanCache(capacity=2)
+        for x in range(3):
+            cache.put((float(x), 0.0, 0.0), np.full(3, x))
+        self.assertIsNone(cache.get((0.0, 0.0, 0.0)))
+        self.assertIsNotNone(cache.get((2.0, 0.0, 0.0)))
+        cache.invalidate()
+        self.assertIsNone(cache.get((2.0, 0.0, 0.0)))
+        self.assertEqual(len(cache), 0)
+
+
+class ObstacleFileTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Test that a saved obstacle map loads as the same edges"""
+        obstacles = VisibilityCullerTest().random_rectangles(20)
+        expected, expected_ids = edges_from_obstacles(obstacles, return_ids=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'obstacles.npy')
+            save_obstacles(path, obstacles)
+            edges, ids = load_obstacles(path)
+            np.testing.assert_array_equal(edges, expected)
+            np.testing.assert_array_equal(ids, expected_ids)
+            self.assertTrue(edges.flags.c_contiguous)
+            self.assertFalse(edges.flags.writeable)
+            del edges
+
+    def test_not_an_obstacle_map(self):
+        """Test that other arrays are rejected"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'other.npy')
+            np.save(path, np.zeros((3, 4)))
+            with self.assertRaises(ValueError):
+                load_obstacles(path)
+
+
+class MovingObstacleTest(unittest.TestCase):
+
+    def test_trajectory(self):
+        """Test interpolation and looping along the trajectory"""
+        obstacle = MovingObstacle([[0, 0], [1, 0], [1, 1]],
+                                  trajectory=[[0, 0, 0, 0], [2, 2, 0, math.pi/2]])
+        self.assertTrue(obstacle.update(1.0))
+        np.testing.assert_allclose(obstacle.pose, [1.0, 0.0, math.pi/4])
+        self.assertFalse(obstacle.update(3.0))
+        np.testing.assert_allclose(obstacle.edges[0], [1.0, 0.0, 1.0 + math.sqrt(0.5), math.sqrt(0.5)])
+
+    def test_set_pose(self):
+        """Test that edges follow the pose set externally"""
+        obstacle = MovingObstacle([[0, 0], [1, 0]])
+        self.assertFalse(obstacle.update(1.0))
+        self.assertTrue(obstacle.set_pose([2.0, 1.0, math.pi]))
+        np.testing.assert_allclose(obstacle.edges[0], [2.0, 1.0, 1.0, 1.0], atol=1e-12)
+        self.assertFalse(obstacle.set_pose([2.0, 1.0, math.pi]))
+
+
+class NoiseStreamTest(unittest.TestCase):
+
+    def test_reproducible(self):
+        """Streams with the same seed and key draw the same noise, across
+        blocks and independent of the block size"""
+        first = NoiseStream((0.1, 0.05), shape=(2,), seed=7, key=('svea0', 'actuation'),
+                            block_size=16)
+        second = NoiseStream((0.1, 0.05), shape=(2,), seed=7, key=('svea0', 'actuation'),
+                             block_size=25)
+        samples = np.array([first.sample().copy() for _ in range(40)])
+        np.testing.assert_array_equal(samples, [second.sample().copy() for _ in range(40)])
+        self.assertEqual(samples.shape, (40, 2))
+
+    def test_independent_keys(self):
+        first = NoiseStream(1.0, seed=7, key='svea0')
+        second = NoiseStream(1.0, seed=7, key='svea1')
+        self.assertIsInstance(first.sample(), float)
+        self.assertNotEqual([first.sample() for _ in range(5)],
+                            [second.sample() for _ in range(5)])
+
+    def test_std(self):
+        stream = NoiseStream((0.1, 2.0), shape=2, seed=0)
+        samples = np.array([stream.sample().copy() for _ in range(5000)])
+        np.testing.assert_allclose(samples.std(axis=0), (0.1, 2.0), rtol=0.05)
+        np.testing.assert_allclose(samples.mean(axis=0), 0.0, atol=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the integrators of the bicycle models.
+
+Drives `Bicycle4DWithESC` with random steering and velocity requests at the
+top speed of the high gear, held for one control period each, and reports the
+position error against a reference solution together with the CPU time per
+simulated second, for every integrator and a range of time steps.
+
+Usage:
+    python3 benchmark_integrators.py [--duration 20] [--seed 0]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from svea_core.models.bicycle import Bicycle4D, Bicycle4DWithESC
+
+MAX_SPEED_1 = 3.6                           # top speed in high gear [m/s]
+CONTROL_PERIOD = 0.1                        # hold time of each request [s]
+TIME_STEPS = (0.0125, 0.025, 0.05, 0.1)     # simulation time steps [s]
+REFERENCE_STEP = CONTROL_PERIOD / 1000      # time step of the reference [s]
+
+
+def simulate(integrator, dt, requests):
+    """Simulates the requests and returns the pose after each control period
+    and the CPU time it took."""
+    model = Bicycle4DWithESC(dt=dt, integrator=integrator)
+    steps = round(CONTROL_PERIOD / dt)
+    poses = np.empty((len(requests), 3))
+    start = time.process_time()
+    for i, (steering, velocity) in enumerate(requests):
+        for _ in range(steps):
+            model.update(steering, velocity)
+        poses[i] = model.state[:3]
+    return poses, time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--duration', type=float, default=20.0, help="simulated time [s]")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    count = round(args.duration / CONTROL_PERIOD)
+    requests = np.column_stack([rng.uniform(-Bicycle4D.DELTA_MAX, Bicycle4D.DELTA_MAX, count),
+                                rng.uniform(0, MAX_SPEED_1, count)])
+
+    reference, _ = simulate('rk4', REFERENCE_STEP, requests)
+
+    print(f"{'integrator':>10} {'dt [s]':>8} {'max error [m]':>14} {'cpu [ms/s]':>11}")
+    for integrator in Bicycle4D.INTEGRATORS:
+        for dt in TIME_STEPS:
+            poses, cpu_time = simulate(integrator, dt, requests)
+            error = np.hypot(*(poses[:, :2] - reference[:, :2]).T).max()
+            print(f"{integrator:>10} {dt:>8} {error:>14.2e} "
+                  f"{1e3 * cpu_time / args.duration:>11.3f}")
+
+
+if __name__ == '__main__':
+    main()
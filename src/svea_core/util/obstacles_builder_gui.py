@@ -5,13 +5,16 @@ import pickle
 import numpy as np
 from PIL import Image, ImageTk
 import tkinter as tk
-from tkinter.filedialog import asksaveasfile, askopenfilename
+from tkinter.filedialog import asksaveasfilename, askopenfilename
+
+from svea_core.simulators.obstacle_file import save_obstacles
 
 
 class ObstaclesBuilderGUI(tk.Frame):
     """Obstacles Builder GUI, which allows the user to load a map and
     add obstacles defined by their edges. Finally, it allows the user to
-    export the map in the YAML format.
+    export the map in the YAML format, or as a binary obstacle map (.npy)
+    that sim_lidar can memory-map.
 
     :param master: master widget (root), defaults to tk.Tk()
     :type master: tkinter.Tk, optional
@@ -104,17 +107,23 @@ class ObstaclesBuilderGUI(tk.Frame):
         self.obstacle_creation_mode = not self.obstacle_creation_mode
 
     def _export_button_cb(self):
-        """Exports the obstacles to a YAML file
+        """Exports the obstacles to a YAML file or a binary obstacle map,
+        depending on the extension of the chosen file
         """
-        filename = asksaveasfile(
-            mode='w',
-            filetypes=(('YAML files', '*.yaml'), ('All files', '*.*'))
+        filename = asksaveasfilename(
+            filetypes=(('YAML files', '*.yaml'),
+                       ('Obstacle maps', '*.npy'),
+                       ('All files', '*.*'))
         )
 
         if not filename:
             return
 
-        with open(filename.name, 'w') as f:
+        if filename.endswith('.npy'):
+            save_obstacles(filename, self.obstacles)
+            return
+
+        with open(filename, 'w') as f:
             f.write('obstacles:\n')
             for obstacle in self.obstacles:
                 f.write(f'    - {str(obstacle)}')
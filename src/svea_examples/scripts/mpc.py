@@ -9,7 +9,7 @@ try:
     from svea_mocap.mocap import MotionCaptureInterface
 except ImportError:
     pass
-from svea_core.controllers.mpc import MPC
+from svea_core.controllers.mpc import MPC, AsyncMPC
 from std_msgs.msg import Float32
 from geometry_msgs.msg import PoseArray, PoseStamped
 from rclpy.qos import QoSProfile, QoSDurabilityPolicy, QoSReliabilityPolicy, QoSHistoryPolicy
@@ -90,7 +90,8 @@ class mpc(rx.Node):
             "svea7": 7
         }
 
-        self.controller = MPC(self)
+        # The MPC solves in a worker thread, so the loop never waits for the optimizer.
+        self.controller = AsyncMPC(MPC(self))
         self.DELTA_TIME = 1.0/self.mpc_freq
         self.initial_horizon = self.prediction_horizon
         self.initial_Qf = self.final_state_weight_matrix
@@ -139,10 +140,17 @@ class mpc(rx.Node):
                     self.RESET_MPC_PARAM = False  # Prevent repeated resetting
 
                 if  not self.is_goal_reached(distance_to_next_point):
-                    # Run the MPC to compute control
-                    steering_rate, acceleration = self.controller.compute_control([self.state[0],self.state[1],self.state[2],self.velocity,self.steering], reference_trajectory)
-                    self.steering += steering_rate * measured_dt
-                    self.velocity += acceleration * measured_dt  
+                    # Request a new solution and apply the newest one, at the current time
+                    now = current_time.sec + current_time.nanosec / 1e9
+                    self.controller.request([self.state[0],self.state[1],self.state[2],self.velocity,self.steering], reference_trajectory, now)
+                    control = self.controller.get_control(now)
+                    if control is not None:
+                        steering_rate, acceleration = control
+                        self.steering += steering_rate * measured_dt
+                        self.velocity += acceleration * measured_dt
+                    elif self.controller.age(now) != float('inf'):
+                        self.get_logger().warn(f"MPC solution is {self.controller.age(now):.2f} s old, holding the last control.",
+                                               throttle_duration_sec=1.0)
                     self.predicted_state = self.controller.get_optimal_states()
                 else:
                     # Stop the vehicle if the goal is reached
@@ -212,6 +220,8 @@ class mpc(rx.Node):
         self.UPDATE_MPC_PARAM = True  
         self.RESET_MPC_PARAM = False
         self.mpc_last_time = Clock().now().to_msg()
+        # solutions for the previous goal are of no use anymore
+        self.controller.clear()
         self.controller.reset_parameters()
 
         # Calculate the straight-line trajectory between current state and goal position
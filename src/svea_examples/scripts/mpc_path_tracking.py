@@ -9,7 +9,7 @@ try:
     from svea_mocap.mocap import MotionCaptureInterface
 except ImportError:
     pass
-from svea_core.controllers.mpc import MPC
+from svea_core.controllers.mpc import MPC, AsyncMPC
 
 from rclpy.qos import QoSProfile, QoSDurabilityPolicy, QoSReliabilityPolicy, QoSHistoryPolicy
 from rclpy.clock import Clock
@@ -65,7 +65,8 @@ class mpc_path_tracking(rx.Node):
         Initialize the MPC controller and set up the static path plan.
         """
 
-        self.controller = MPC(self)
+        # The MPC solves in a worker thread, so the loop never waits for the optimizer.
+        self.controller = AsyncMPC(MPC(self))
         self.mpc_dt = 1.0 / self.mpc_freq
         self.initial_horizon = self.prediction_horizon
         self.current_horizon = self.prediction_horizon
@@ -104,12 +105,18 @@ class mpc_path_tracking(rx.Node):
             measured_dt = current_time - self.mpc_last_time
             if measured_dt >= self.mpc_dt:
                 reference_trajectory = self.get_mpc_current_reference()
-                # Run the MPC to compute control
-                steering_rate, acceleration = self.controller.compute_control(
-                    [self.state[0], self.state[1], self.state[2], self.state[3], self.steering], reference_trajectory
+                # Request a new solution and apply the newest one, at the current time
+                self.controller.request(
+                    [self.state[0], self.state[1], self.state[2], self.state[3], self.steering], reference_trajectory, current_time
                 )
-                self.steering += steering_rate * measured_dt
-                self.velocity += acceleration * measured_dt
+                control = self.controller.get_control(current_time)
+                if control is not None:
+                    steering_rate, acceleration = control
+                    self.steering += steering_rate * measured_dt
+                    self.velocity += acceleration * measured_dt
+                elif self.controller.age(current_time) != float('inf'):
+                    self.get_logger().warn(f"MPC solution is {self.controller.age(current_time):.2f} s old, holding the last control.",
+                                           throttle_duration_sec=1.0)
                 self.predicted_state = self.controller.get_optimal_states()
                 self.mpc_last_time = current_time
 